@@ -8,28 +8,67 @@ import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
 import fhirclient.models.diagnosticreport as fhir_diag_mod
 import fhirclient.models.observation as fhir_obs_mod
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from itertools import chain, groupby
+import re
+from utils.db_connect import PostgresqlDB, SparqlDB, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, instance_num_to_ref
 import fhirclient.models.quantity as fhir_qty_mod
 
 
-@lru_cache()
-def _get_request_1():
+# CONCEPT_CD of the researches
+RESEARCH_REGEX = re.compile("^SYN|BACT:RECHERCHE_")
+
+
+# observation_fact columns used to build bacteriology bundles
+SYNERGY_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "MODIFIER_CD", "START_DATE", ' \
+                  '"TVAL_CHAR", "NVAL_NUM", "UNITS_CD"'
+
+# rows are grouped by INSTANCE_NUM into bundles, so they have to be sorted by it
+PostgresqlDB.register_statement(
+    'synergy_for_patient',
+    f"""SELECT {SYNERGY_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "PATIENT_NUM" = $1
+        ORDER BY "INSTANCE_NUM" """)
+PostgresqlDB.register_statement(
+    'synergy_for_encounter',
+    f"""SELECT {SYNERGY_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "ENCOUNTER_NUM" = $1
+        ORDER BY "INSTANCE_NUM" """)
+# results of the researches, by their INSTANCE_NUM
+PostgresqlDB.register_statement(
+    'synergy_results',
+    f"""SELECT {SYNERGY_COLUMNS} FROM observation_fact WHERE "INSTANCE_NUM" = ANY($1::bigint[])""")
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'synergy_for_patients',
+    f"""SELECT {SYNERGY_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "PATIENT_NUM" = ANY($1::bigint[])
+        ORDER BY "INSTANCE_NUM" """)
+PostgresqlDB.register_statement(
+    'synergy_for_encounters',
+    f"""SELECT {SYNERGY_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "ENCOUNTER_NUM" = ANY($1::bigint[])
+        ORDER BY "INSTANCE_NUM" """)
+
+
+@metadata(lazy_key='sLabel')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking bacteriologicalSearch and its target
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    search = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/bacteriologie-synergy#bacteriologicalSearch> .\
+    search = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/bacteriologie-synergy#bacteriologicalSearch> .\
                         ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                         ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?search .\
                         ?search <http://www.w3.org/2004/02/skos/core#prefLabel> ?sLabel }'
-    res = server.load_data(search)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['sLabel']['value']] = b['s']['value']
+    for s, s_label in server.load_rows(search, ['s', 'sLabel']):
+        hashed_map[s_label] = s
     return hashed_map
 
 
@@ -41,10 +80,7 @@ def get_bacterio_search_value(bacterio_search_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if bacterio_search_label in res:
-        return res[bacterio_search_label]
-    return default_value
+    return _get_request_1.lookup(bacterio_search_label, default_value)
 
 
 # def get_bacterio_sensibility_label(code):
@@ -63,7 +99,7 @@ def get_bacterio_search_value(bacterio_search_label, default_value=""):
 #     return ""
 
 
-# @lru_cache()
+# @metadata
 # def _get_request_3():
 #     server = SparqlDB()
 #     search = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/bacteriologie-synergy#organism> .\
@@ -84,20 +120,20 @@ def get_bacterio_search_value(bacterio_search_label, default_value=""):
 #     return default_value
 
 
-@lru_cache()
-def _get_request_2():
+@metadata(lazy_key='s', lazy_iri=True)
+def _get_request_2(values=''):
     """
     Get and cache metadata search linking antibiotic and its prefLabel
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    ident = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/bacteriologie-synergy#antibiotic> .\
+    ident = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/bacteriologie-synergy#antibiotic> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?prefLabel }'
-    res = server.load_data(ident)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['s']['value']] = b['prefLabel']['value']
+    for s, pref_label in server.load_rows(ident, ['s', 'prefLabel']):
+        hashed_map[s] = pref_label
     return hashed_map
 
 
@@ -109,11 +145,11 @@ def get_bacterio_antibiotic_label(antibiotic_code, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_2()
-    key = f"http://chu-bordeaux.fr/bacteriologie-synergy#antibiotic-{antibiotic_code}"
-    if key in res:
-        return res[key]
-    return default_value
+    return _get_request_2.lookup(_antibiotic_key(antibiotic_code), default_value)
+
+
+def _antibiotic_key(antibiotic_code):
+    return f"http://chu-bordeaux.fr/bacteriologie-synergy#antibiotic-{antibiotic_code}"
 
 
 # def get_display_material(code):
@@ -139,8 +175,7 @@ def get_synergy_for_patient(patient_num):
     :param patient_num: str
     :return: [fhirclient.models.bundle.Bundle() as json]
     """
-    return _process_synergy_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "PATIENT_NUM" = """ + patient_num)
+    return _process_synergy_request('synergy_for_patient', patient_num)
 
 
 def get_synergy_for_encounter(encounter_num):
@@ -150,44 +185,144 @@ def get_synergy_for_encounter(encounter_num):
     :param encounter_num: str
     :return: [fhirclient.models.bundle.Bundle() as json]
     """
-    return _process_synergy_request(
-        """
-        SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" = 'SYNERGIE' AND "ENCOUNTER_NUM" = 
-        """ + encounter_num)
+    return _process_synergy_request('synergy_for_encounter', encounter_num)
 
 
-def _process_synergy_request(sql_statement):
+def _process_synergy_request(statement_name, *params):
     """
-    processes bacteriology for a sql_statement
+    processes bacteriology for a registered statement
+    The results of all the researches are fetched at once.
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
     :return: [fhirclient.models.bundle.Bundle() as json]
     """
     connect_to_db = PostgresqlDB()
-    data_prelevements = connect_to_db.load_data(sql_statement)
+    data_prelevements = connect_to_db.fetch_rows(statement_name, *params)
+    instances_nums_results = _get_results_instances(data_prelevements)
 
-    # get research identifiers
-    bool_recherche = data_prelevements["CONCEPT_CD"].str.contains("^SYN|BACT:RECHERCHE_")
-    instances_nums_recherche = data_prelevements[bool_recherche].INSTANCE_NUM.unique()
+    # get results data by results id
+    instances_nums_res = [instance_num_res for instance_nums_res in instances_nums_results.values()
+                          for instance_num_res in instance_nums_res]
+    results_observations_data = group_rows(connect_to_db.fetch_rows('synergy_results', instances_nums_res),
+                                           'INSTANCE_NUM', instances_nums_res)
+    _prefetch_labels(data_prelevements, results_observations_data)
 
-    # get results identifiers by research id
-    instances_nums_results = {}
-    for instance_num_rec in instances_nums_recherche:
-        instances_nums_results[instance_num_rec] = data_prelevements.loc[(data_prelevements["TVAL_CHAR"] == str(instance_num_rec).replace(".0",""))
-                                                      & (data_prelevements["MODIFIER_CD"] == "SYN|BACT:PRELEVEMENT_INSTANCE_NUM"), 'INSTANCE_NUM']
+    return _build_synergy(data_prelevements, instances_nums_results, results_observations_data)
 
-    # get results data by results id
-    results_observations_data = {}
-    for instance_num_rec in instances_nums_recherche:
-        for instance_num_res in instances_nums_results[instance_num_rec]:
-            results_observations_data[instance_num_res] = connect_to_db.load_data("""SELECT * FROM observation_fact WHERE "INSTANCE_NUM" = """ + str(instance_num_res))
 
+def get_synergy_for_patients(patient_nums):
+    """
+    searches bacteriology for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.bundle.Bundle() as json]}
+    """
+    return _process_synergy_batch('synergy_for_patients', 'PATIENT_NUM', patient_nums)
+
+
+def get_synergy_for_encounters(encounter_nums):
+    """
+    searches bacteriology for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.bundle.Bundle() as json]}
+    """
+    return _process_synergy_batch('synergy_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_synergy_batch(statement_name, column, nums):
+    """
+    processes bacteriology for a registered batch statement, grouped by patient or encounter
+    The results of all the researches are fetched at once.
+
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.bundle.Bundle() as json]}
+    """
+    connect_to_db = PostgresqlDB()
+    rows_by_num = group_rows(connect_to_db.fetch_rows(statement_name, list(nums)), column, nums)
+    instances_by_num = {num: _get_results_instances(num_rows) for num, num_rows in rows_by_num.items()}
+
+    # get results data of all the researches by results id
+    instances_nums_res = [instance_num_res for instances_nums_results in instances_by_num.values()
+                          for instance_nums_res in instances_nums_results.values()
+                          for instance_num_res in instance_nums_res]
+    results_observations_data = group_rows(connect_to_db.fetch_rows('synergy_results', instances_nums_res),
+                                           'INSTANCE_NUM', instances_nums_res)
+    _prefetch_labels(chain.from_iterable(rows_by_num.values()), results_observations_data)
+
+    return {num: _build_synergy(rows_by_num[num], instances_by_num[num], results_observations_data)
+            for num in rows_by_num}
+
+
+def _prefetch_labels(data_prelevements, results_observations_data):
+    """
+    resolves at once the labels needed by the bundles, for the metadata resolved per key
+
+    :param data_prelevements: iterable of namedtuple, rows of the researches
+    :param results_observations_data: {result instance_num: [namedtuple]}, rows of the results
+    """
+    _get_request_1.prefetch(row.CONCEPT_CD for row in data_prelevements if "@" in row.MODIFIER_CD)
+    _get_request_2.prefetch(_antibiotic_key(row.MODIFIER_CD[len("SYN|BACT:SENSIBILITE_"):].split('-')[0])
+                            for rows in results_observations_data.values() for row in rows
+                            if 'SENSIBILITE' in row.MODIFIER_CD)
+
+
+def _get_results_instances(data_prelevements):
+    """
+    finds the results identifiers of each research
+
+    :param data_prelevements: [namedtuple], rows of the researches
+    :return: {research instance_num: [result instance_num]}
+    """
+    # index the results by the research they refer to, then get the results of each research
+    results_by_research = {}
+    instances_nums_recherche = {}
+    for row in data_prelevements:
+        if row.CONCEPT_CD is not None and RESEARCH_REGEX.search(row.CONCEPT_CD):
+            instances_nums_recherche[row.INSTANCE_NUM] = None
+        if row.MODIFIER_CD == "SYN|BACT:PRELEVEMENT_INSTANCE_NUM":
+            results_by_research.setdefault(row.TVAL_CHAR, {})[row.INSTANCE_NUM] = None
+    return {instance_num_rec: list(results_by_research.get(str(instance_num_rec), []))
+            for instance_num_rec in instances_nums_recherche}
+
+
+def _index_result_rows(observation_data):
+    """
+    splits the rows of a result in a single pass
+
+    :param observation_data: [namedtuple], rows of the result
+    :return: row giving the code of the result (the last one with "@" in MODIFIER_CD) or None,
+        [namedtuple] rows of the sensitivities and comments, in order
+    """
+    code_row = None
+    member_rows = []
+    for row in observation_data:
+        if "@" in row.MODIFIER_CD:
+            code_row = row
+        if 'SENSIBILITE' in row.MODIFIER_CD or 'COMMENTAIRE' in row.MODIFIER_CD:
+            member_rows.append(row)
+    return code_row, member_rows
+
+
+def _build_synergy(data_prelevements, instances_nums_results, results_observations_data):
+    """
+    builds bacteriology bundles from fetched rows
+
+    :param data_prelevements: [namedtuple], rows of the researches
+    :param instances_nums_results: {research instance_num: [result instance_num]}, see _get_results_instances
+    :param results_observations_data: {result instance_num: [namedtuple]}, rows of the results
+    :return: [fhirclient.models.bundle.Bundle() as json]
+    """
     # create bundles
-    data_by_instance = data_prelevements.groupby(["INSTANCE_NUM"])
+    data_by_instance = groupby(data_prelevements, key=lambda row: row.INSTANCE_NUM)
     list_of_bundles = []
     for instance_num_rec, instance_num_rec_data in data_by_instance:
         # for each research
-        encounter_num_str = str(instance_num_rec_data.iloc[0]["ENCOUNTER_NUM"]).replace(".0","")
+        instance_num_rec_data = list(instance_num_rec_data)
+        encounter_num_str = str(instance_num_rec_data[0].ENCOUNTER_NUM)
         # create bundle
         bundle = fhir_bundle_mod.Bundle()
         # identifier attribute
@@ -211,31 +346,31 @@ def _process_synergy_request(sql_statement):
         diagnosticReport.status = "final"
         # subject attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(instance_num_rec_data.iloc[0]["PATIENT_NUM"]).replace(".0",""))
+        ref_subject.reference = patient_num_to_ref(str(instance_num_rec_data[0].PATIENT_NUM))
         # ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0", ""))
         diagnosticReport.subject = ref_subject
         # issued attribute
         issued = fhir_date_mod.FHIRDate()
-        issued.date = date_to_datetime(instance_num_rec_data.iloc[0]["START_DATE"])
+        issued.date = date_to_datetime(instance_num_rec_data[0].START_DATE)
         diagnosticReport.issued = issued
 
         category_codings = []
         # get code and catgeory codings by analysing rows
-        for index, row in instance_num_rec_data.iterrows():
-            if "@" in row["MODIFIER_CD"]:
+        for row in instance_num_rec_data:
+            if "@" in row.MODIFIER_CD:
                 codeableconcept = fhir_cod_concept_mod.CodeableConcept()
                 codeableconcept.coding = []
                 coding = fhir_coding_mod.Coding()
                 coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
-                coding.code = row["CONCEPT_CD"]
+                coding.code = row.CONCEPT_CD
                 coding.display = get_bacterio_search_value(coding.code)
                 codeableconcept.coding = [coding]
                 diagnosticReport.code = codeableconcept
             else:
                 coding_categ = fhir_coding_mod.Coding()
                 coding_categ.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
-                coding_categ.code = row["MODIFIER_CD"]
-                coding_categ.display = row["TVAL_CHAR"] if row["TVAL_CHAR"] else ""
+                coding_categ.code = row.MODIFIER_CD
+                coding_categ.display = row.TVAL_CHAR if row.TVAL_CHAR else ""
                 category_codings.append(coding_categ)
 
         if diagnosticReport.code is None:
@@ -253,25 +388,28 @@ def _process_synergy_request(sql_statement):
         category_coding.coding = category_codings
         diagnosticReport.category = category_coding
 
+        # rows of each result, split once
+        results_rows = {instance_num_res: _index_result_rows(results_observations_data[instance_num_res])
+                        for instance_num_res in instances_nums_results[instance_num_rec]}
+
         diag_results = []
         # 1 result by line of results_observations_data
-        for instance_num_res in instances_nums_results[instance_num_rec]:
+        for instance_num_res, (code_row, _) in results_rows.items():
             ref_result = fhir_ref_mod.FHIRReference()
-            ref_result.reference = instance_num_to_ref(str(instance_num_res).replace('.0', ""))
-            observation_data = results_observations_data[instance_num_res]
-            for index, row in observation_data.iterrows():
-                if "@" in row["MODIFIER_CD"]:
-                    ref_result.display = row["TVAL_CHAR"] if row["TVAL_CHAR"] else ""
+            ref_result.reference = instance_num_to_ref(str(instance_num_res))
+            if code_row is not None:
+                ref_result.display = code_row.TVAL_CHAR if code_row.TVAL_CHAR else ""
             diag_results.append(ref_result)
 
         diagnosticReport.result = diag_results
         diagnostic_entry.resource = diagnosticReport
         bundle.entry.append(diagnostic_entry)
 
-        # get observations members (results for the current research)
-        for instance_num_res in instances_nums_results[instance_num_rec]:
+        # get observations members (results for the current research), each followed by its
+        # quantities/interpretations and comments
+        for instance_num_res, (code_row, member_rows) in results_rows.items():
             # for each result
-            instance_num_str = str(instance_num_res).replace(".0","")
+            instance_num_str = str(instance_num_res)
             observation_entry = fhir_bundle_mod.BundleEntry()
             observation_entry.fullUrl = "https://eds.chu-bordeaux.fr/fhir/Observation/" + instance_num_str
 
@@ -287,130 +425,115 @@ def _process_synergy_request(sql_statement):
             observation.subject = ref_subject
             # issued attribute
             issued = fhir_date_mod.FHIRDate()
-            issued.date = date_to_datetime(observation_data.iloc[0]["START_DATE"])
+            issued.date = date_to_datetime(observation_data[0].START_DATE)
             observation.issued = issued
 
+            if code_row is not None:
+                codeableconcept = fhir_cod_concept_mod.CodeableConcept()
+                codeableconcept.coding = []
+                coding = fhir_coding_mod.Coding()
+                coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
+                coding.code = code_row.CONCEPT_CD
+                coding.display = code_row.TVAL_CHAR if code_row.TVAL_CHAR else ""
+                codeableconcept.coding = [coding]
+                observation.code = codeableconcept
+
             observation.hasMember = []
+            observation_entry.resource = observation
+            bundle.entry.append(observation_entry)
+
+            for row in member_rows:
+                if 'SENSIBILITE' in row.MODIFIER_CD:
+                    id_val = row.MODIFIER_CD[len("SYN|BACT:SENSIBILITE_"):]
+                    id_val = id_val.split('-')[0]
+                    id_ref = encounter_num_str + "_" + instance_num_str + "_" + id_val
+                    if "SYN|BACT:SENSIBILITE_" in row.MODIFIER_CD:
+                        hasmember_ref = fhir_ref_mod.FHIRReference()
+                        hasmember_ref.reference = instance_num_to_ref(id_ref)
+                        observation.hasMember.append(hasmember_ref)
+
+                    observation_quantity_entry = fhir_bundle_mod.BundleEntry()
+                    observation_quantity_entry.fullUrl = "https://eds.chu-bordeaux.fr/fhir/Observation/" + id_ref
+
+                    observation_quantity = fhir_obs_mod.Observation()
+                    # identifier attribute
+                    ident_obs = fhir_id_mod.Identifier()
+                    ident_obs.value = id_ref
+                    observation_quantity.identifier = [ident_obs]
+                    # status attribute
+                    observation_quantity.status = "final"
+                    # subject attribute
+                    observation_quantity.subject = ref_subject
 
-            for i, row in observation_data.iterrows():
-                if "@" in row["MODIFIER_CD"]:
                     codeableconcept = fhir_cod_concept_mod.CodeableConcept()
                     codeableconcept.coding = []
                     coding = fhir_coding_mod.Coding()
-                    coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
-                    coding.code = row["CONCEPT_CD"]
-                    coding.display = row["TVAL_CHAR"] if row["TVAL_CHAR"] else ""
+                    coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology/Antibiotic"
+                    coding.code = id_val
+                    coding.display = get_bacterio_antibiotic_label(id_val)
                     codeableconcept.coding = [coding]
-                    observation.code = codeableconcept
-
-                if 'SENSIBILITE' in row["MODIFIER_CD"]:
+                    observation_quantity.code = codeableconcept
+
+                    # valueQuantity attribute
+                    quantity = fhir_qty_mod.Quantity()
+                    quantity.value = row.NVAL_NUM
+                    quantity.unit = row.UNITS_CD if row.UNITS_CD else ""
+                    observation_quantity.valueQuantity = quantity
+                    # interpretation attribute
+                    codeableconcept_interpretation = fhir_cod_concept_mod.CodeableConcept()
+                    codinginterpretation = fhir_coding_mod.Coding()
+                    codinginterpretation.system = "https://eds.chu-bordeaux.fr/fhir/SynergyBacteriology"
+                    codinginterpretation.code = row.MODIFIER_CD
+                    codinginterpretation.display = row.TVAL_CHAR if row.TVAL_CHAR else None
+                    codeableconcept_interpretation.coding = [codinginterpretation]
+                    observation_quantity.interpretation = codeableconcept_interpretation
+
+                    observation_quantity_entry.resource = observation_quantity
+                    bundle.entry.append(observation_quantity_entry)
+
+                if 'COMMENTAIRE' in row.MODIFIER_CD:
+                    id_ref = encounter_num_str + "_" + instance_num_str + "_commentaires"
                     hasmember_ref = fhir_ref_mod.FHIRReference()
-                    if "SYN|BACT:SENSIBILITE_" not in row["MODIFIER_CD"]:
-                        continue
-                    id_val = row["MODIFIER_CD"][len("SYN|BACT:SENSIBILITE_"):]
-                    id_val = id_val.split('-')[0]
-                    id_ref = encounter_num_str + "_" + instance_num_str + "_" + id_val
                     hasmember_ref.reference = instance_num_to_ref(id_ref)
                     observation.hasMember.append(hasmember_ref)
 
-                if 'COMMENTAIRE' in row["MODIFIER_CD"]:
-                    hasmember_ref = fhir_ref_mod.FHIRReference()
-                    id_ref = encounter_num_str + "_" + instance_num_str + "_commentaires"
-                    hasmember_ref.reference = instance_num_to_ref(id_ref)
-                    observation.hasMember.append(hasmember_ref)
+                    observation_comment_entry = fhir_bundle_mod.BundleEntry()
+                    observation_comment_entry.fullUrl = "https://eds.chu-bordeaux.fr/fhir/Observation/" + id_ref
 
-            observation_entry.resource = observation
-            bundle.entry.append(observation_entry)
+                    observation_comment = fhir_obs_mod.Observation()
+                    # identifier attribute
+                    ident_obs = fhir_id_mod.Identifier()
+                    ident_obs.value = id_ref
+                    observation_comment.identifier = [ident_obs]
+                    # status attribute
+                    observation_comment.status = "final"
+                    # subject attribute
+                    observation_comment.subject = ref_subject
 
-            # get observations quantities/interpretations or comments
-            for instance_num_res in instances_nums_results[instance_num_rec]:
-                instance_num_str = str(instance_num_res).replace(".0", "")
-                observation_data = results_observations_data[instance_num_res]
-                for i, row in observation_data.iterrows():
-                    if 'SENSIBILITE' in row["MODIFIER_CD"]:
-                        id_val = row["MODIFIER_CD"][len("SYN|BACT:SENSIBILITE_"):]
-                        id_val = id_val.split('-')[0]
-                        id_ref = encounter_num_str + "_" + instance_num_str + "_" + id_val
-
-                        observation_quantity_entry = fhir_bundle_mod.BundleEntry()
-                        observation_quantity_entry.fullUrl = "https://eds.chu-bordeaux.fr/fhir/Observation/" + id_ref
-
-                        observation_quantity = fhir_obs_mod.Observation()
-                        # identifier attribute
-                        ident_obs = fhir_id_mod.Identifier()
-                        ident_obs.value = id_ref
-                        observation_quantity.identifier = [ident_obs]
-                        # status attribute
-                        observation_quantity.status = "final"
-                        # subject attribute
-                        observation_quantity.subject = ref_subject
-
-                        codeableconcept = fhir_cod_concept_mod.CodeableConcept()
-                        codeableconcept.coding = []
-                        coding = fhir_coding_mod.Coding()
-                        coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology/Antibiotic"
-                        coding.code = id_val
-                        coding.display = get_bacterio_antibiotic_label(id_val)
-                        codeableconcept.coding = [coding]
-                        observation_quantity.code = codeableconcept
-
-                        # valueQuantity attribute
-                        quantity = fhir_qty_mod.Quantity()
-                        quantity.value = row["NVAL_NUM"]
-                        quantity.unit = row["UNITS_CD"] if row["UNITS_CD"] else ""
-                        observation_quantity.valueQuantity = quantity
-                        # interpretation attribute
-                        codeableconcept_interpretation = fhir_cod_concept_mod.CodeableConcept()
-                        codinginterpretation = fhir_coding_mod.Coding()
-                        codinginterpretation.system = "https://eds.chu-bordeaux.fr/fhir/SynergyBacteriology"
-                        codinginterpretation.code = row["MODIFIER_CD"]
-                        codinginterpretation.display = row["TVAL_CHAR"] if row["TVAL_CHAR"] else None
-                        codeableconcept_interpretation.coding = [codinginterpretation]
-                        observation_quantity.interpretation = codeableconcept_interpretation
-
-                        observation_quantity_entry.resource = observation_quantity
-                        bundle.entry.append(observation_quantity_entry)
-
-                    if 'COMMENTAIRE' in row["MODIFIER_CD"]:
-                        id_ref = encounter_num_str + "_" + instance_num_str + "_commentaires"
-
-                        observation_comment_entry = fhir_bundle_mod.BundleEntry()
-                        observation_comment_entry.fullUrl = "https://eds.chu-bordeaux.fr/fhir/Observation/" + id_ref
-
-                        observation_comment = fhir_obs_mod.Observation()
-                        # identifier attribute
-                        ident_obs = fhir_id_mod.Identifier()
-                        ident_obs.value = id_ref
-                        observation_comment.identifier = [ident_obs]
-                        # status attribute
-                        observation_comment.status = "final"
-                        # subject attribute
-                        observation_comment.subject = ref_subject
-
-                        codeableconcept = fhir_cod_concept_mod.CodeableConcept()
-                        codeableconcept.coding = []
-                        coding = fhir_coding_mod.Coding()
-                        coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
-                        coding.code = "TO_DO"
-                        coding.display = "Commentaires"
-                        codeableconcept.coding = [coding]
-                        observation_comment.code = codeableconcept
-
-                        # component
-                        component = fhir_obs_mod.ObservationComponent()
-                        valueCodeableConcept = fhir_cod_concept_mod.CodeableConcept()
-                        codingcomponent = fhir_coding_mod.Coding()
-                        codingcomponent.system = "https://eds.chu-bordeaux.fr/fhir/SynergyBacteriology"
-                        codingcomponent.code = row["MODIFIER_CD"]
-                        codingcomponent.display = row["TVAL_CHAR"] if row["TVAL_CHAR"] else None
-                        valueCodeableConcept.coding = [codingcomponent]
-                        component.valueCodeableConcept = valueCodeableConcept
-                        component.valueString = row["TVAL_CHAR"] if row["TVAL_CHAR"] else None
-                        component.code = component.valueCodeableConcept
-                        observation_comment.component = [component]
-
-                        observation_comment_entry.resource = observation_comment
-                        bundle.entry.append(observation_comment_entry)
+                    codeableconcept = fhir_cod_concept_mod.CodeableConcept()
+                    codeableconcept.coding = []
+                    coding = fhir_coding_mod.Coding()
+                    coding.system = "https://eds.chu-bordeaux.fr/SynergyBacteriology"
+                    coding.code = "TO_DO"
+                    coding.display = "Commentaires"
+                    codeableconcept.coding = [coding]
+                    observation_comment.code = codeableconcept
+
+                    # component
+                    component = fhir_obs_mod.ObservationComponent()
+                    valueCodeableConcept = fhir_cod_concept_mod.CodeableConcept()
+                    codingcomponent = fhir_coding_mod.Coding()
+                    codingcomponent.system = "https://eds.chu-bordeaux.fr/fhir/SynergyBacteriology"
+                    codingcomponent.code = row.MODIFIER_CD
+                    codingcomponent.display = row.TVAL_CHAR if row.TVAL_CHAR else None
+                    valueCodeableConcept.coding = [codingcomponent]
+                    component.valueCodeableConcept = valueCodeableConcept
+                    component.valueString = row.TVAL_CHAR if row.TVAL_CHAR else None
+                    component.code = component.valueCodeableConcept
+                    observation_comment.component = [component]
+
+                    observation_comment_entry.resource = observation_comment
+                    bundle.entry.append(observation_comment_entry)
 
         # bug trouvé en testant   --> solved in fhirclient==4.0.0, not yet available on pip
         bundle_json = bundle.as_json()
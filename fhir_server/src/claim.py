@@ -5,29 +5,65 @@ import fhirclient.models.fhirdate as fhir_date_mod
 import fhirclient.models.claim as fhir_claim_mod
 import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from itertools import chain, groupby
+from utils.db_connect import PostgresqlDB, SparqlDB, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
+from utils.fhir_templates import iter_resources, fhir_datetime, make_coding
 
 
-@lru_cache()
-def _get_request_1():
+# observation_fact columns used to build claims
+PMSI_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "MODIFIER_CD", "START_DATE"'
+
+# rows are grouped by INSTANCE_NUM into claims, so they have to be sorted by it
+PostgresqlDB.register_statement(
+    'pmsis_for_patient',
+    f"""SELECT {PMSI_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE-PMSI' AND "PATIENT_NUM" = $1
+        ORDER BY "INSTANCE_NUM", "START_DATE" """,
+    page_group=('"INSTANCE_NUM"',))
+PostgresqlDB.register_statement(
+    'pmsis_for_encounter',
+    f"""SELECT {PMSI_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE-PMSI' AND "ENCOUNTER_NUM" = $1
+        ORDER BY "INSTANCE_NUM", "START_DATE" """,
+    page_group=('"INSTANCE_NUM"',))
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'pmsis_for_patients',
+    f"""SELECT {PMSI_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE-PMSI' AND "PATIENT_NUM" = ANY($1::bigint[])
+        ORDER BY "INSTANCE_NUM", "START_DATE" """)
+PostgresqlDB.register_statement(
+    'pmsis_for_encounters',
+    f"""SELECT {PMSI_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE-PMSI' AND "ENCOUNTER_NUM" = ANY($1::bigint[])
+        ORDER BY "INSTANCE_NUM", "START_DATE" """)
+
+
+# constant parts of the claims built from templates, shared by all of them: resources are read-only
+_CLAIM_TYPE = {'coding': [{'system': "http://terminology.hl7.org/CodeSystem/claim-type", 'code': "institutional"}]}
+
+
+@metadata(lazy_key='pmsi_label')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking pmsi and its diagnosticCode
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/pmsi#diagnosticCode> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/pmsi#diagnosticCode> .\
                                     ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasMeaningPermissibleValueMeaning> ?d .\
                                     ?d <http://www.w3.org/2004/02/skos/core#prefLabel> ?l .\
                                     ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                     ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?pmsi .\
                                     ?pmsi <http://www.w3.org/2004/02/skos/core#prefLabel> ?pmsi_label }'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['pmsi_label']['value']] = b['l']['value']
+    for pmsi_label, label in server.load_rows(query_diag, ['pmsi_label', 'l']):
+        hashed_map[pmsi_label] = label
     return hashed_map
 
 
@@ -39,33 +75,30 @@ def get_pmsi_diagcode_value_by_pmsilabel(pmsi_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if pmsi_label in res:
-        return res[pmsi_label]
-    return default_value
+    return _get_request_1.lookup(pmsi_label, default_value)
     # for b in pmsi_diag['results']['bindings']:
     #     if pmsi_label in b['pmsi_label']['value'] and b['l']['value']:
     #         return b['l']['value']
     # return default_value
 
 
-@lru_cache()
-def _get_request_2():
+@metadata(lazy_key='pmsiLabel')
+def _get_request_2(values=''):
     """
     Get and cache metadata search linking pmsi and its procedureCode
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/pmsi#procedureCode> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/pmsi#procedureCode> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                 ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?pmsi .\
                                 ?pmsi <http://www.w3.org/2004/02/skos/core#prefLabel> ?pmsiLabel }'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['pmsiLabel']['value']] = b['label']['value']
+    for pmsi_label, label in server.load_rows(query_diag, ['pmsiLabel', 'label']):
+        hashed_map[pmsi_label] = label
     return hashed_map
 
 
@@ -77,55 +110,160 @@ def get_pmsi_proccode_label_by_pmsilabel(pmsi_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_2()
-    if pmsi_label in res:
-        return res[pmsi_label]
-    return default_value
+    return _get_request_2.lookup(pmsi_label, default_value)
 
 
-def get_pmsis_for_patient(patient_num):
+def get_pmsis_for_patient(patient_num, stream=False, page=None):
     """
     searches claims for a given patient
 
     :param patient_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.claim.Claim() as json]
     """
-    return _process_pmsi_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE-PMSI' AND "PATIENT_NUM" = """ + patient_num + """ ORDER BY "START_DATE" """)
+    return _process_pmsi_request('pmsis_for_patient', patient_num, stream=stream, page=page)
 
 
-def get_pmsis_for_encounter(encounter_num):
+def get_pmsis_for_encounter(encounter_num, stream=False, page=None):
     """
     searches claims for a given encounter
 
     :param encounter_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.claim.Claim() as json]
     """
-    return _process_pmsi_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE-PMSI' and  "ENCOUNTER_NUM" = """ + encounter_num + """ ORDER BY "START_DATE" """)
+    return _process_pmsi_request('pmsis_for_encounter', encounter_num, stream=stream, page=page)
 
 
-def _process_pmsi_request(sql_statement):
+def _process_pmsi_request(statement_name, *params, stream=False, page=None):
     """
-    processes claims for a sql_statement
+    processes claims for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream: if True, rows are read through a server-side cursor and resources are yielded one by one
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.claim.Claim() as json]
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data(sql_statement)
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return list(_iter_pmsi(rows)), next_key
+    if stream:
+        return _iter_pmsi(connect_to_db.iter_rows(statement_name, *params))
+    return list(_iter_pmsi(connect_to_db.fetch_rows(statement_name, *params)))
+
+
+def get_pmsis_for_patients(patient_nums):
+    """
+    searches claims for several patients at once
 
-    list_of_claims = []
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.claim.Claim() as json]}
+    """
+    return _process_pmsi_batch('pmsis_for_patients', 'PATIENT_NUM', patient_nums)
+
+
+def get_pmsis_for_encounters(encounter_nums):
+    """
+    searches claims for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.claim.Claim() as json]}
+    """
+    return _process_pmsi_batch('pmsis_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_pmsi_batch(statement_name, column, nums):
+    """
+    processes claims for a registered batch statement, grouped by patient or encounter
 
-    data = data.groupby(["INSTANCE_NUM"])
-    for group_ind, group_data in data:
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.claim.Claim() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: list(_iter_pmsi(num_rows)) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _iter_pmsi(rows):
+    """
+    builds claims from fetched rows, with the selected builders
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.claim.Claim() as json
+    """
+    return iter_resources(rows, _iter_pmsi_templates, _iter_pmsi_fhirclient)
+
+
+def _iter_pmsi_templates(rows):
+    """
+    builds claims from fetched rows as json dicts, without the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.claim.Claim() as json
+    """
+    rows = _get_request_1.iter_prefetched(rows, lambda row: row.CONCEPT_CD if "DIAG" in row.CONCEPT_CD else None)
+    rows = _get_request_2.iter_prefetched(rows, lambda row: row.CONCEPT_CD if "ACTE" in row.CONCEPT_CD else None)
+    for group_ind, group_data in groupby(rows, key=lambda row: row.INSTANCE_NUM):
+        first_row = next(group_data)
+        diagnosis = []
+        procedures = []
+        for row in chain([first_row], group_data):
+            if "DIAG" in row.CONCEPT_CD:
+                diag = {
+                    'diagnosisCodeableConcept': {'coding': [make_coding(
+                        "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-diagnostic-code", row.CONCEPT_CD,
+                        get_pmsi_diagcode_value_by_pmsilabel(row.CONCEPT_CD))]},
+                    'sequence': row.INSTANCE_NUM,
+                }
+                if "@" not in row.MODIFIER_CD:
+                    diag['type'] = [{'coding': [make_coding(
+                        "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-diagnostic-type", row.MODIFIER_CD)]}]
+                diagnosis.append(diag)
+            if "ACTE" in row.CONCEPT_CD:
+                procedures.append({
+                    'procedureCodeableConcept': {'coding': [make_coding(
+                        "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-procedure-code", row.CONCEPT_CD,
+                        get_pmsi_proccode_label_by_pmsilabel(row.CONCEPT_CD))]},
+                    'sequence': row.INSTANCE_NUM,
+                })
+        claim = {
+            'resourceType': 'Claim',
+            'identifier': [{'value': str(first_row.ENCOUNTER_NUM) + "_" + str(first_row.INSTANCE_NUM)}],
+            'status': 'active',
+            'type': _CLAIM_TYPE,
+            'patient': {'reference': patient_num_to_ref(str(first_row.PATIENT_NUM))},
+            'item': [{'encounter': [{'reference': encounter_num_to_ref(str(first_row.ENCOUNTER_NUM))}],
+                      'sequence': 0}],
+            'created': fhir_datetime(first_row.START_DATE),
+        }
+        if diagnosis:
+            claim['diagnosis'] = diagnosis
+        if procedures:
+            claim['procedure'] = procedures
+        yield claim
+
+
+def _iter_pmsi_fhirclient(rows):
+    """
+    builds claims from fetched rows through the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.claim.Claim() as json
+    """
+    for group_ind, group_data in groupby(rows, key=lambda row: row.INSTANCE_NUM):
+        group_data = list(group_data)
         claim = fhir_claim_mod.Claim()
         claim.procedure = []
         claim.diagnosis = []
         # identifier attribute
         ident = fhir_id_mod.Identifier()
-        ident.value = str(group_data.iloc[0]["ENCOUNTER_NUM"]).replace(".0", "")+ "_" + \
-                      str(group_data.iloc[0]["INSTANCE_NUM"]).replace(".0", "")
+        ident.value = str(group_data[0].ENCOUNTER_NUM) + "_" + \
+                      str(group_data[0].INSTANCE_NUM)
         claim.identifier = [ident]
         # status attribute
         claim.status = "active"
@@ -138,54 +276,52 @@ def _process_pmsi_request(sql_statement):
         claim.type = cc_category
         # patient attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(group_data.iloc[0]["PATIENT_NUM"]).replace(".0", ""))
+        ref_subject.reference = patient_num_to_ref(str(group_data[0].PATIENT_NUM))
         claim.patient = ref_subject
         # encounter attribute
         claim_item = fhir_claim_mod.ClaimItem()
         ref_encounter = fhir_ref_mod.FHIRReference()
-        ref_encounter.reference = encounter_num_to_ref(str(group_data.iloc[0]["ENCOUNTER_NUM"]).replace(".0", ""))
+        ref_encounter.reference = encounter_num_to_ref(str(group_data[0].ENCOUNTER_NUM))
         claim_item.encounter = [ref_encounter]
         claim_item.sequence = 0
         claim.item = [claim_item]
         # created attribute
         efdt = fhir_date_mod.FHIRDate()
-        efdt.date = date_to_datetime(group_data.iloc[0]["START_DATE"])
+        efdt.date = date_to_datetime(group_data[0].START_DATE)
         claim.created = efdt
-        for index, row in group_data.iterrows():
-            if "DIAG" in row["CONCEPT_CD"]:
+        for row in group_data:
+            if "DIAG" in row.CONCEPT_CD:
                 # diagnosis attribute
                 diag = fhir_claim_mod.ClaimDiagnosis()
                 codeableconcept = fhir_cod_concept_mod.CodeableConcept()
                 coding = fhir_coding_mod.Coding()
                 coding.system = "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-diagnostic-code"
-                coding.code = row["CONCEPT_CD"]
-                coding.display = get_pmsi_diagcode_value_by_pmsilabel(row["CONCEPT_CD"])
+                coding.code = row.CONCEPT_CD
+                coding.display = get_pmsi_diagcode_value_by_pmsilabel(row.CONCEPT_CD)
                 codeableconcept.coding = [coding]
                 diag.diagnosisCodeableConcept = codeableconcept
                 codeableconcept_type = fhir_cod_concept_mod.CodeableConcept()
-                if "@" not in row["MODIFIER_CD"]:
+                if "@" not in row.MODIFIER_CD:
                     coding_type = fhir_coding_mod.Coding()
                     coding_type.system = "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-diagnostic-type"
-                    coding_type.code = row["MODIFIER_CD"]
+                    coding_type.code = row.MODIFIER_CD
                     codeableconcept_type.coding = [coding_type]
                     diag.type = [codeableconcept_type]
-                diag.sequence = row["INSTANCE_NUM"]
+                diag.sequence = row.INSTANCE_NUM
                 claim.diagnosis.append(diag)
-            if "ACTE" in row["CONCEPT_CD"]:
+            if "ACTE" in row.CONCEPT_CD:
                 # procedure attribute
                 coding_proc = fhir_coding_mod.Coding()
-                coding_proc.code = row["CONCEPT_CD"]
+                coding_proc.code = row.CONCEPT_CD
                 proc = fhir_claim_mod.ClaimProcedure()
                 codeableconcept_proc = fhir_cod_concept_mod.CodeableConcept()
                 coding_proc.system = "https://eds.chu-bordeaux.fr/fhir/CodeSystem/pmsi-procedure-code"
-                coding_proc.display = get_pmsi_proccode_label_by_pmsilabel(row["CONCEPT_CD"])
+                coding_proc.display = get_pmsi_proccode_label_by_pmsilabel(row.CONCEPT_CD)
                 codeableconcept_proc.coding = [coding_proc]
-                proc.sequence = row["INSTANCE_NUM"]
+                proc.sequence = row.INSTANCE_NUM
                 proc.procedureCodeableConcept = codeableconcept_proc
                 claim.procedure.append(proc)
-        list_of_claims.append(claim.as_json())
-
-    return list_of_claims
+        yield claim.as_json()
 
 # entry point for PySpark application
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 from utils.config_parser import get_local_file, parse_full_config
+from utils.db_connect import get_engine_options
 
 
 class Config:
@@ -17,5 +18,6 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = 'postgresql://' + config['postgres_db']['user'] + ':' + config['postgres_db']['pwd'] \
                               + '@' + config['postgres_db']['host'] + '/' + config['postgres_db']['db_name']
+    SQLALCHEMY_ENGINE_OPTIONS = get_engine_options(config['postgres_db'])
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
@@ -6,27 +6,59 @@ import fhirclient.models.fhirdate as fhir_date_mod
 import fhirclient.models.diagnosticreport as fhir_diag_mod
 import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from utils.db_connect import PostgresqlDB, SparqlDB, PAGE_GROUP, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
-
-
-@lru_cache()
-def _get_request_1():
+from utils.fhir_templates import iter_resources, fhir_datetime, make_coding
+
+
+# observation_fact columns used to build diagnostic reports
+REPORT_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "START_DATE", "OBSERVATION_BLOB"'
+
+PostgresqlDB.register_statement(
+    'report_for_patient',
+    f"""SELECT {REPORT_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "PATIENT_NUM" = $1""",
+    page_group=PAGE_GROUP)
+PostgresqlDB.register_statement(
+    'report_for_encounter',
+    f"""SELECT {REPORT_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "ENCOUNTER_NUM" = $1""",
+    page_group=PAGE_GROUP)
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'report_for_patients',
+    f"""SELECT {REPORT_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "PATIENT_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'report_for_encounters',
+    f"""SELECT {REPORT_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "ENCOUNTER_NUM" = ANY($1::bigint[])""")
+
+
+# constant parts of the diagnostic reports built from templates, shared by all of them: resources are read-only
+_REPORT_CATEGORY = {'coding': [{'system': "https://eds.chu-bordeaux.fr/fhir/document-domain",
+                                'code': "https://eds.chu-bordeaux.fr/fhir/document-domain/1",
+                                'display': "Document de sortie"}]}
+
+
+@metadata(lazy_key='docLabel')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking documents and their categories
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/document#document> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/document#document> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?doc .\
                                 ?doc <http://www.w3.org/2004/02/skos/core#prefLabel> ?docLabel }'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['docLabel']['value']] = b['label']['value']
+    for doc_label, label in server.load_rows(query_diag, ['docLabel', 'label']):
+        hashed_map[doc_label] = label
     return hashed_map
 
 
@@ -38,50 +70,135 @@ def get_doccat_label_by_doclabel(doc_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if doc_label in res:
-        return res[doc_label]
-    return default_value
+    return _get_request_1.lookup(doc_label, default_value)
 
 
-def get_report_for_patient(patient_num):
+def get_report_for_patient(patient_num, stream=False, page=None):
     """
     searches diagnostic reports for a given patient
 
     :param patient_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.diagnosticreport.DiagnosticReport() as json]
     """
-    return _process_report_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "PATIENT_NUM" = """ + patient_num)
+    return _process_report_request('report_for_patient', patient_num, stream=stream, page=page)
 
 
-def get_report_for_encounter(encounter_num):
+def get_report_for_encounter(encounter_num, stream=False, page=None):
     """
     searches diagnostic reports for a given encounter
 
     :param encounter_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.diagnosticreport.DiagnosticReport() as json]
     """
-    return _process_report_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" IN ('SRV_DOC', 'SRV_IMAGERIE') AND "ENCOUNTER_NUM" = """ + encounter_num)
+    return _process_report_request('report_for_encounter', encounter_num, stream=stream, page=page)
 
 
-def _process_report_request(sql_statement):
+def _process_report_request(statement_name, *params, stream=False, page=None):
     """
-    processes diagnostic reports for a sql_statement
+    processes diagnostic reports for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream: if True, rows are read through a server-side cursor and resources are yielded one by one
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.DiagnosticReport.DiagnosticReport() as json]
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data(sql_statement)
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return list(_iter_report(rows)), next_key
+    if stream:
+        return _iter_report(connect_to_db.iter_rows(statement_name, *params))
+    return list(_iter_report(connect_to_db.fetch_rows(statement_name, *params)))
+
+
+def get_report_for_patients(patient_nums):
+    """
+    searches diagnostic reports for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.DiagnosticReport.DiagnosticReport() as json]}
+    """
+    return _process_report_batch('report_for_patients', 'PATIENT_NUM', patient_nums)
+
+
+def get_report_for_encounters(encounter_nums):
+    """
+    searches diagnostic reports for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.DiagnosticReport.DiagnosticReport() as json]}
+    """
+    return _process_report_batch('report_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_report_batch(statement_name, column, nums):
+    """
+    processes diagnostic reports for a registered batch statement, grouped by patient or encounter
 
-    df = list()
-    for index, row in data.iterrows():
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.DiagnosticReport.DiagnosticReport() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: list(_iter_report(num_rows)) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _iter_report(rows):
+    """
+    builds diagnostic reports from fetched rows, with the selected builders
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.diagnosticreport.DiagnosticReport() as json
+    """
+    return iter_resources(rows, _iter_report_templates, _iter_report_fhirclient)
+
+
+def _iter_report_templates(rows):
+    """
+    builds diagnostic reports from fetched rows as json dicts, without the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.diagnosticreport.DiagnosticReport() as json
+    """
+    for row in _get_request_1.iter_prefetched(rows, lambda row: str(row.CONCEPT_CD)):
+        concept_cd = str(row.CONCEPT_CD)
+        display = get_doccat_label_by_doclabel(concept_cd)
+        code = {'coding': [make_coding("https://eds.chu-bordeaux.fr/fhir/document-category", concept_cd, display)]}
+        if display is not None:
+            code['text'] = display
+        report = {
+            'resourceType': 'DiagnosticReport',
+            'identifier': [{'value': str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)}],
+            'status': 'final',
+            'category': _REPORT_CATEGORY,
+            'subject': {'reference': patient_num_to_ref(str(row.PATIENT_NUM))},
+            'encounter': {'reference': encounter_num_to_ref(str(row.ENCOUNTER_NUM))},
+            'issued': fhir_datetime(row.START_DATE),
+            'code': code,
+        }
+        if row.OBSERVATION_BLOB is not None:
+            report['conclusion'] = row.OBSERVATION_BLOB
+        yield report
+
+
+def _iter_report_fhirclient(rows):
+    """
+    builds diagnostic reports from fetched rows through the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.diagnosticreport.DiagnosticReport() as json
+    """
+    for row in rows:
         diagnosticReport = fhir_diag_mod.DiagnosticReport()
         # identifier attribute
         ident = fhir_id_mod.Identifier()
-        ident.value = str(row["ENCOUNTER_NUM"]).replace(".0","") + "_" + str(row["INSTANCE_NUM"]).replace(".0","")
+        ident.value = str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)
         diagnosticReport.identifier = [ident]
         # status attribute
         diagnosticReport.status = "final"
@@ -95,35 +212,33 @@ def _process_report_request(sql_statement):
         diagnosticReport.category = cc_category
         # subject attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0",""))
+        ref_subject.reference = patient_num_to_ref(str(row.PATIENT_NUM))
         diagnosticReport.subject = ref_subject
         # encounter attribute
         ref_encounter = fhir_ref_mod.FHIRReference()
-        ref_encounter.reference = encounter_num_to_ref(str(row["ENCOUNTER_NUM"]).replace(".0",""))
+        ref_encounter.reference = encounter_num_to_ref(str(row.ENCOUNTER_NUM))
         diagnosticReport.encounter = ref_encounter
         # issued attribute
         issued = fhir_date_mod.FHIRDate()
-        issued.date = date_to_datetime(row["START_DATE"])
+        issued.date = date_to_datetime(row.START_DATE)
         diagnosticReport.issued = issued
         # code attribute
         codeableconcept = fhir_cod_concept_mod.CodeableConcept()
         coding = fhir_coding_mod.Coding()
         coding.system = "https://eds.chu-bordeaux.fr/fhir/document-category"
-        coding.code = str(row["CONCEPT_CD"])
+        coding.code = str(row.CONCEPT_CD)
         coding.display = get_doccat_label_by_doclabel(coding.code)
         codeableconcept.coding = [coding]
         codeableconcept.text = coding.display
         diagnosticReport.code = codeableconcept
         # text
-        diagnosticReport.conclusion = row["OBSERVATION_BLOB"]
+        diagnosticReport.conclusion = row.OBSERVATION_BLOB
 
         # bug trouvé en testant   --> solved in fhirclient==4.0.0, not yet available on pip
         json_val = diagnosticReport.as_json()
         if 'encounter' not in json_val:
             json_val['encounter'] = ref_encounter.as_json()
-        df.append(json_val)
-
-    return df
+        yield json_val
 
 
 # entry point for PySpark application
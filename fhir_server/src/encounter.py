@@ -6,10 +6,55 @@ import fhirclient.models.identifier as fhir_id_mod
 import fhirclient.models.period as fhir_period_mod
 import fhirclient.models.fhirreference as fhir_ref_mod
 import fhirclient.models.codeableconcept as fhir_cod_concept_mod
-from utils.db_connect import PostgresqlDB
+from utils.db_connect import PostgresqlDB, group_rows
 from utils.utils import date_to_datetime, patient_num_to_ref
 
 
+# visit_dimension with the type of the visits and their locations aggregated in arrays, sorted by date:
+# one row per visit, the visits without type or location being left out
+ENCOUNTER_QUERY = """
+    SELECT
+        a."PATIENT_NUM",
+        a."ENCOUNTER_NUM",
+        a."START_DATE",
+        a."END_DATE",
+        a."SOURCESYSTEM_CD",
+        a."UPLOAD_ID",
+        b."TYPE",
+        c."UAMS",
+        c."LOCATION_START_DATES",
+        c."LOCATION_END_DATES"
+    FROM
+        visit_dimension a
+    INNER JOIN LATERAL (
+        SELECT min(t."TYPE") AS "TYPE"
+        FROM visit_type t
+        WHERE t."ENCOUNTER_NUM" = a."ENCOUNTER_NUM"
+        HAVING count(*) > 0
+    ) b ON TRUE
+    INNER JOIN LATERAL (
+        SELECT
+            array_agg(l."UAM" ORDER BY l."START_DATE", l."UAM", l."END_DATE") AS "UAMS",
+            array_agg(l."START_DATE" ORDER BY l."START_DATE", l."UAM", l."END_DATE") AS "LOCATION_START_DATES",
+            array_agg(l."END_DATE" ORDER BY l."START_DATE", l."UAM", l."END_DATE") AS "LOCATION_END_DATES"
+        FROM visit_location l
+        WHERE l."ENCOUNTER_NUM" = a."ENCOUNTER_NUM"
+        HAVING count(*) > 0
+    ) c ON TRUE
+    """
+
+PostgresqlDB.register_statement(
+    'encounter',
+    ENCOUNTER_QUERY + """WHERE a."ENCOUNTER_NUM" = $1""")
+PostgresqlDB.register_statement(
+    'encounters',
+    ENCOUNTER_QUERY + """WHERE a."ENCOUNTER_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'encounters_for_patients',
+    ENCOUNTER_QUERY + """WHERE a."PATIENT_NUM" = ANY($1::bigint[])
+        ORDER BY a."PATIENT_NUM", a."START_DATE", a."ENCOUNTER_NUM" """)
+
+
 def get_encounter(encounter_num):
     """
     Process encounter data for a given encounter
@@ -18,73 +63,92 @@ def get_encounter(encounter_num):
     :return: fhirclient.models.encounter.Encounter()
     """
     connect_to_db = PostgresqlDB()
-    sql_statement = """
-        SELECT 
-            a."PATIENT_NUM",
-            a."ENCOUNTER_NUM", 
-            a."START_DATE",
-            a."END_DATE",
-            a."SOURCESYSTEM_CD",
-            a."UPLOAD_ID",
-            b."TYPE",
-            c."UAM",
-            c."START_DATE" as start_date,
-            c."END_DATE" as end_date
-        FROM 
-            visit_dimension a
-        INNER JOIN visit_type b
-        ON a."ENCOUNTER_NUM" = b."ENCOUNTER_NUM"
-        INNER JOIN visit_location c
-        ON a."ENCOUNTER_NUM" = c."ENCOUNTER_NUM"
-        WHERE a."ENCOUNTER_NUM" =
-         """ + encounter_num
-
-    data = connect_to_db.load_data(sql_statement)
-    if data.empty:
+    return _build_encounter(connect_to_db.fetch_rows('encounter', encounter_num))
+
+
+def get_encounters(encounter_nums):
+    """
+    Process encounter data for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: fhirclient.models.encounter.Encounter()}, without the encounters not found
+    """
+    rows = PostgresqlDB().fetch_rows('encounters', list(encounter_nums))
+    return {num: _build_encounter(num_rows) for num, num_rows in group_rows(rows, 'ENCOUNTER_NUM', []).items()}
+
+
+def get_encounters_for_patients(patient_nums):
+    """
+    searches the encounters of one or several patients
+
+    :param patient_nums: [int]
+    :return: [fhirclient.models.encounter.Encounter()], sorted by patient and date
+    """
+    return _build_encounters(PostgresqlDB().fetch_rows('encounters_for_patients', list(patient_nums)))
+
+
+def _build_encounters(rows):
+    """
+    builds encounters from fetched rows, one row per encounter
+
+    :param rows: [namedtuple]
+    :return: [fhirclient.models.encounter.Encounter()]
+    """
+    return [_build_encounter([row]) for row in rows]
+
+
+def _build_encounter(rows):
+    """
+    builds an encounter from fetched rows
+
+    :param rows: [namedtuple], the row of the encounter
+    :return: fhirclient.models.encounter.Encounter()
+    """
+    if not rows:
         raise ValueError()
 
-    encounter_data = data.iloc[0]
+    encounter_data = rows[0]
     encounter = fhir_encounter_mod.Encounter()
     # id attribute
-    encounter.id = str(encounter_data["ENCOUNTER_NUM"]).replace(".0","")
+    encounter.id = str(encounter_data.ENCOUNTER_NUM)
     # status attribute
     encounter.status = "finished"
     # identifier attribute
     ident = fhir_id_mod.Identifier()
-    ident.system = str(encounter_data["SOURCESYSTEM_CD"])
-    ident.value = str(encounter_data["UPLOAD_ID"])
+    ident.system = str(encounter_data.SOURCESYSTEM_CD)
+    ident.value = str(encounter_data.UPLOAD_ID)
     encounter.identifier = [ident]
     # period attribute
     startdate = fhir_date_mod.FHIRDate()
-    startdate.date = date_to_datetime(encounter_data["START_DATE"])
+    startdate.date = date_to_datetime(encounter_data.START_DATE)
     period = fhir_period_mod.Period()
     period.start = startdate
     enddate = fhir_date_mod.FHIRDate()
-    enddate.date = date_to_datetime(encounter_data["END_DATE"])
+    enddate.date = date_to_datetime(encounter_data.END_DATE)
     period.end = enddate
     encounter.period = period
     # subject attribute
     ref_subject = fhir_ref_mod.FHIRReference()
-    ref_subject.reference = patient_num_to_ref(str(encounter_data["PATIENT_NUM"]).replace(".0",""))
+    ref_subject.reference = patient_num_to_ref(str(encounter_data.PATIENT_NUM))
     encounter.subject = ref_subject
     # type attribute
     codeableconcept = fhir_cod_concept_mod.CodeableConcept()
-    codeableconcept.text = str(encounter_data["TYPE"])
+    codeableconcept.text = str(encounter_data.TYPE)
     encounter.type = [codeableconcept]
     # location attribute
     encounter.location = []
-    for index in range(data.shape[0]):
-
+    for uam, location_start_date, location_end_date in zip(encounter_data.UAMS, encounter_data.LOCATION_START_DATES,
+                                                           encounter_data.LOCATION_END_DATES):
         enc_location = fhir_encounter_mod.EncounterLocation()
         ref_location = fhir_ref_mod.FHIRReference()
-        ref_location.reference = data["UAM"].astype(str)[index]
+        ref_location.reference = str(uam)
         enc_location.location = ref_location
         loc_startdate = fhir_date_mod.FHIRDate()
-        loc_startdate.date = date_to_datetime(data["start_date"][index])
+        loc_startdate.date = date_to_datetime(location_start_date)
         loc_period = fhir_period_mod.Period()
         loc_period.start = loc_startdate
         loc_enddate = fhir_date_mod.FHIRDate()
-        loc_enddate.date = date_to_datetime(data["end_date"][index])
+        loc_enddate.date = date_to_datetime(location_end_date)
         loc_period.end = loc_enddate
         enc_location.period = loc_period
         encounter.location.append(enc_location)
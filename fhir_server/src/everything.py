@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# coding: utf8
+from itertools import groupby
+from utils.db_connect import PostgresqlDB
+import patient
+import observation
+import diagnostic_report
+import medicationAdministration
+import procedure
+import claim
+import questionnaireResponse
+import bacteriologie
+
+
+# source systems of the facts of each resource type, in the order of the resources in the bundle
+OBS_SOURCES = ('DXCARE_RESULTATS',)
+REPORT_SOURCES = ('SRV_DOC', 'SRV_IMAGERIE')
+MED_SOURCES = ('DXCARE_PRESCRIPTION',)
+PROC_SOURCES = ('TRACELINE',)
+PMSI_SOURCES = ('DXCARE-PMSI',)
+QUEST_SOURCES = ('CHU_BORDEAUX_QUESTIONNAIRES_DXC',)
+SYNERGY_SOURCES = ('SYNERGIE',)
+EVERYTHING_SOURCES = OBS_SOURCES + REPORT_SOURCES + MED_SOURCES + PROC_SOURCES + PMSI_SOURCES + QUEST_SOURCES \
+                     + SYNERGY_SOURCES
+
+# observation_fact columns used by all the resource types
+EVERYTHING_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "MODIFIER_CD", "START_DATE", ' \
+                     '"VALTYPE_CD", "TVAL_CHAR", "NVAL_NUM", "VALUEFLAG_CD", "QUANTITY_NUM", "UNITS_CD", ' \
+                     '"OBSERVATION_BLOB", "SOURCESYSTEM_CD"'
+
+# a single scan of the ("PATIENT_NUM", "SOURCESYSTEM_CD") index for all the source systems
+PostgresqlDB.register_statement(
+    'everything_for_patient',
+    f"""SELECT {EVERYTHING_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" IN ({', '.join(f"'{source}'" for source in EVERYTHING_SOURCES)})
+        AND "PATIENT_NUM" = $1""")
+
+
+def get_everything_for_patient(patient_num):
+    """
+    searches the patient and all its resources
+
+    :param patient_num: str
+    :return: [resource as json], the patient first
+    """
+    connect_to_db = PostgresqlDB()
+    # unknown patients are answered before scanning the facts of all the source systems
+    patient_resource = patient._build_patient(connect_to_db.fetch_rows('patient', patient_num))
+    return _build_everything(patient_resource, connect_to_db.fetch_rows('everything_for_patient', patient_num))
+
+
+def _build_everything(patient_resource, rows):
+    """
+    builds the resources of a patient from fetched rows, partitioned by source system
+
+    :param patient_resource: patient as json, see patient._build_patient
+    :param rows: [namedtuple], rows of the everything_for_patient statement
+    :return: [resource as json], the patient first
+    """
+    resources = [patient_resource]
+    partitions = _partition_rows(rows)
+
+    def _get_partition(sources):
+        return [row for source in sources for row in partitions.get(source, [])]
+
+    resources += observation._iter_obs(_get_partition(OBS_SOURCES))
+    resources += diagnostic_report._iter_report(_get_partition(REPORT_SOURCES))
+    resources += medicationAdministration._iter_med(_get_partition(MED_SOURCES))
+    resources += procedure._iter_proc(_get_partition(PROC_SOURCES))
+    # claims and bacteriology are grouped by INSTANCE_NUM, as sorted by their statements
+    pmsi_rows = sorted(_get_partition(PMSI_SOURCES),
+                       key=lambda row: (row.INSTANCE_NUM, row.START_DATE is None, row.START_DATE or 0))
+    resources += claim._iter_pmsi(pmsi_rows)
+    resources += questionnaireResponse._build_quest(_get_partition(QUEST_SOURCES))
+    resources += _build_synergy(_get_partition(SYNERGY_SOURCES))
+    return resources
+
+
+def _partition_rows(rows):
+    """
+    partitions rows by source system, keeping their order
+
+    :param rows: iterable of namedtuple
+    :return: {SOURCESYSTEM_CD: [namedtuple]}
+    """
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(row.SOURCESYSTEM_CD, []).append(row)
+    return partitions
+
+
+def _build_synergy(synergy_rows):
+    """
+    builds bacteriology bundles, the results of the researches being taken among the patient's facts
+    instead of being fetched by bacteriologie._process_synergy_request
+
+    :param synergy_rows: [namedtuple], bacteriology rows of the patient
+    :return: [fhirclient.models.bundle.Bundle() as json]
+    """
+    data_prelevements = sorted(synergy_rows, key=lambda row: row.INSTANCE_NUM)
+    instances_nums_results = bacteriologie._get_results_instances(data_prelevements)
+    rows_by_instance = {instance_num: list(instance_rows)
+                        for instance_num, instance_rows in groupby(data_prelevements, key=lambda row: row.INSTANCE_NUM)}
+    results_observations_data = {}
+    for instance_num_rec in instances_nums_results:
+        for instance_num_res in instances_nums_results[instance_num_rec]:
+            results_observations_data[instance_num_res] = rows_by_instance.get(instance_num_res, [])
+    return bacteriologie._build_synergy(data_prelevements, instances_nums_results, results_observations_data)
@@ -8,28 +8,54 @@ import fhirclient.models.quantity as fhir_qty_mod
 import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
 import fhirclient.models.medication as fhir_medication_mod
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from utils.db_connect import PostgresqlDB, SparqlDB, PAGE_GROUP, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
-
-
-@lru_cache()
-def _get_request_1():
+from utils.fhir_templates import iter_resources, fhir_datetime, make_coding
+
+
+# observation_fact columns used to build medication administrations
+MED_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "START_DATE", "QUANTITY_NUM"'
+
+PostgresqlDB.register_statement(
+    'med_for_patient',
+    f"""SELECT {MED_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_PRESCRIPTION' AND "PATIENT_NUM" = $1""",
+    page_group=PAGE_GROUP)
+PostgresqlDB.register_statement(
+    'med_for_encounter',
+    f"""SELECT {MED_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_PRESCRIPTION' AND "ENCOUNTER_NUM" = $1""",
+    page_group=PAGE_GROUP)
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'med_for_patients',
+    f"""SELECT {MED_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_PRESCRIPTION' AND "PATIENT_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'med_for_encounters',
+    f"""SELECT {MED_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_PRESCRIPTION' AND "ENCOUNTER_NUM" = ANY($1::bigint[])""")
+
+
+@metadata(lazy_key='admLabel')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking drug administrations and the drugs listed inside
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-dxcare#drug> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-dxcare#drug> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                 ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?code .\
                                 ?code <http://www.w3.org/2004/02/skos/core#prefLabel> ?admLabel }'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['admLabel']['value']] = b['label']['value']
+    for adm_label, label in server.load_rows(query_diag, ['admLabel', 'label']):
+        hashed_map[adm_label] = label
     return hashed_map
 
 
@@ -41,90 +67,173 @@ def get_prescription_drug_label_by_adm_label(adm_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if adm_label in res:
-        return res[adm_label]
-    return default_value
+    return _get_request_1.lookup(adm_label, default_value)
 
 
-def get_med_for_patient(patient_num):
+def get_med_for_patient(patient_num, stream=False, page=None):
     """
     searches medication administrations for a given patient
 
     :param patient_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.medicationadministration.MedicationAdministration() as json]
     """
-    return _process_med_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE_PRESCRIPTION' AND "PATIENT_NUM" = """ + patient_num)
+    return _process_med_request('med_for_patient', patient_num, stream=stream, page=page)
 
 
-def get_med_for_encounter(encounter_num):
+def get_med_for_encounter(encounter_num, stream=False, page=None):
     """
     searches medication administrations for a given encounter
 
     :param encounter_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.medicationadministration.MedicationAdministration() as json]
     """
-    return _process_med_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE_PRESCRIPTION' and  "ENCOUNTER_NUM" = """ + encounter_num)
+    return _process_med_request('med_for_encounter', encounter_num, stream=stream, page=page)
 
 
-def _process_med_request(sql_statement):
+def _process_med_request(statement_name, *params, stream=False, page=None):
     """
-    processes medication administrations for a sql_statement
+    processes medication administrations for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream: if True, rows are read through a server-side cursor and resources are yielded one by one
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.medicationadministration.MedicationAdministration() as json]
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data(sql_statement)
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return list(_iter_med(rows)), next_key
+    if stream:
+        return _iter_med(connect_to_db.iter_rows(statement_name, *params))
+    return list(_iter_med(connect_to_db.fetch_rows(statement_name, *params)))
+
+
+def get_med_for_patients(patient_nums):
+    """
+    searches medication administrations for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.medicationadministration.MedicationAdministration() as json]}
+    """
+    return _process_med_batch('med_for_patients', 'PATIENT_NUM', patient_nums)
+
+
+def get_med_for_encounters(encounter_nums):
+    """
+    searches medication administrations for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.medicationadministration.MedicationAdministration() as json]}
+    """
+    return _process_med_batch('med_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_med_batch(statement_name, column, nums):
+    """
+    processes medication administrations for a registered batch statement, grouped by patient or encounter
 
-    df = list()
-    for index, row in data.iterrows():
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.medicationadministration.MedicationAdministration() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: list(_iter_med(num_rows)) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _iter_med(rows):
+    """
+    builds medication administrations from fetched rows, with the selected builders
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.medicationadministration.MedicationAdministration() as json
+    """
+    return iter_resources(rows, _iter_med_templates, _iter_med_fhirclient)
+
+
+def _iter_med_templates(rows):
+    """
+    builds medication administrations from fetched rows as json dicts, without the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.medicationadministration.MedicationAdministration() as json
+    """
+    for row in _get_request_1.iter_prefetched(rows, lambda row: str(row.CONCEPT_CD)):
+        concept_cd = str(row.CONCEPT_CD)
+        display = get_prescription_drug_label_by_adm_label(concept_cd)
+        code = {'coding': [make_coding("https://eds.chu-bordeaux.fr/fhir/CodeSystem/drug-code", concept_cd, display)]}
+        if display is not None:
+            code['text'] = display
+        medication_administration = {
+            'resourceType': 'MedicationAdministration',
+            'identifier': [{'value': str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)}],
+            'status': 'completed',
+            'medicationReference': {'reference': concept_cd.rsplit("|")[1]},
+            'subject': {'reference': patient_num_to_ref(str(row.PATIENT_NUM))},
+            'context': {'reference': encounter_num_to_ref(str(row.ENCOUNTER_NUM))},
+            'effectiveDateTime': fhir_datetime(row.START_DATE),
+            'contained': [{'resourceType': 'Medication', 'code': code}],
+        }
+        if row.QUANTITY_NUM:
+            medication_administration['dosage'] = {'dose': {'value': row.QUANTITY_NUM}}
+        yield medication_administration
+
+
+def _iter_med_fhirclient(rows):
+    """
+    builds medication administrations from fetched rows through the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.medicationadministration.MedicationAdministration() as json
+    """
+    for row in rows:
         medicationAdministration = fhir_med_mod.MedicationAdministration()
         # identifier attribute
         ident = fhir_id_mod.Identifier()
-        ident.value = str(row["ENCOUNTER_NUM"]).replace(".0","") + "_" + str(row["INSTANCE_NUM"]).replace(".0","")
+        ident.value = str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)
         medicationAdministration.identifier = [ident]
         # status attribute
         medicationAdministration.status = "completed"
         # medicationReference attribute
         ref_med = fhir_ref_mod.FHIRReference()
-        ref_med.reference = str(row["CONCEPT_CD"]).rsplit("|")[1]
+        ref_med.reference = str(row.CONCEPT_CD).rsplit("|")[1]
         medicationAdministration.medicationReference = ref_med
         # subject attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0",""))
+        ref_subject.reference = patient_num_to_ref(str(row.PATIENT_NUM))
         medicationAdministration.subject = ref_subject
         # encounter attribute
         ref_encounter = fhir_ref_mod.FHIRReference()
-        ref_encounter.reference = encounter_num_to_ref(str(row["ENCOUNTER_NUM"]).replace(".0",""))
+        ref_encounter.reference = encounter_num_to_ref(str(row.ENCOUNTER_NUM))
         medicationAdministration.context = ref_encounter
         # effectiveDateTime attribute
         startdate = fhir_date_mod.FHIRDate()
-        startdate.date = date_to_datetime(row["START_DATE"])
+        startdate.date = date_to_datetime(row.START_DATE)
         medicationAdministration.effectiveDateTime = startdate
         # contained attribute
         contained_resource = fhir_medication_mod.Medication()
         contained_codeableconcept = fhir_cod_concept_mod.CodeableConcept()
         coding = fhir_coding_mod.Coding()
         coding.system = "https://eds.chu-bordeaux.fr/fhir/CodeSystem/drug-code"
-        coding.code = str(row["CONCEPT_CD"])
+        coding.code = str(row.CONCEPT_CD)
         coding.display = get_prescription_drug_label_by_adm_label(coding.code)
         contained_codeableconcept.coding = [coding]
         contained_codeableconcept.text = coding.display
         contained_resource.code = contained_codeableconcept
         medicationAdministration.contained = [contained_resource]
         # dosage attribute
-        if row["QUANTITY_NUM"]:
+        if row.QUANTITY_NUM:
             dosage = fhir_med_mod.MedicationAdministrationDosage()
             dose = fhir_qty_mod.Quantity()
-            dose.value = row["QUANTITY_NUM"]
+            dose.value = row.QUANTITY_NUM
             dosage.dose = dose
             medicationAdministration.dosage = dosage
-        df.append(medicationAdministration.as_json())
-
-    return df
+        yield medicationAdministration.as_json()
 
 
 # entry point for PySpark application
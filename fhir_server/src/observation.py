@@ -7,31 +7,56 @@ import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
 import fhirclient.models.quantity as fhir_qty_mod
 from fhirclient.models.observation import ObservationReferenceRange
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from utils.db_connect import PostgresqlDB, SparqlDB, PAGE_GROUP, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
+from utils.fhir_templates import iter_resources, iter_chunks, fhir_datetime, make_coding, transform_column
 
 
-@lru_cache()
-def _get_request_1():
+# observation_fact columns used to build observations
+OBS_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "START_DATE", "NVAL_NUM", "UNITS_CD", "VALUEFLAG_CD"'
+
+PostgresqlDB.register_statement(
+    'obs_for_patient',
+    f"""SELECT {OBS_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_RESULTATS' AND "PATIENT_NUM" = $1""",
+    page_group=PAGE_GROUP)
+PostgresqlDB.register_statement(
+    'obs_for_encounter',
+    f"""SELECT {OBS_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_RESULTATS' AND "ENCOUNTER_NUM" = $1""",
+    page_group=PAGE_GROUP)
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'obs_for_patients',
+    f"""SELECT {OBS_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_RESULTATS' AND "PATIENT_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'obs_for_encounters',
+    f"""SELECT {OBS_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'DXCARE_RESULTATS' AND "ENCOUNTER_NUM" = ANY($1::bigint[])""")
+
+
+@metadata(lazy_key='t_label')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking drug biological results and their targets
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    bio_result = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/biologie-dxcare-num#biologicalResult> .\
+    bio_result = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/biologie-dxcare-num#biologicalResult> .\
                                     ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?t .\
                                     ?t <http://www.w3.org/2000/01/rdf-schema#label> ?t_label .\
                                     ?s <http://www.w3.org/2000/01/rdf-schema#label> ?r_label }'
-    res = server.load_data(bio_result)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['t_label']['value']] = b['r_label']['value']
+    for t_label, r_label in server.load_rows(bio_result, ['t_label', 'r_label']):
+        hashed_map[t_label] = r_label
     return hashed_map
 
 
-@lru_cache()
 def get_bio_result_label_from_concept_cd(concept_cd, default_value=""):
     """
     look for a bio result label by its concept_cd via _get_request_1()
@@ -40,50 +65,156 @@ def get_bio_result_label_from_concept_cd(concept_cd, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if concept_cd in res:
-        return res[concept_cd]
-    return default_value
+    return _get_request_1.lookup(concept_cd, default_value)
 
 
-def get_obs_for_patient(patient_num):
+def get_obs_for_patient(patient_num, stream=False, page=None):
     """
     searches observations for a given patient
 
     :param patient_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.observation.Observation() as json]
     """
-    return _process_obs_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE_RESULTATS' AND "PATIENT_NUM" = """ + patient_num)
+    return _process_obs_request('obs_for_patient', patient_num, stream=stream, page=page)
 
 
-def get_obs_for_encounter(encounter_num):
+def get_obs_for_encounter(encounter_num, stream=False, page=None):
     """
     searches observations for a given encounter
 
     :param encounter_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.observation.Observation() as json]
     """
-    return _process_obs_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='DXCARE_RESULTATS' and  "ENCOUNTER_NUM" = """ + encounter_num)
+    return _process_obs_request('obs_for_encounter', encounter_num, stream=stream, page=page)
 
 
-def _process_obs_request(sql_statement):
+def _process_obs_request(statement_name, *params, stream=False, page=None):
     """
-    processes observations for a sql_statement
+    processes observations for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream: if True, rows are read through a server-side cursor and resources are yielded one by one
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.observation.Observation() as json]
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data(sql_statement)
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return list(_iter_obs(rows)), next_key
+    if stream:
+        return _iter_obs(connect_to_db.iter_rows(statement_name, *params))
+    return list(_iter_obs(connect_to_db.fetch_rows(statement_name, *params)))
+
+
+def get_obs_for_patients(patient_nums):
+    """
+    searches observations for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.observation.Observation() as json]}
+    """
+    return _process_obs_batch('obs_for_patients', 'PATIENT_NUM', patient_nums)
 
-    df = list()
-    for index, row in data.iterrows():
+
+def get_obs_for_encounters(encounter_nums):
+    """
+    searches observations for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.observation.Observation() as json]}
+    """
+    return _process_obs_batch('obs_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_obs_batch(statement_name, column, nums):
+    """
+    processes observations for a registered batch statement, grouped by patient or encounter
+
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.observation.Observation() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: list(_iter_obs(num_rows)) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _iter_obs(rows):
+    """
+    builds observations from fetched rows, with the selected builders
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.observation.Observation() as json
+    """
+    return iter_resources(rows, _iter_obs_templates, _iter_obs_fhirclient)
+
+
+def _iter_obs_templates(rows):
+    """
+    builds observations from fetched rows as json dicts, without the fhirclient object model
+
+    The strings of each column (identifiers, references, dates, labels) are computed once per distinct value
+    for a batch of rows, then zipped into the resources.
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.observation.Observation() as json
+    """
+    for chunk in iter_chunks(rows):
+        patient_nums = transform_column([row.PATIENT_NUM for row in chunk], str)
+        encounter_nums = transform_column([row.ENCOUNTER_NUM for row in chunk], str)
+        concept_cds = transform_column([row.CONCEPT_CD for row in chunk], str)
+        _get_request_1.prefetch(concept_cds)
+        columns = zip(
+            [patient_num + "_" + encounter_num for patient_num, encounter_num in zip(patient_nums, encounter_nums)],
+            transform_column(patient_nums, patient_num_to_ref),
+            transform_column(encounter_nums, encounter_num_to_ref),
+            transform_column(concept_cds, lambda concept_cd: concept_cd.replace(".0", "")),
+            concept_cds,
+            transform_column(concept_cds, get_bio_result_label_from_concept_cd),
+            transform_column([row.START_DATE for row in chunk], fhir_datetime),
+            [row.NVAL_NUM for row in chunk],
+            transform_column([row.UNITS_CD for row in chunk], str),
+            transform_column([row.VALUEFLAG_CD for row in chunk], str))
+        for identifier, subject, encounter, category_code, concept_cd, display, effective_date, value, unit, flag \
+                in columns:
+            code = {'coding': [make_coding("https://eds.chu-bordeaux.fr/fhir/bio-code", concept_cd, display)]}
+            if display is not None:
+                code['text'] = display
+            value_quantity = {'unit': unit}
+            if value is not None:
+                value_quantity['value'] = value
+            yield {
+                'resourceType': 'Observation',
+                'identifier': [{'value': identifier}],
+                'status': 'final',
+                'category': [{'coding': [{'system': "https://eds.chu-bordeaux.fr/fhir/bio-category",
+                                          'code': category_code}]}],
+                'subject': {'reference': subject},
+                'encounter': {'reference': encounter},
+                'effectiveDateTime': effective_date,
+                'code': code,
+                'valueQuantity': value_quantity,
+                'referenceRange': [{'text': flag}],
+            }
+
+
+def _iter_obs_fhirclient(rows):
+    """
+    builds observations from fetched rows through the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.observation.Observation() as json
+    """
+    for row in rows:
         observation = fhir_observation_mod.Observation()
         # identifier attribute
         ident = fhir_id_mod.Identifier()
-        ident.value = str(row["PATIENT_NUM"]).replace(".0","") + "_" + str(row["ENCOUNTER_NUM"]).replace(".0","")
+        ident.value = str(row.PATIENT_NUM) + "_" + str(row.ENCOUNTER_NUM)
         observation.identifier = [ident]
         # status attribute
         observation.status = "final"
@@ -91,46 +222,44 @@ def _process_obs_request(sql_statement):
         cc_category = fhir_cod_concept_mod.CodeableConcept()
         coding_categ = fhir_coding_mod.Coding()
         coding_categ.system = "https://eds.chu-bordeaux.fr/fhir/bio-category"
-        coding_categ.code = str(row["CONCEPT_CD"]).replace(".0","")
+        coding_categ.code = str(row.CONCEPT_CD).replace(".0","")
         cc_category.coding = [coding_categ]
         observation.category = [cc_category]
         # subject attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0",""))
+        ref_subject.reference = patient_num_to_ref(str(row.PATIENT_NUM))
         observation.subject = ref_subject
         # encounter attribute
         ref_encounter = fhir_ref_mod.FHIRReference()
-        ref_encounter.reference = encounter_num_to_ref(str(row["ENCOUNTER_NUM"]).replace(".0",""))
+        ref_encounter.reference = encounter_num_to_ref(str(row.ENCOUNTER_NUM))
         observation.encounter = ref_encounter
         # effectiveDateTime attribute
         efdt = fhir_date_mod.FHIRDate()
-        efdt.date = date_to_datetime(row["START_DATE"])
+        efdt.date = date_to_datetime(row.START_DATE)
         observation.effectiveDateTime = efdt
         # code attribute
         codeableconcept = fhir_cod_concept_mod.CodeableConcept()
         coding = fhir_coding_mod.Coding()
         coding.system = "https://eds.chu-bordeaux.fr/fhir/bio-code"
-        coding.code = str(row["CONCEPT_CD"])
+        coding.code = str(row.CONCEPT_CD)
         coding.display = get_bio_result_label_from_concept_cd(coding.code)
         codeableconcept.coding = [coding]
         codeableconcept.text = coding.display
         observation.code = codeableconcept
         # valueQuantity attribute
         quantity = fhir_qty_mod.Quantity()
-        quantity.value = row["NVAL_NUM"]
-        quantity.unit = str(row["UNITS_CD"])  #.encode('ascii', 'ignore')
+        quantity.value = row.NVAL_NUM
+        quantity.unit = str(row.UNITS_CD)  #.encode('ascii', 'ignore')
         observation.valueQuantity = quantity
         # referenceRange attribute
         ref_range = ObservationReferenceRange()
-        ref_range.text = str(row["VALUEFLAG_CD"])
+        ref_range.text = str(row.VALUEFLAG_CD)
         observation.referenceRange = [ref_range]
         json_val = observation.as_json()
         # bug trouvé en testant   --> solved in fhirclient==4.0.0, not yet available on pip
         if 'encounter' not in json_val:
             json_val['encounter'] = ref_encounter.as_json()
-        df.append(json_val)
-
-    return df
+        yield json_val
 
 
 # entry point for PySpark application
@@ -3,10 +3,20 @@
 import fhirclient.models.patient as fhir_patient_mod
 import fhirclient.models.fhirdate as fhir_date_mod
 import fhirclient.models.identifier as fhir_id_mod
-from utils.db_connect import PostgresqlDB
+from utils.db_connect import PostgresqlDB, group_rows
 from utils.utils import date_to_datetime
 
 
+PostgresqlDB.register_statement(
+    'patient',
+    """SELECT "PATIENT_NUM", "SOURCESYSTEM_CD", "SEX_CD", "BIRTH_DATE", "DEATH_DATE"
+       FROM patient_dimension WHERE "PATIENT_NUM" = $1""")
+PostgresqlDB.register_statement(
+    'patients',
+    """SELECT "PATIENT_NUM", "SOURCESYSTEM_CD", "SEX_CD", "BIRTH_DATE", "DEATH_DATE"
+       FROM patient_dimension WHERE "PATIENT_NUM" = ANY($1::bigint[])""")
+
+
 def get_patient(patient_num):
     """
     search and process patient data for a given encounter
@@ -15,36 +25,57 @@ def get_patient(patient_num):
     :return: fhirclient.models.patient.Patient()
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data("""SELECT * FROM patient_dimension  WHERE  "PATIENT_NUM" = """ + patient_num)
-    if data.empty:
+    return _build_patient(connect_to_db.fetch_rows('patient', patient_num))
+
+
+def get_patients(patient_nums):
+    """
+    search and process patient data for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: fhirclient.models.patient.Patient()}, without the patients not found
+    """
+    rows = PostgresqlDB().fetch_rows('patients', list(patient_nums))
+    return {num: _build_patient(num_rows) for num, num_rows in group_rows(rows, 'PATIENT_NUM', []).items()}
+
+
+def _build_patient(rows):
+    """
+    builds a patient from fetched rows
+
+    :param rows: [namedtuple]
+    :return: fhirclient.models.patient.Patient()
+    """
+    if not rows:
         raise ValueError()
 
-    patient_data = data.iloc[0]
+    patient_data = rows[0]
     patient = fhir_patient_mod.Patient()
     # id attribute
-    patient.id = str(patient_data["PATIENT_NUM"]).replace(".0","")
+    patient.id = str(patient_data.PATIENT_NUM)
     # status attribute
     patient.status = "generated"
     # identifier attribute
     ident = fhir_id_mod.Identifier()
-    ident.system = patient_data["SOURCESYSTEM_CD"]
-    ident.value = str(patient_data["PATIENT_NUM"]).replace(".0", "")
+    ident.system = patient_data.SOURCESYSTEM_CD
+    ident.value = str(patient_data.PATIENT_NUM)
     patient.identifier = [ident]
     # gender attribute
-    if data["SEX_CD"].item() == 'DEM|SEX:F':
+    if patient_data.SEX_CD == 'DEM|SEX:F':
         patient.gender = 'female'
-    elif data["SEX_CD"].item() == 'DEM|SEX:M':
+    elif patient_data.SEX_CD == 'DEM|SEX:M':
         patient.gender = 'male'
     else :
         patient.gender = 'other'
     # birthdate attribute
     birthdate = fhir_date_mod.FHIRDate()
-    birthdate.date = date_to_datetime(patient_data["BIRTH_DATE"])
+    birthdate.date = date_to_datetime(patient_data.BIRTH_DATE)
     patient.birthDate = birthdate
     # deathdate attribute
-    deathdate = fhir_date_mod.FHIRDate()
-    deathdate.date = date_to_datetime(patient_data["DEATH_DATE"])
-    patient.deceasedDateTime = deathdate
+    if patient_data.DEATH_DATE is not None:
+        deathdate = fhir_date_mod.FHIRDate()
+        deathdate.date = date_to_datetime(patient_data.DEATH_DATE)
+        patient.deceasedDateTime = deathdate
 
     return patient.as_json()
 
@@ -5,31 +5,57 @@ import fhirclient.models.fhirdate as fhir_date_mod
 import fhirclient.models.procedure as fhir_procedure_mod
 import fhirclient.models.codeableconcept as fhir_cod_concept_mod
 import fhirclient.models.coding as fhir_coding_mod
-from functools import lru_cache
-from utils.db_connect import PostgresqlDB, SparqlDB
+from utils.db_connect import PostgresqlDB, SparqlDB, PAGE_GROUP, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
-
-
-@lru_cache()
-def _get_request_1():
+from utils.fhir_templates import iter_resources, fhir_datetime, make_coding
+
+
+# observation_fact columns used to build procedures
+PROC_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "START_DATE"'
+
+PostgresqlDB.register_statement(
+    'proc_for_patient',
+    f"""SELECT {PROC_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'TRACELINE' AND "PATIENT_NUM" = $1""",
+    page_group=PAGE_GROUP)
+PostgresqlDB.register_statement(
+    'proc_for_encounter',
+    f"""SELECT {PROC_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'TRACELINE' AND "ENCOUNTER_NUM" = $1""",
+    page_group=PAGE_GROUP)
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'proc_for_patients',
+    f"""SELECT {PROC_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'TRACELINE' AND "PATIENT_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'proc_for_encounters',
+    f"""SELECT {PROC_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'TRACELINE' AND "ENCOUNTER_NUM" = ANY($1::bigint[])""")
+
+
+@metadata(lazy_key='mdsLabel')
+def _get_request_1(values=''):
     """
     Get and cache metadata search linking bdd labels and mds labels
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-traceline#bloodDerivedDrug> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-traceline#bloodDerivedDrug> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                 ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?code .\
                                 ?code <http://www.w3.org/2004/02/skos/core#prefLabel> ?mdsLabel .\
                                 ?s <http://chu-bordeaux.fr/prescription-traceline#drugInDrugFamily> ?drugFamily .\
                                 ?drugFamily <http://www.w3.org/2004/02/skos/core#prefLabel> ?drugFamilyLabel}'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['mdsLabel']['value']] = (b['label']['value'],
-                                              (b['drugFamily']['value'], b['drugFamilyLabel']['value']))
+    for mds_label, label, drug_family, drug_family_label in server.load_rows(
+            query_diag, ['mdsLabel', 'label', 'drugFamily', 'drugFamilyLabel']):
+        hashed_map[mds_label] = (label, (drug_family, drug_family_label))
     return hashed_map
 
 
@@ -41,9 +67,9 @@ def get_prescription_bdd_label_from_mds_label(mds_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if mds_label in res:
-        return res[mds_label][0]
+    res = _get_request_1.lookup(mds_label)
+    if res is not None:
+        return res[0]
     return default_value
 
 
@@ -55,32 +81,32 @@ def get_drug_category_id_and_label_from_mds_label(mds_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_1()
-    if mds_label in res:
-        return res[mds_label][1]
+    res = _get_request_1.lookup(mds_label)
+    if res is not None:
+        return res[1]
     return default_value, default_value
 
 
-@lru_cache()
-def _get_request_2():
+@metadata(lazy_key='pslLabel')
+def _get_request_2(values=''):
     """
     Get and cache metadata search linking lbp labels and psl labels
 
+    :param values: VALUES clause restricting the query to some keys, see utils.metadata
     :return: pd.Frame
     """
     server = SparqlDB()
-    query_diag = 'SELECT * WHERE {  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-traceline#labileBloodProduct> .\
+    query_diag = 'SELECT * WHERE { ' + values + '  ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/prescription-traceline#labileBloodProduct> .\
                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                 ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?code .\
                                 ?code <http://www.w3.org/2004/02/skos/core#prefLabel> ?pslLabel .\
                                 ?s <http://chu-bordeaux.fr/prescription-traceline#drugInDrugFamily> ?drugFamily .\
                                 ?drugFamily <http://www.w3.org/2004/02/skos/core#prefLabel> ?drugFamilyLabel}'
-    res = server.load_data(query_diag)
     hashed_map = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['pslLabel']['value']] = (b['label']['value'],
-                                              (b['drugFamily']['value'], b['drugFamilyLabel']['value']))
+    for psl_label, label, drug_family, drug_family_label in server.load_rows(
+            query_diag, ['pslLabel', 'label', 'drugFamily', 'drugFamilyLabel']):
+        hashed_map[psl_label] = (label, (drug_family, drug_family_label))
     return hashed_map
 
 
@@ -92,9 +118,9 @@ def get_prescription_lbd_label_from_psl_label(psl_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_2()
-    if psl_label in res:
-        return res[psl_label][0]
+    res = _get_request_2.lookup(psl_label)
+    if res is not None:
+        return res[0]
     return default_value
 
 
@@ -106,50 +132,142 @@ def get_drug_category_id_and_label_from_psl_label(psl_label, default_value=""):
     :param default_value: value to return if not found
     :return: str
     """
-    res = _get_request_2()
-    if psl_label in res:
-        return res[psl_label][1]
+    res = _get_request_2.lookup(psl_label)
+    if res is not None:
+        return res[1]
     return default_value, default_value
 
 
-def get_proc_for_patient(patient_num):
+def get_proc_for_patient(patient_num, stream=False, page=None):
     """
     searches procedures for a given patient
 
     :param patient_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.procedure.Procedure() as json]
     """
-    return _process_proc_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='TRACELINE' AND "PATIENT_NUM" = """ + patient_num)
+    return _process_proc_request('proc_for_patient', patient_num, stream=stream, page=page)
 
 
-def get_proc_for_encounter(encounter_num):
+def get_proc_for_encounter(encounter_num, stream=False, page=None):
     """
     searches procedures for a given encounter
 
     :param encounter_num: str
+    :param stream: if True, returns a generator fed by a server-side cursor instead of a list
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.procedure.Procedure() as json]
     """
-    return _process_proc_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='TRACELINE' and  "ENCOUNTER_NUM" = """ + encounter_num)
+    return _process_proc_request('proc_for_encounter', encounter_num, stream=stream, page=page)
 
 
-def _process_proc_request(sql_statement):
+def _process_proc_request(statement_name, *params, stream=False, page=None):
     """
-    processes procedures for a sql_statement
+    processes procedures for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream: if True, rows are read through a server-side cursor and resources are yielded one by one
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.procedure.Procedure() as json]
     """
     connect_to_db = PostgresqlDB()
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return list(_iter_proc(rows)), next_key
+    if stream:
+        return _iter_proc(connect_to_db.iter_rows(statement_name, *params))
+    return list(_iter_proc(connect_to_db.fetch_rows(statement_name, *params)))
+
+
+def get_proc_for_patients(patient_nums):
+    """
+    searches procedures for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.procedure.Procedure() as json]}
+    """
+    return _process_proc_batch('proc_for_patients', 'PATIENT_NUM', patient_nums)
+
 
-    data = connect_to_db.load_data(sql_statement)
-    df = list()
-    for index, row in data.iterrows():
+def get_proc_for_encounters(encounter_nums):
+    """
+    searches procedures for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.procedure.Procedure() as json]}
+    """
+    return _process_proc_batch('proc_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_proc_batch(statement_name, column, nums):
+    """
+    processes procedures for a registered batch statement, grouped by patient or encounter
+
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.procedure.Procedure() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: list(_iter_proc(num_rows)) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _iter_proc(rows):
+    """
+    builds procedures from fetched rows, with the selected builders
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.procedure.Procedure() as json
+    """
+    return iter_resources(rows, _iter_proc_templates, _iter_proc_fhirclient)
+
+
+def _iter_proc_templates(rows):
+    """
+    builds procedures from fetched rows as json dicts, without the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.procedure.Procedure() as json
+    """
+    rows = _get_request_1.iter_prefetched(
+        rows, lambda row: None if "PSL" in str(row.CONCEPT_CD) else str(row.CONCEPT_CD))
+    rows = _get_request_2.iter_prefetched(
+        rows, lambda row: str(row.CONCEPT_CD) if "PSL" in str(row.CONCEPT_CD) else None)
+    for row in rows:
+        concept_cd = str(row.CONCEPT_CD)
+        if "PSL" in concept_cd:
+            category_code, category_display = get_drug_category_id_and_label_from_psl_label(concept_cd)
+            display = get_prescription_lbd_label_from_psl_label(concept_cd)
+        else:
+            category_code, category_display = get_drug_category_id_and_label_from_mds_label(concept_cd)
+            display = get_prescription_bdd_label_from_mds_label(concept_cd)
+        yield {
+            'resourceType': 'Procedure',
+            'identifier': [{'value': str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)}],
+            'status': 'completed',
+            'category': {'coding': [make_coding("https://eds.chu-bordeaux.fr/fhir/traceline-domain",
+                                                category_code, category_display)]},
+            'subject': {'reference': patient_num_to_ref(str(row.PATIENT_NUM))},
+            'encounter': {'reference': encounter_num_to_ref(str(row.ENCOUNTER_NUM))},
+            'performedDateTime': fhir_datetime(row.START_DATE),
+            'code': {'coding': [make_coding("https://eds.chu-bordeaux.fr/fhir/traceline-category", concept_cd, display)]},
+        }
+
+
+def _iter_proc_fhirclient(rows):
+    """
+    builds procedures from fetched rows through the fhirclient object model
+
+    :param rows: iterable of namedtuple
+    :return: generator of fhirclient.models.procedure.Procedure() as json
+    """
+    for row in rows:
         procedure = fhir_procedure_mod.Procedure()
         # identifier attribute
         ident = fhir_id_mod.Identifier()
-        ident.value = str(row["ENCOUNTER_NUM"]).replace(".0","") + "_" + str(row["INSTANCE_NUM"]).replace(".0","")
+        ident.value = str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)
         procedure.identifier = [ident]
         # status attribute
         procedure.status = "completed"
@@ -157,30 +275,30 @@ def _process_proc_request(sql_statement):
         cc_category = fhir_cod_concept_mod.CodeableConcept()
         coding_categ = fhir_coding_mod.Coding()
         coding_categ.system = "https://eds.chu-bordeaux.fr/fhir/traceline-domain"
-        if "PSL" in str(row["CONCEPT_CD"]):
-            coding_categ.code, coding_categ.display = get_drug_category_id_and_label_from_psl_label(str(row["CONCEPT_CD"]))
+        if "PSL" in str(row.CONCEPT_CD):
+            coding_categ.code, coding_categ.display = get_drug_category_id_and_label_from_psl_label(str(row.CONCEPT_CD))
         else:
-            coding_categ.code, coding_categ.display = get_drug_category_id_and_label_from_mds_label(str(row["CONCEPT_CD"]))
+            coding_categ.code, coding_categ.display = get_drug_category_id_and_label_from_mds_label(str(row.CONCEPT_CD))
         cc_category.coding = [coding_categ]
         procedure.category = cc_category
         # subject attribute
         ref_subject = fhir_ref_mod.FHIRReference()
-        ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0",""))
+        ref_subject.reference = patient_num_to_ref(str(row.PATIENT_NUM))
         procedure.subject = ref_subject
         # encounter attribute
         ref_encounter = fhir_ref_mod.FHIRReference()
-        ref_encounter.reference = encounter_num_to_ref(str(row["ENCOUNTER_NUM"]).replace(".0",""))
+        ref_encounter.reference = encounter_num_to_ref(str(row.ENCOUNTER_NUM))
         procedure.encounter = ref_encounter
         # performedDateTime attribute
         efdt = fhir_date_mod.FHIRDate()
-        efdt.date = date_to_datetime(row["START_DATE"])
+        efdt.date = date_to_datetime(row.START_DATE)
         procedure.performedDateTime  = efdt
         # code attribute
         codeableconcept = fhir_cod_concept_mod.CodeableConcept()
         coding = fhir_coding_mod.Coding()
         coding.system = "https://eds.chu-bordeaux.fr/fhir/traceline-category"
-        coding.code = str(row["CONCEPT_CD"])
-        if "PSL" in str(row["CONCEPT_CD"]):
+        coding.code = str(row.CONCEPT_CD)
+        if "PSL" in str(row.CONCEPT_CD):
             coding.display = get_prescription_lbd_label_from_psl_label(coding.code)
         else:
             coding.display = get_prescription_bdd_label_from_mds_label(coding.code)
@@ -191,9 +309,7 @@ def _process_proc_request(sql_statement):
         # bug trouvé en testant   --> solved in fhirclient==4.0.0, not yet available on pip
         if 'encounter' not in json_val:
             json_val['encounter'] = ref_encounter.as_json()
-        df.append(json_val)
-
-    return df
+        yield json_val
 
 
 # entry point for PySpark application
@@ -5,18 +5,47 @@ import fhirclient.models.fhirdate as fhir_date_mod
 import fhirclient.models.identifier as fhir_id_mod
 import fhirclient.models.fhirreference as fhir_ref_mod
 import fhirclient.models.coding as fhir_coding_mod
-from functools import lru_cache
+from collections import namedtuple
+from itertools import chain
+from types import MappingProxyType
 import logging
 
-from utils.db_connect import PostgresqlDB,SparqlDB
+from utils.db_connect import PostgresqlDB,SparqlDB, group_rows
+from utils.metadata import metadata
 from utils.utils import date_to_datetime, patient_num_to_ref, encounter_num_to_ref
 
 
+# observation_fact columns used to build questionnaire responses
+QUEST_COLUMNS = '"PATIENT_NUM", "ENCOUNTER_NUM", "INSTANCE_NUM", "CONCEPT_CD", "START_DATE", "VALTYPE_CD", ' \
+                '"NVAL_NUM", "OBSERVATION_BLOB"'
+
+PostgresqlDB.register_statement(
+    'quest_for_patient',
+    f"""SELECT {QUEST_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'CHU_BORDEAUX_QUESTIONNAIRES_DXC' AND "PATIENT_NUM" = $1""",
+    page_group=('"ENCOUNTER_NUM"', '"INSTANCE_NUM"'))
+PostgresqlDB.register_statement(
+    'quest_for_encounter',
+    f"""SELECT {QUEST_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'CHU_BORDEAUX_QUESTIONNAIRES_DXC' AND "ENCOUNTER_NUM" = $1""",
+    page_group=('"ENCOUNTER_NUM"', '"INSTANCE_NUM"'))
+
+# batch variants, for several patients or encounters at once
+PostgresqlDB.register_statement(
+    'quest_for_patients',
+    f"""SELECT {QUEST_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'CHU_BORDEAUX_QUESTIONNAIRES_DXC' AND "PATIENT_NUM" = ANY($1::bigint[])""")
+PostgresqlDB.register_statement(
+    'quest_for_encounters',
+    f"""SELECT {QUEST_COLUMNS} FROM observation_fact
+        WHERE "SOURCESYSTEM_CD" = 'CHU_BORDEAUX_QUESTIONNAIRES_DXC' AND "ENCOUNTER_NUM" = ANY($1::bigint[])""")
+
+
 ########################
 # Questions - Réponses #
 ########################
 
-@lru_cache()
+@metadata
 def _get_request_1():
     """
     Get and cache metadata search linking question labels and text
@@ -28,12 +57,11 @@ def _get_request_1():
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?question .\
                                 ?question <http://www.w3.org/2004/02/skos/core#prefLabel> ?questionLabel }'
     
-    res = server.load_data(query_diag)
     hashed_map = {}
     hashed_map_rev = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['questionLabel']['value']] = b['s']['value']
-        hashed_map_rev[b['s']['value']] = b['questionLabel']['value']
+    for s, question_label in server.load_rows(query_diag, ['s', 'questionLabel']):
+        hashed_map[question_label] = s
+        hashed_map_rev[s] = question_label
     return hashed_map, hashed_map_rev
 
 
@@ -65,7 +93,7 @@ def get_questionlabel_by_question_id(question_id, default_value=""):
     return default_value
 
 
-@lru_cache()
+@metadata
 def _get_request_2():
     """
     Get and cache metadata search linking responses label and text
@@ -77,12 +105,11 @@ def _get_request_2():
                                 ?s <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#isComponentOf> ?n .\
                                 ?n <http://chu-bordeaux.fr/m2sitis/iso11179-3/mdr.owl#hasTarget> ?code .\
                                 ?code <http://www.w3.org/2004/02/skos/core#prefLabel> ?responseLabel }'
-    res = server.load_data(query_diag)
     hashed_map = {}
     hashed_map_rev = {}
-    for b in res['results']['bindings']:
-        hashed_map[b['responseLabel']['value']] = b['s']['value']
-        hashed_map_rev[b['s']['value']] = b['responseLabel']['value']
+    for s, response_label in server.load_rows(query_diag, ['s', 'responseLabel']):
+        hashed_map[response_label] = s
+        hashed_map_rev[s] = response_label
     return hashed_map, hashed_map_rev
 
 
@@ -114,7 +141,7 @@ def get_responselabel_by_responseid(response_id, default_value=""):
     return default_value
 
 
-@lru_cache()
+@metadata
 def _get_request_3():
     """
     Get and cache metadata search linking responses and questions
@@ -129,17 +156,17 @@ def _get_request_3():
                                  ?question <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/questionnaire-dxcare#question> .\
                                  ?question <http://www.w3.org/2004/02/skos/core#prefLabel> ?questionLabel }"
 
-    qr = server.load_data(qr_query)
+    qr = server.load_rows(qr_query, ['question', 'questionLabel', 'reponse', 'reponseLabel'])
 
     # le résultat est une liste de tuples
     # chaque tuple est de la forme (question_id, question_label, reponse_id, reponse_label)
     questions_labels = {}
     reponses_label = {}
     reponse_to_question_link = {}
-    for b in qr['results']['bindings']:
-        questions_labels[b['question']['value']] = b['questionLabel']['value']
-        reponses_label[b['reponse']['value']] = b['reponseLabel']['value']
-        reponse_to_question_link[b['reponse']['value']] = b['question']['value']
+    for question, question_label, reponse, reponse_label in qr:
+        questions_labels[question] = question_label
+        reponses_label[reponse] = reponse_label
+        reponse_to_question_link[reponse] = question
     return questions_labels, reponses_label, reponse_to_question_link
 
 
@@ -185,7 +212,7 @@ def get_questionid_from_responseid(response_label, default_value=""):
     return default_value
 
 
-@lru_cache()
+@metadata
 def _get_request_4():
     """
     Get and cache metadata search for questionnaire structure
@@ -206,58 +233,65 @@ def _get_request_4():
                                             ?question <http://www.w3.org/2004/02/skos/core#prefLabel> ?questionLabel .\
                                             ?question <http://chu-bordeaux.fr/questionnaire-dxcare#questionInSection> ?section .\
                                             ?section <http://www.w3.org/2004/02/skos/core#prefLabel> ?sectionLabel}"
-    res = server.load_data(question_in_section)
-    for b in res['results']['bindings']:
-        question_labels[b['question']['value']] = b['questionLabel']['value']
-        question_to_section_links[b['question']['value']] = b['section']['value']
-        section_labels[b['section']['value']] = b['sectionLabel']['value']
+    for question, question_label, section, section_label in server.load_rows(
+            question_in_section, ['question', 'questionLabel', 'section', 'sectionLabel']):
+        question_labels[question] = question_label
+        question_to_section_links[question] = section
+        section_labels[section] = section_label
 
     section_in_section = "SELECT * WHERE {  ?section <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/questionnaire-dxcare#section> .\
                                             ?section <http://www.w3.org/2004/02/skos/core#prefLabel> ?sectionLabel1 .\
                                             ?section <http://chu-bordeaux.fr/questionnaire-dxcare#sectionInSection> ?section2 .\
                                             ?section2 <http://www.w3.org/2004/02/skos/core#prefLabel> ?sectionLabel2}"
-    res = server.load_data(section_in_section)
-    for b in res['results']['bindings']:
-        section_labels[b['section']['value']] = b['sectionLabel1']['value']
-        section_labels[b['section2']['value']] = b['sectionLabel2']['value']
-        section_to_section_links[b['section']['value']] = b['section2']['value']
+    for section, section_label1, section2, section_label2 in server.load_rows(
+            section_in_section, ['section', 'sectionLabel1', 'section2', 'sectionLabel2']):
+        section_labels[section] = section_label1
+        section_labels[section2] = section_label2
+        section_to_section_links[section] = section2
 
     section_in_page = "SELECT * WHERE {  ?section <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/questionnaire-dxcare#section> .\
                                         ?section <http://www.w3.org/2004/02/skos/core#prefLabel> ?sectionLabel .\
                                         ?section <http://chu-bordeaux.fr/questionnaire-dxcare#sectionInPage> ?page .\
                                         ?page <http://www.w3.org/2004/02/skos/core#prefLabel> ?pageLabel}"
-    res = server.load_data(section_in_page)
-    for b in res['results']['bindings']:
-        section_labels[b['section']['value']] = b['sectionLabel']['value']
-        page_labels[b['page']['value']] = b['pageLabel']['value']
-        section_to_page_links[b['section']['value']] = b['page']['value']
+    for section, section_label, page, page_label in server.load_rows(
+            section_in_page, ['section', 'sectionLabel', 'page', 'pageLabel']):
+        section_labels[section] = section_label
+        page_labels[page] = page_label
+        section_to_page_links[section] = page
 
     question_in_page = "SELECT * WHERE {  ?question <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/questionnaire-dxcare#question> .\
                                             ?question <http://www.w3.org/2004/02/skos/core#prefLabel> ?questionLabel .\
                                             ?question <http://chu-bordeaux.fr/questionnaire-dxcare#questionInPage> ?page .\
                                             ?page <http://www.w3.org/2004/02/skos/core#prefLabel> ?pageLabel}"
-    res = server.load_data(question_in_page)
-    for b in res['results']['bindings']:
-        question_labels[b['question']['value']] = b['questionLabel']['value']
-        question_to_page_links[b['question']['value']] = b['page']['value']
-        page_labels[b['page']['value']] = b['pageLabel']['value']
+    for question, question_label, page, page_label in server.load_rows(
+            question_in_page, ['question', 'questionLabel', 'page', 'pageLabel']):
+        question_labels[question] = question_label
+        question_to_page_links[question] = page
+        page_labels[page] = page_label
 
     page_in_form = "SELECT * WHERE {  ?page <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://chu-bordeaux.fr/questionnaire-dxcare#page> .\
                                         ?page <http://www.w3.org/2004/02/skos/core#prefLabel> ?pageLabel .\
                                         ?page <http://chu-bordeaux.fr/questionnaire-dxcare#pageInForm> ?form .\
                                         ?form <http://www.w3.org/2004/02/skos/core#prefLabel> ?formLabel}"
-    res = server.load_data(page_in_form)
-    for b in res['results']['bindings']:
-        page_labels[b['page']['value']] = b['pageLabel']['value']
-        form_labels[b['form']['value']] = b['formLabel']['value']
-        page_to_form_links[b['page']['value']] = b['form']['value']
+    for page, page_label, form, form_label in server.load_rows(
+            page_in_form, ['page', 'pageLabel', 'form', 'formLabel']):
+        page_labels[page] = page_label
+        form_labels[form] = form_label
+        page_to_form_links[page] = form
 
     return (question_labels, section_labels, page_labels, form_labels), \
             (question_to_section_links, section_to_section_links, section_to_page_links, question_to_page_links, page_to_form_links)
 
 
-def get_question_to_form_links(question):
-    _, (question_to_section_links, section_to_section_links, section_to_page_links, question_to_page_links, page_to_form_links) = _get_request_4()
+def _question_to_form_links(question, links):
+    """
+    walks the links of _get_request_4() from a question up to its form
+
+    :param question: str, question id
+    :param links: links returned by _get_request_4()
+    :return: [question, section..., page, form]
+    """
+    question_to_section_links, section_to_section_links, section_to_page_links, question_to_page_links, page_to_form_links = links
     link = [question]
     if question in question_to_section_links:
         link.append(question_to_section_links[question])
@@ -276,86 +310,154 @@ def get_question_to_form_links(question):
     return link
 
 
-def add_questionid_to_questionnaire(question_id, questionlabel, questionnaire):
-    (question_labels, section_labels, page_labels, form_labels), _ = _get_request_4()
-    descending_links = list(reversed(get_question_to_form_links(question_id)))
+# path of a question in the questionnaire structure, from its form:
+# links = (form, page, section..., question), texts = their labels
+QuestionPath = namedtuple('QuestionPath', ['links', 'texts'])
 
-    items_idxs = []
-    # form
-    forms = [elt.linkId for elt in questionnaire.item]
-    if descending_links[0] in forms:
-        form_idx = forms.index(descending_links[0])
-    else:
-        quest_item = fhir_quest_mod.QuestionnaireResponseItem()
-        quest_item.linkId = descending_links[0]
-        quest_item.text = form_labels[descending_links[0]]
-        quest_item.item = []
-        questionnaire.item.append(quest_item)
-        form_idx = len(questionnaire.item) - 1
-    items_idxs.append(form_idx)
-
-    # page
-    pages = [elt.linkId for elt in questionnaire.item[form_idx].item]
-    if descending_links[1] in pages:
-        page_idx = pages.index(descending_links[1])
-    else:
-        quest_item = fhir_quest_mod.QuestionnaireResponseItem()
-        quest_item.linkId = descending_links[1]
-        quest_item.text = page_labels[descending_links[1]]
-        quest_item.item = []
-        questionnaire.item[form_idx].item.append(quest_item)
-        page_idx = len(questionnaire.item[form_idx].item) - 1
-    items_idxs.append(page_idx)
-
-    # sections
-    start_item = questionnaire.item[form_idx].item[page_idx]
-    for i in range(2, len(descending_links)-1):
-        sections = [elt.linkId for elt in start_item.item]
-        if descending_links[i] in sections:
-            section_idx = sections.index(descending_links[i])
-        else:
-            quest_item = fhir_quest_mod.QuestionnaireResponseItem()
-            quest_item.linkId = descending_links[i]
-            quest_item.text = section_labels[descending_links[i]]
-            quest_item.item = []
-            start_item.item.append(quest_item)
-            section_idx = len(start_item.item) - 1
-        start_item = start_item.item[section_idx]
-        items_idxs.append(section_idx)
-
-    # question
-    if not questionlabel:
-        questionlabel = get_questionlabel_by_question_id(descending_links[-1])
-    questions = [elt.linkId for elt in start_item.item]
-    if descending_links[-1] in questions:
-        question_idx = questions.index(descending_links[-1])
-        if not start_item.item[question_idx].definition:
-            start_item.item[question_idx].definition = questionlabel
-    else:
+
+def build_structure_index(structure):
+    """
+    compiles the questionnaire structure returned by _get_request_4() into an index of the question paths,
+    questions with broken links being logged once
+
+    :param structure: (labels, links) as returned by _get_request_4()
+    :return: ({question id: QuestionPath}, {question id: error message}), read-only
+    """
+    (question_labels, section_labels, page_labels, form_labels), links = structure
+    question_to_section_links, _, _, question_to_page_links, _ = links
+    paths = {}
+    broken = {}
+    # the strings of the compact maps are decoded at each access: the forms, pages and sections common to several
+    # questions are stored once
+    shared = {}
+    for question in dict.fromkeys(chain(question_to_section_links, question_to_page_links)):
+        try:
+            descending_links = tuple(shared.setdefault(link, link)
+                                     for link in reversed(_question_to_form_links(question, links)))
+            texts = (form_labels[descending_links[0]], page_labels[descending_links[1]]) + \
+                tuple(section_labels[section] for section in descending_links[2:-1]) + \
+                (question_labels[question],)
+            texts = tuple(shared.setdefault(text, text) for text in texts)
+        except ValueError as e:
+            broken[question] = str(e)
+            continue
+        except KeyError as e:
+            broken[question] = f'label not found for {e.args[0]}'
+            continue
+        paths[question] = QuestionPath(descending_links, texts)
+    if broken:
+        logging.getLogger('questionnaireResponse').warning(
+            f'{len(broken)} questions not placed in a form: ' +
+            ', '.join(f'{question} ({error})' for question, error in broken.items()))
+    return MappingProxyType(paths), MappingProxyType(broken)
+
+
+@metadata(derived=True)
+def _get_structure_index():
+    """
+    Get and cache the compiled questionnaire structure, see build_structure_index
+
+    :return: ({question id: QuestionPath}, {question id: error message})
+    """
+    return build_structure_index(_get_request_4())
+
+
+def get_question_path(question_id):
+    """
+    look for the path of a question via _get_structure_index()
+
+    :param question_id: str
+    :return: QuestionPath, None if the question has a broken link, already logged by build_structure_index
+    :raise ValueError: if the question is unknown
+    """
+    paths, broken = _get_structure_index()
+    if question_id in paths:
+        return paths[question_id]
+    if question_id in broken:
+        return None
+    raise ValueError(f'section or page not found for question {question_id}')
+
+
+class QuestionnaireTree:
+    """
+    Items of a QuestionnaireResponse, indexed by linkId at each level (forms, pages, sections, questions)
+    """
+
+    def __init__(self, questionnaire):
+        """
+        :param questionnaire: fhirclient.models.questionnaireresponse.QuestionnaireResponse, with an empty item list
+        """
+        self.questionnaire = questionnaire
+        # {linkId: (item, {linkId: (item, ...)})}
+        self._nodes = {}
+
+    @staticmethod
+    def _new_item(link_id, text):
         quest_item = fhir_quest_mod.QuestionnaireResponseItem()
-        quest_item.definition = questionlabel
-        quest_item.linkId = question_id
-        quest_item.text = question_labels[descending_links[-1]]
+        quest_item.linkId = link_id
+        quest_item.text = text
         quest_item.item = []
-        start_item.item.append(quest_item)
-        question_idx = len(start_item.item) - 1
-    items_idxs.append(question_idx)
-
-    return items_idxs
+        return quest_item
+
+    def get_question_item(self, question_id, questionlabel):
+        """
+        Get the item of a question, adding it with its form, page and sections if needed
+
+        :param question_id: str
+        :param questionlabel: str, definition of the question, looked for if empty
+        :return: fhirclient.models.questionnaireresponse.QuestionnaireResponseItem, None if the question has a broken
+            link
+        """
+        path = get_question_path(question_id)
+        if path is None:
+            return None
+        descending_links, texts = path
+
+        parent, nodes = self.questionnaire, self._nodes
+        for link_id, text in zip(descending_links[:-1], texts):
+            node = nodes.get(link_id)
+            if node is None:
+                quest_item = self._new_item(link_id, text)
+                parent.item.append(quest_item)
+                node = nodes[link_id] = (quest_item, {})
+            parent, nodes = node
+
+        # question
+        if not questionlabel:
+            questionlabel = get_questionlabel_by_question_id(descending_links[-1])
+        node = nodes.get(descending_links[-1])
+        if node is None:
+            quest_item = self._new_item(question_id, texts[-1])
+            quest_item.definition = questionlabel
+            parent.item.append(quest_item)
+            node = nodes[descending_links[-1]] = (quest_item, {})
+        elif not node[0].definition:
+            node[0].definition = questionlabel
+        return node[0]
+
+
+def add_questionid_to_questionnaire(question_id, questionlabel, tree):
+    """
+    :param question_id: str
+    :param questionlabel: str
+    :param tree: QuestionnaireTree
+    :return: fhirclient.models.questionnaireresponse.QuestionnaireResponseItem of the question, None if it has a
+        broken link
+    """
+    return tree.get_question_item(question_id, questionlabel)
 
 
-def add_questionlabel_to_questionnaire(questionlabel, questionnaire):
+def add_questionlabel_to_questionnaire(questionlabel, tree):
     question_id = get_question_id_by_questionlabel(questionlabel)
-    return add_questionid_to_questionnaire(question_id, questionlabel, questionnaire)
+    return add_questionid_to_questionnaire(question_id, questionlabel, tree)
 
 
-def add_responselabel_to_questionnaire(responselabel, val_type, val, questionnaire):
+def add_responselabel_to_questionnaire(responselabel, val_type, val, tree):
     response_id = get_response_id_by_responselabel(responselabel)
     question_id = get_questionid_from_responseid(response_id)
-    items_idx = add_questionid_to_questionnaire(question_id, "", questionnaire)
-    start_item = questionnaire
-    for idx in items_idx:
-        start_item = start_item.item[idx]
+    start_item = add_questionid_to_questionnaire(question_id, "", tree)
+    if start_item is None:
+        return
 
     answer_item = fhir_quest_mod.QuestionnaireResponseItemAnswer()
     coding = fhir_coding_mod.Coding()
@@ -372,81 +474,129 @@ def add_responselabel_to_questionnaire(responselabel, val_type, val, questionnai
     start_item.answer.append(answer_item)
 
 
-def get_quest_for_patient(patient_num):
+def get_quest_for_patient(patient_num, page=None):
     """
     searches questionnaire responses for a given patient
 
     :param patient_num: str
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]
     """
-    return _process_quest_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='CHU_BORDEAUX_QUESTIONNAIRES_DXC' AND "PATIENT_NUM" = """ + patient_num)
+    return _process_quest_request('quest_for_patient', patient_num, page=page)
 
 
-def get_quest_for_encounter(encounter_num):
+def get_quest_for_encounter(encounter_num, page=None):
     """
     searches questionnaire responses for a given encounter
 
     :param encounter_num: str
+    :param page: (count, page key), if given returns a page of resources and the key of the next page
     :return: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]
     """
-    return _process_quest_request(
-        """SELECT * FROM observation_fact WHERE "SOURCESYSTEM_CD" ='CHU_BORDEAUX_QUESTIONNAIRES_DXC' and  "ENCOUNTER_NUM" = """ + encounter_num)
+    return _process_quest_request('quest_for_encounter', encounter_num, page=page)
 
 
-def _process_quest_request(sql_statement):
+def _process_quest_request(statement_name, *params, page=None):
     """
-    processes questionnaire responses for a sql_statement
+    processes questionnaire responses for a registered statement
 
-    :param sql_statement: search statement
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param page: (count, page key), if given only a page of resources is processed, see PostgresqlDbInit.fetch_page
     :return: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]
     """
     connect_to_db = PostgresqlDB()
-    data = connect_to_db.load_data(sql_statement)
+    if page is not None:
+        rows, next_key = connect_to_db.fetch_page(statement_name, page, *params)
+        return _build_quest(rows), next_key
+    return _build_quest(connect_to_db.fetch_rows(statement_name, *params))
+
+
+def get_quest_for_patients(patient_nums):
+    """
+    searches questionnaire responses for several patients at once
+
+    :param patient_nums: [int]
+    :return: {patient_num: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]}
+    """
+    return _process_quest_batch('quest_for_patients', 'PATIENT_NUM', patient_nums)
+
+
+def get_quest_for_encounters(encounter_nums):
+    """
+    searches questionnaire responses for several encounters at once
+
+    :param encounter_nums: [int]
+    :return: {encounter_num: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]}
+    """
+    return _process_quest_batch('quest_for_encounters', 'ENCOUNTER_NUM', encounter_nums)
+
+
+def _process_quest_batch(statement_name, column, nums):
+    """
+    processes questionnaire responses for a registered batch statement, grouped by patient or encounter
+
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]}
+    """
+    rows = PostgresqlDB().fetch_rows(statement_name, list(nums))
+    return {num: _build_quest(num_rows) for num, num_rows in group_rows(rows, column, nums).items()}
+
+
+def _build_quest(rows):
+    """
+    builds questionnaire responses from fetched rows
+
+    :param rows: iterable of namedtuple
+    :return: [fhirclient.models.questionnaireresponse.QuestionnaireResponse() as json]
+    """
     questionnaires = {}
     df = list()
-    for index, row in data.iterrows():
-        q_id = str(row["ENCOUNTER_NUM"]).replace(".0","") + "_" + str(row["INSTANCE_NUM"]).replace(".0","")
+    for row in rows:
+        q_id = str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)
         if q_id not in questionnaires:
             questionnaireResponse = fhir_quest_mod.QuestionnaireResponse()
             # identifier attribute
             ident = fhir_id_mod.Identifier()
-            ident.value = str(row["ENCOUNTER_NUM"]).replace(".0","") + "_" + str(row["INSTANCE_NUM"]).replace(".0","")
+            ident.value = str(row.ENCOUNTER_NUM) + "_" + str(row.INSTANCE_NUM)
             questionnaireResponse.identifier = ident
             # status attribute
             questionnaireResponse.status = "completed"
             # subject attribute
             ref_subject = fhir_ref_mod.FHIRReference()
-            ref_subject.reference = patient_num_to_ref(str(row["PATIENT_NUM"]).replace(".0",""))
+            ref_subject.reference = patient_num_to_ref(str(row.PATIENT_NUM))
             questionnaireResponse.subject = ref_subject
             # encounter attribute
             ref_encounter = fhir_ref_mod.FHIRReference()
-            ref_encounter.reference = encounter_num_to_ref(str(row["ENCOUNTER_NUM"]).replace(".0",""))
+            ref_encounter.reference = encounter_num_to_ref(str(row.ENCOUNTER_NUM))
             questionnaireResponse.encounter = ref_encounter
             # authored attribute
             efdt = fhir_date_mod.FHIRDate()
-            efdt.date = date_to_datetime(row["START_DATE"])
+            efdt.date = date_to_datetime(row.START_DATE)
             questionnaireResponse.authored = efdt
             #items
             questionnaireResponse.item = []
-            questionnaires[q_id] = questionnaireResponse
+            questionnaires[q_id] = QuestionnaireTree(questionnaireResponse)
 
         try:
             qr = questionnaires[q_id]
-            if "QUESTION" in str(row["CONCEPT_CD"]):
-                add_questionlabel_to_questionnaire(str(row["CONCEPT_CD"]), qr)
-            if "REPONSE" in str(row["CONCEPT_CD"]):
+            if "QUESTION" in str(row.CONCEPT_CD):
+                add_questionlabel_to_questionnaire(str(row.CONCEPT_CD), qr)
+            if "REPONSE" in str(row.CONCEPT_CD):
                 val = ""
-                if row['VALTYPE_CD'] == "N":
-                    val = row["NVAL_NUM"]
-                elif row['VALTYPE_CD'] == "T":
-                    val = str(row["OBSERVATION_BLOB"])  # .encode('ascii', 'ignore'))
-                add_responselabel_to_questionnaire(str(row["CONCEPT_CD"]), row['VALTYPE_CD'], val, qr)
+                if row.VALTYPE_CD == "N":
+                    val = row.NVAL_NUM
+                elif row.VALTYPE_CD == "T":
+                    val = str(row.OBSERVATION_BLOB)  # .encode('ascii', 'ignore'))
+                add_responselabel_to_questionnaire(str(row.CONCEPT_CD), row.VALTYPE_CD, val, qr)
         except ValueError as e:
-            logging.getLogger('questionnaireResponse').warning(f'Could not place {str(row["CONCEPT_CD"])}: {e}')
+            logging.getLogger('questionnaireResponse').warning(f'Could not place {str(row.CONCEPT_CD)}: {e}')
             continue
 
-    for qr in questionnaires.values():
+    for tree in questionnaires.values():
+        qr = tree.questionnaire
         json_val = qr.as_json()
         # bug trouvé en testant   --> solved in fhirclient==4.0.0, not yet available on pip
         if 'encounter' not in json_val:
@@ -0,0 +1,83 @@
+"""
+Benchmark of the questionnaire structure lookups: on demand traversal of the links vs compiled index
+
+Run from src:
+
+        python3 -m tests.bench_questionnaire [nb answers]
+"""
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import random
+from time import perf_counter
+
+from questionnaireResponse import _question_to_form_links, build_structure_index
+
+
+def make_structure(nb_forms=50, nb_pages=10, nb_sections=10, depth=3, nb_questions=5):
+    """
+    synthetic questionnaire structure, as returned by _get_request_4()
+
+    :return: (labels, links), questions ids
+    """
+    question_labels, section_labels, page_labels, form_labels = {}, {}, {}, {}
+    question_to_section_links, section_to_section_links, section_to_page_links = {}, {}, {}
+    question_to_page_links, page_to_form_links = {}, {}
+    for f in range(nb_forms):
+        form = f'form_{f}'
+        form_labels[form] = f'Form {f}'
+        for p in range(nb_pages):
+            page = f'{form}_page_{p}'
+            page_labels[page] = f'Page {p}'
+            page_to_form_links[page] = form
+            question = f'{page}_question'
+            question_labels[question] = 'Question'
+            question_to_page_links[question] = page
+            for s in range(nb_sections):
+                parent = None
+                for d in range(depth):
+                    section = f'{page}_section_{s}_{d}'
+                    section_labels[section] = f'Section {s}.{d}'
+                    if parent is None:
+                        section_to_page_links[section] = page
+                    else:
+                        section_to_section_links[section] = parent
+                    parent = section
+                for q in range(nb_questions):
+                    question = f'{parent}_question_{q}'
+                    question_labels[question] = f'Question {q}'
+                    question_to_section_links[question] = parent
+    structure = ((question_labels, section_labels, page_labels, form_labels),
+                 (question_to_section_links, section_to_section_links, section_to_page_links, question_to_page_links,
+                  page_to_form_links))
+    return structure, list(question_labels)
+
+
+def on_demand(structure, answers):
+    """path and labels of each answer, the links being walked for each of them"""
+    (question_labels, section_labels, page_labels, form_labels), links = structure
+    for question in answers:
+        descending_links = list(reversed(_question_to_form_links(question, links)))
+        form_labels[descending_links[0]], page_labels[descending_links[1]]
+        [section_labels[section] for section in descending_links[2:-1]]
+        question_labels[descending_links[-1]]
+
+
+def indexed(structure, answers):
+    """path and labels of each answer, from the index compiled once"""
+    paths, _ = build_structure_index(structure)
+    for question in answers:
+        paths[question]
+
+
+if __name__ == '__main__':
+    nb_answers = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    structure, questions = make_structure()
+    answers = random.Random(0).choices(questions, k=nb_answers)
+    print(f'{len(questions)} questions, {nb_answers} answers')
+    for name, func in [('on demand', on_demand), ('indexed', indexed)]:
+        start = perf_counter()
+        func(structure, answers)
+        print(f'{name:>10}: {perf_counter() - start:.3f}s')
+    start = perf_counter()
+    build_structure_index(structure)
+    print(f'{"index":>10}: {perf_counter() - start:.3f}s to compile')
@@ -0,0 +1,77 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import requests
+from pprint import pprint
+
+from .utils_test import get_test_client
+from src import web
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def _post_route(self, api_path, body):
+        if self.docker_adress is not None:
+            res = requests.post(f'http://{self.docker_adress}{api_path}', json=body)
+            if res.status_code != 400:
+                res.json = res.json()
+            return res
+        else:
+            return self.app.post(api_path, json=body)
+
+    def test_ressource_ok(self):
+        # When
+        for ressource in ['labResults', 'clinicalReports', 'medicationAdministrations', 'procedures', 'pmsis',
+                          'questionnaireResponses', 'bacteriology']:
+            for kind, nums in [('patients', [1, 2]), ('encounters', [22, '23'])]:
+                response = self._post_route(f'/{ressource}/_batch', {kind: nums})
+                if self.verbose:
+                    pprint(response.json)
+
+                # Then: same resources as the route of each id
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(sorted(str(num) for num in nums), sorted(response.json))
+                for num in nums:
+                    expected = self._get_route(f'/{kind}/{num}/{ressource}').json
+                    self.assertEqual(sorted(expected, key=str), sorted(response.json[str(num)], key=str))
+
+        response = self._post_route('/patients/_batch', {'patients': [1, 999999]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'1': self._get_route('/patients/1').json}, response.json)
+
+        response = self._post_route('/encounters/_batch', {'encounters': [22, 999999]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['22'], list(response.json))
+        # the order of the locations is the one of the join, which may differ between the two statements
+        expected = self._get_route('/encounters/22').json
+        for res in [expected, response.json['22']]:
+            res['location'] = sorted(res['location'], key=str)
+        self.assertEqual(expected, response.json['22'])
+
+    def test_ressource_failure(self):
+        # When
+        for body in [{'patients': ['test']}, {'patients': 1}, {'visits': [1]}, {'patients': [1], 'encounters': [1]},
+                     [1], None]:
+            response = self._post_route('/labResults/_batch', body)
+            self.assertEqual(400, response.status_code)
+
+        response = self._post_route('/patients/_batch', {'encounters': [22]})
+        self.assertEqual(400, response.status_code)
+
+    # def tearDown(self):
+    #     pass
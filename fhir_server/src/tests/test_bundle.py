@@ -6,8 +6,10 @@ import requests
 from datetime import datetime
 from pprint import pprint
 
-from .utils_test import datetime_fromisoformat
+from .utils_test import datetime_fromisoformat, get_test_client
 from src import web
+# same module as the one used by the app, for its database connection
+from utils.db_connect import PostgresqlDbInit
 
 
 class BacterioTest(unittest.TestCase):
@@ -16,7 +18,7 @@ class BacterioTest(unittest.TestCase):
         self.app = None
         self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
         if self.docker_adress is None:
-            self.app = web.app.test_client()
+            self.app = get_test_client(self)
         self.verbose = os.environ.get('TEST_VERBOSE', False)
 
     def _get_route(self, api_path):
@@ -129,5 +131,44 @@ class BacterioTest(unittest.TestCase):
         response = self._get_route('/encounters//bacteriology')
         self.assertEqual(404, response.status_code)
 
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS') or os.environ.get('TEST_ASGI'),
+                     'counts the queries of the in-process flask app')
+    def test_queries(self):
+        # the results of all the researches are fetched by a single query
+        executed = []
+        execute_statement = PostgresqlDbInit._execute_statement
+
+        def _execute_statement(db, connection, cursor, name, params):
+            executed.append(name)
+            return execute_statement(db, connection, cursor, name, params)
+
+        PostgresqlDbInit._execute_statement = _execute_statement
+        try:
+            for api_path, statement in [('/patients/1/bacteriology', 'synergy_for_patient'),
+                                        ('/encounters/22/bacteriology', 'synergy_for_encounter')]:
+                executed.clear()
+                # query parameter not used by the route, so that the response is not taken from the cache
+                response = self._get_route(f'{api_path}?_nocache={datetime.now().timestamp()}')
+                self.assertEqual(200, response.status_code)
+                self.assertGreater(len(response.json), 0)
+                self.assertEqual([statement, 'synergy_results'], executed)
+        finally:
+            PostgresqlDbInit._execute_statement = execute_statement
+        self.assertIn('= ANY($1::bigint[])', PostgresqlDbInit.statements['synergy_results'])
+
+    def test_entries(self):
+        # each observation is in the bundle once, followed by its sensitivities and comments
+        response = self._get_route('/encounters/22/bacteriology')
+        self.assertEqual(200, response.status_code)
+        for bundle in response.json:
+            full_urls = [entry['fullUrl'] for entry in bundle['entry']]
+            self.assertEqual(len(set(full_urls)), len(full_urls))
+
+        full_urls = [entry['fullUrl'][len('https://eds.chu-bordeaux.fr/fhir/'):] for entry in response.json[0]['entry']]
+        self.assertEqual(['DiagnosticReport/22_SYNERGY',
+                          'Observation/7002', 'Observation/22_7002_803', 'Observation/22_7002_804',
+                          'Observation/22_7002_commentaires',
+                          'Observation/7003', 'Observation/22_7003_803'], full_urls)
+
     # def tearDown(self):
     #     pass
\ No newline at end of file
@@ -0,0 +1,111 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import requests
+
+from .utils_test import get_test_client
+from src import web
+from src.utils.cache import CachedResponse, MemoryCache, RedisCache, etag_matches, make_etag
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """local stand-in for redis.Redis"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, px=None):
+        self.data[key] = value
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path, headers=None):
+        # uncompressed responses, whose ETag is the one of their body (see test_responses for gzip)
+        headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+        if self.docker_adress is not None:
+            return requests.get(f'http://{self.docker_adress}{api_path}', headers=headers)
+        else:
+            return self.app.get(api_path, headers=headers)
+
+    def test_memory_cache(self):
+        clock = FakeClock()
+        cache = MemoryCache(ttl=10, max_entries=2, max_bytes=10, clock=clock)
+        cache.set('a', CachedResponse(b'aaa', 'application/json', '"a"'))
+        cache.set('b', CachedResponse(b'bbb', 'application/json', '"b"'))
+        self.assertEqual(b'aaa', cache.get('a').body)
+
+        # least recently used entry evicted
+        cache.set('c', CachedResponse(b'ccc', 'application/json', '"c"'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+
+        # size bound
+        cache.set('d', CachedResponse(b'dddddddd', 'application/json', '"d"'))
+        self.assertEqual({'entries': 1, 'bytes': 8}, {k: cache.get_status()[k] for k in ['entries', 'bytes']})
+        cache.set('e', CachedResponse(b'e' * 11, 'application/json', '"e"'))
+        self.assertIsNone(cache.get('e'))
+
+        # ttl
+        clock.now = 10
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(0, cache.get_status()['bytes'])
+
+    def test_redis_cache(self):
+        cache = RedisCache(ttl=10, redis_url=None, client=FakeRedis())
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', CachedResponse(b'{"a":\n1}', 'application/json', '"a"'))
+        self.assertEqual(CachedResponse(b'{"a":\n1}', 'application/json', '"a"'), cache.get('a'))
+
+    def test_etag(self):
+        etag = make_etag(b'body')
+        self.assertEqual(etag, make_etag(b'body'))
+        self.assertNotEqual(etag, make_etag(b'other body'))
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches(f'"other", W/{etag}', etag))
+        self.assertTrue(etag_matches('*', etag))
+        self.assertFalse(etag_matches('"other"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+    def test_conditional_get(self):
+        # When
+        response = self._get_route('/patients/1/labResults')
+        self.assertEqual(200, response.status_code)
+        etag = response.headers['ETag']
+        self.assertEqual(etag, make_etag(response.data if self.app else response.content))
+
+        response = self._get_route('/patients/1/labResults', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers['ETag'])
+
+        response = self._get_route('/patients/1/labResults', headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(etag, response.headers['ETag'])
+
+        response = self._get_route('/patients/1/labResults?_count=1', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+        response = self._get_route('/patients/test/labResults', headers={'If-None-Match': etag})
+        self.assertEqual(404, response.status_code)
+
+    # def tearDown(self):
+    #     pass
@@ -0,0 +1,129 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import json
+import pickle
+import requests
+import tempfile
+
+from .utils_test import get_test_client
+from src import web
+from src.utils.compact import CompactMap, StringTable, compact, from_json, read_shared, to_json, write_shared
+from src.utils.metadata import MetadataRegistry
+
+
+NAMESPACE = 'http://chu-bordeaux.fr/bacteriologie-synergy#'
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def test_string_table(self):
+        strings = StringTable()
+        ids = [strings.add(value) for value in [f'{NAMESPACE}antibiotic-1', 'Amoxicilline é', f'{NAMESPACE}',
+                                                 'http://x/a/b', f'{NAMESPACE}antibiotic-1', '']]
+        self.assertEqual([0, 1, 2, 3, 0, 4], ids)
+        self.assertEqual(5, len(strings))
+        self.assertEqual(['', NAMESPACE, 'http://x/a/'], strings.namespaces)
+        strings.freeze()
+        self.assertEqual('Amoxicilline é', strings.get(1))
+        self.assertEqual(NAMESPACE, strings.get(2))
+        self.assertEqual('', strings.get(4))
+        self.assertTrue(strings.equals(0, *strings.find(f'{NAMESPACE}antibiotic-1')))
+        self.assertFalse(strings.equals(0, *strings.find(f'{NAMESPACE}antibiotic-10')))
+        self.assertFalse(strings.equals(0, *strings.find('antibiotic-1')))
+        self.assertIsNone(strings.find('http://y/antibiotic-1')[0])
+
+    def test_compact_map(self):
+        mapping = {f'{NAMESPACE}antibiotic-{i}': f'Antibiotique {i % 7}' for i in range(1000)}
+        mapping['clé'] = 'Libellé'
+        compacted = compact(mapping)
+        self.assertIsInstance(compacted, CompactMap)
+        self.assertEqual(mapping, compacted)
+        self.assertEqual(list(mapping), list(compacted))
+        self.assertEqual('Antibiotique 3', compacted[f'{NAMESPACE}antibiotic-10'])
+        self.assertEqual('Libellé', compacted.get('clé'))
+        for missing in [f'{NAMESPACE}antibiotic-1000', f'{NAMESPACE}', 'http://y/antibiotic-1', 'clef', '', 1, None]:
+            self.assertNotIn(missing, compacted)
+            self.assertEqual('default', compacted.get(missing, 'default'))
+        with self.assertRaises(KeyError):
+            compacted['clef']
+        self.assertEqual(compacted, pickle.loads(pickle.dumps(compacted)))
+        self.assertEqual({}, compact({}))
+
+        # maps of a tuple sharing their strings, values of the same shape
+        value = ({'mds:1': ('Paracétamol', ('ATC:N02', 'Analgésiques')), 'mds:2': ('Ibuprofène', ('', ''))},
+                 {'Paracétamol': 'mds:1'})
+        compacted = compact(value)
+        self.assertEqual(value, compacted)
+        self.assertIs(compacted[0]._strings, compacted[1]._strings)
+        self.assertEqual(7, len(compacted[0]._strings))
+
+        # maps which cannot be compacted are kept as is
+        for mapping in [{'version': 1}, {'a': 'b', 'c': ('d',)}, {1: 'a'}]:
+            self.assertIs(mapping, compact(mapping))
+
+    def test_json(self):
+        value = ({'mds:1': ('Paracétamol', ('ATC:N02', None)), ('a', 1): [1.5, True]}, compact({'a': 'b'}), 'c')
+        encoded = json.loads(json.dumps(to_json(value)))
+        self.assertEqual(value, from_json(encoded))
+        self.assertIs(tuple, type(from_json(encoded)[0]['mds:1']))
+        self.assertIs(dict, type(from_json(encoded)[1]))
+        self.assertRaises(TypeError, to_json, {'a': object()})
+        for invalid in [{'other': []}, {'tuple': 1}, {'map': [[{'map': []}, 'a']]}, {'map': [['a']]}]:
+            self.assertRaises(ValueError, from_json, invalid)
+
+    def test_registry(self):
+        registry = MetadataRegistry()
+        registry.register('map', lambda: {'a': 'b'})
+        registry.register('derived', lambda: {'derived': registry.get('map')['a']}, derived=True)
+        registry.start({'refresh_interval': 0})
+        self.assertNotIsInstance(registry.get('map'), dict)
+        self.assertEqual({'a': 'b'}, registry.get('map'))
+        self.assertEqual('b', registry.lookup('map', 'a'))
+        self.assertIs(dict, type(registry.get('derived')))
+        registry.start({'refresh_interval': 0, 'compact_maps': False})
+        registry.refresh(force=True)
+        self.assertIs(dict, type(registry.get('map')))
+
+    def test_shared_file(self):
+        maps = {'labels': compact({f'{NAMESPACE}antibiotic-{i}': f'Antibiotique {i}' for i in range(100)}),
+                'pairs': compact(({'mds:1': ('Paracétamol', ('ATC:N02', 'Analgésiques'))}, {'Paracétamol': 'mds:1'})),
+                'empty': compact({}), 'other': {'version': 1}}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metadata.shared')
+            header = write_shared(path, maps)
+            read_header, shared = read_shared(path)
+            self.assertEqual((header['id'], header['size']), (read_header['id'], read_header['size']))
+            self.assertEqual(maps, shared)
+            # arrays read from the mapped file, copied when pickled
+            self.assertIsInstance(shared['labels']._keys, memoryview)
+            self.assertIs(shared['pairs'][0]._strings, shared['pairs'][1]._strings)
+            self.assertEqual(maps['labels'], pickle.loads(pickle.dumps(shared['labels'])))
+            self.assertEqual('Antibiotique 42', shared['labels'].get(f'{NAMESPACE}antibiotic-42'))
+
+            # maps of a shared file published again
+            write_shared(path, shared)
+            self.assertEqual(maps, read_shared(path)[1])
+
+            for content in [b'', b'other', b'FHIR_METADATA_SHARED\n{"version": 0}\n']:
+                with open(path, 'wb') as f:
+                    f.write(content)
+                self.assertRaises(ValueError, read_shared, path)
+
+    # def tearDown(self):
+    #     pass
@@ -0,0 +1,55 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import asyncio
+import unittest
+
+from src import web
+# same module as the one used by the app, for its database connection
+from utils.db_connect import PostgresqlDbInit
+
+
+@unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'reads the database of the in-process app')
+class AsyncPostgresqlDbTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from utils.db_connect_async import AsyncPostgresqlDbInit
+        except ImportError:
+            self.skipTest('asyncpg is not installed')
+        # a single connection, reused by every request
+        self.db = AsyncPostgresqlDbInit(**dict(web.config['postgres_db'], pool_size=1, max_overflow=0))
+
+    def test_prepared_statements(self):
+        async def _prepared():
+            connection = await self.db._get_connection()
+            try:
+                return [row['name'] for row in await connection.fetch(
+                    'SELECT name FROM pg_prepared_statements WHERE statement = $1',
+                    PostgresqlDbInit.statements['patient'])]
+            finally:
+                await self.db.pool.release(connection)
+
+        async def _run():
+            await self.db.open()
+            try:
+                first = await self.db.fetch_rows('patient', 1)
+                prepared = await _prepared()
+                second = await self.db.fetch_rows('patient', 1)
+                batches = [batch async for batch in self.db.iter_batches('patient', 1)]
+                return first, second, batches, prepared, await _prepared()
+            finally:
+                await self.db.close()
+
+        first, second, batches, prepared, prepared_again = asyncio.get_event_loop().run_until_complete(_run())
+        self.assertEqual(first, second)
+        self.assertEqual([first], batches)
+        # prepared by the first request, reused by the following ones
+        self.assertTrue(prepared)
+        self.assertEqual(prepared, prepared_again)
+
+    # def tearDown(self):
+    #     pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,7 @@ from datetime import datetime
 from pprint import pprint
 import requests
 
-from .utils_test import datetime_fromisoformat
+from .utils_test import datetime_fromisoformat, get_test_client
 from src import web
 
 
@@ -16,7 +16,7 @@ class ClinicalReportTest(unittest.TestCase):
         self.app = None
         self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
         if self.docker_adress is None:
-            self.app = web.app.test_client()
+            self.app = get_test_client(self)
         self.verbose = os.environ.get('TEST_VERBOSE', False)
 
     def _get_route(self, api_path):
@@ -6,7 +6,7 @@ import requests
 from datetime import datetime
 from pprint import pprint
 
-from .utils_test import datetime_fromisoformat
+from .utils_test import datetime_fromisoformat, get_test_client
 from src import web
 
 
@@ -17,7 +17,7 @@ class EncounterTest(unittest.TestCase):
         self.app = None
         self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
         if self.docker_adress is None:
-            self.app = web.app.test_client()
+            self.app = get_test_client(self)
         self.verbose = os.environ.get('TEST_VERBOSE', False)
 
     def _get_route(self, api_path):
@@ -83,5 +83,37 @@ class EncounterTest(unittest.TestCase):
         response = self._get_route(self.end_point.format(encounter_num=''))
         self.assertEqual(404, response.status_code)
 
+    def test_search_by_patient(self):
+        # When
+        response = self._get_route('/encounters?patient=1')
+
+        # Then
+        if self.verbose:
+            pprint(response.json)
+
+        self.assertEqual(200, response.status_code)
+        self.assertIsInstance(response.json, list)
+        self.assertGreaterEqual(len(response.json), 1)
+        for encounter in response.json:
+            self.assertEqual('Patient/1', encounter['subject']['reference'])
+            self.assertEqual(self._get_route(self.end_point.format(encounter_num=encounter['id'])).json, encounter)
+            # locations sorted by date
+            starts = [location['period']['start'] for location in encounter['location']]
+            self.assertEqual(sorted(starts), starts)
+
+        # several patients
+        response_several = self._get_route('/encounters?patient=1,999999,1')
+        self.assertEqual(200, response_several.status_code)
+        self.assertEqual(response.json, response_several.json)
+
+    def test_search_by_patient_failure(self):
+        for query in ['', '?patient=', '?patient=test']:
+            # html error page, not parsed as json
+            if self.docker_adress is not None:
+                response = requests.get(f'http://{self.docker_adress}/encounters{query}')
+            else:
+                response = self.app.get(f'/encounters{query}')
+            self.assertEqual(400, response.status_code, query)
+
     # def tearDown(self):
     #     pass
\ No newline at end of file
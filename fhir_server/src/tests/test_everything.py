@@ -0,0 +1,81 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import requests
+from pprint import pprint
+
+from .utils_test import get_test_client
+from src import web
+# same module as the one used by the app, for its database connection
+from utils.db_connect import PostgresqlDbInit
+
+
+class EverythingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.end_point = '/patients/{patient_num}/$everything'
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def test_ressource_ok(self):
+        # When
+        patient_num = 1
+        response = self._get_route(self.end_point.format(patient_num=patient_num))
+
+        # Then
+        if self.verbose:
+            pprint(response.json)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Bundle', response.json['resourceType'])
+        self.assertEqual('searchset', response.json['type'])
+        resources = [entry['resource'] for entry in response.json['entry']]
+        self.assertEqual(self._get_route(f'/patients/{patient_num}').json, resources[0])
+
+        # same resources as the routes of each resource type
+        expected = []
+        for ressource in ['labResults', 'clinicalReports', 'medicationAdministrations', 'procedures', 'pmsis',
+                          'questionnaireResponses', 'bacteriology']:
+            expected += self._get_route(f'/patients/{patient_num}/{ressource}').json
+        self.assertEqual(sorted(expected, key=str), sorted(resources[1:], key=str))
+
+    def test_ressource_failure(self):
+        # When
+        response = self._get_route(self.end_point.format(patient_num="test"))
+        self.assertEqual(404, response.status_code)
+
+        response = self._get_route(self.end_point.format(patient_num="0"))
+        self.assertEqual(404, response.status_code)
+
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS') or os.environ.get('TEST_ASGI'),
+                     'counts the queries of the in-process flask app')
+    def test_unknown_patient(self):
+        # the facts are not scanned for an unknown patient
+        executed = []
+        execute_statement = PostgresqlDbInit._execute_statement
+
+        def _execute_statement(db, connection, cursor, name, params):
+            executed.append(name)
+            return execute_statement(db, connection, cursor, name, params)
+
+        PostgresqlDbInit._execute_statement = _execute_statement
+        try:
+            response = self._get_route(self.end_point.format(patient_num="0"))
+        finally:
+            PostgresqlDbInit._execute_statement = execute_statement
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(['patient'], executed)
+
+    # def tearDown(self):
+    #     pass
@@ -0,0 +1,398 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import hashlib
+import json
+import pickle
+import re
+import requests
+import tempfile
+import time
+from pprint import pprint
+
+from .utils_test import get_test_client
+from src import web
+from src.utils.metadata import SNAPSHOT_MAGIC, LazyResolver, MetadataRegistry, values_clause
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLoader:
+    """loader returning a new map at each call, or failing"""
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    def __call__(self):
+        self.calls += 1
+        if self.error is not None:
+            raise ValueError(self.error)
+        return {'version': self.calls}
+
+
+class FakeTerminology:
+    """loader answering VALUES queries on literal keys"""
+
+    def __init__(self, terminology):
+        self.terminology = terminology
+        self.queries = []
+
+    def __call__(self, values=''):
+        keys = re.findall(r'"([^"]*)"', values)
+        self.queries.append(keys)
+        if not values:
+            return dict(self.terminology)
+        return {key: self.terminology[key] for key in keys if key in self.terminology}
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def test_registry(self):
+        clock = FakeClock()
+        registry = MetadataRegistry(clock=clock)
+        loader = FakeLoader()
+        registry.register('map', loader)
+        registry.refresh_interval = 100
+        registry.retry_interval = 10
+
+        # loaded once, on first use
+        self.assertEqual({}, registry.refresh())
+        self.assertEqual({'version': 1}, registry.get('map'))
+        self.assertEqual({'version': 1}, registry.get('map'))
+        self.assertEqual(1, loader.calls)
+
+        # refreshed when due
+        clock.now = 50
+        self.assertEqual({}, registry.refresh())
+        clock.now = 100
+        self.assertEqual({'map': True}, registry.refresh())
+        self.assertEqual({'version': 2}, registry.get('map'))
+
+        # previous map kept if the refresh fails, retried sooner
+        loader.error = 'endpoint down'
+        clock.now = 200
+        with self.assertLogs('Metadata', level='ERROR'):
+            self.assertEqual({'map': False}, registry.refresh())
+        self.assertEqual({'version': 2}, registry.get('map'))
+        status = registry.get_status()['maps']['map']
+        self.assertEqual((1, 'endpoint down', 1, 10.), (status['errors'], status['last_error'], status['size'],
+                                                        status['next_refresh_s']))
+
+        loader.error = None
+        clock.now = 210
+        self.assertEqual({'map': True}, registry.refresh())
+        self.assertEqual({'version': 4}, registry.get('map'))
+        self.assertEqual(2, registry.get_status()['maps']['map']['refreshes'])
+
+        # error of the first load raised, and retried at the next use
+        failing = FakeLoader()
+        failing.error = 'endpoint down'
+        registry.register('failing', failing)
+        self.assertRaises(ValueError, registry.get, 'failing')
+        self.assertFalse(registry.get_status()['maps']['failing']['loaded'])
+        failing.error = None
+        self.assertEqual({'version': 2}, registry.get('failing'))
+
+    def test_background_refresh(self):
+        registry = MetadataRegistry()
+        loader = FakeLoader()
+        registry.register('map', loader)
+        registry.get('map')
+        registry.start({'refresh_interval': 0.01})
+        try:
+            for _ in range(200):
+                if loader.calls > 2:
+                    break
+                registry._stop.wait(0.01)
+            self.assertGreater(loader.calls, 2)
+            self.assertTrue(registry.get_status()['background_refresh'])
+        finally:
+            registry.stop()
+        self.assertFalse(registry.get_status()['background_refresh'])
+
+        # disabled
+        registry.start({'refresh_interval': 0})
+        self.assertFalse(registry.get_status()['background_refresh'])
+
+        # errors of the refresh itself (shared file lock here) do not stop the thread
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry.start({'refresh_interval': 0.01, 'retry_interval': 0.01,
+                            'shared_path': os.path.join(tmp_dir, 'missing', 'metadata.shared')})
+            try:
+                with self.assertLogs('Metadata', level='ERROR'):
+                    for _ in range(200):
+                        if registry.refresh_errors > 2:
+                            break
+                        registry._stop.wait(0.01)
+                status = registry.get_status()
+                self.assertGreater(status['refresh_errors'], 2)
+                self.assertIn('missing', status['last_refresh_error'])
+                self.assertTrue(status['background_refresh'])
+            finally:
+                registry.stop()
+
+    def test_preload(self):
+        registry = MetadataRegistry()
+
+        def _slow_loader(version):
+            def _load():
+                time.sleep(0.2)
+                return {'version': version}
+            return _load
+
+        for i in range(4):
+            registry.register(f'map{i}', _slow_loader(i))
+        failing = FakeLoader()
+        failing.error = 'endpoint down'
+        registry.register('failing', failing)
+        registry.register('derived', lambda: {'derived': registry.get('map3')['version']}, derived=True)
+
+        # concurrent loads, derived maps after the others
+        start = time.perf_counter()
+        with self.assertLogs('Metadata', level='INFO') as logs:
+            results = registry.preload(workers=4)
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertEqual({'map0': None, 'map1': None, 'map2': None, 'map3': None, 'failing': 'endpoint down',
+                          'derived': None}, results)
+        self.assertEqual({'derived': 3}, registry.get('derived'))
+        self.assertTrue(any('map0: 1 entries in' in line for line in logs.output))
+        status = registry.get_status()['preload']
+        self.assertEqual((5, ['failing'], 4), (status['loaded'], status['failed'], status['workers']))
+
+        # only the maps not loaded yet, stopping at the first error if asked, without waiting for the slow loads
+        registry.register('slow', _slow_loader(4))
+        start = time.perf_counter()
+        self.assertRaises(ValueError, registry.preload, workers=2, fail_fast=True)
+        self.assertLess(time.perf_counter() - start, 0.15)
+        failing.error = None
+        self.assertEqual({'slow': None, 'failing': None}, registry.preload())
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metadata.snapshot')
+            clock = FakeClock()
+            registry = MetadataRegistry(clock=clock)
+            loader = FakeLoader()
+            registry.register('map', loader)
+            registry.register('derived', lambda: {'derived': registry.get('map')['version']}, derived=True)
+            registry.start({'refresh_interval': 0, 'snapshot_path': path})
+            self.assertEqual({'derived': 1}, registry.get('derived'))
+            self.assertTrue(registry.save_snapshot())
+
+            # new process, sparql unavailable: maps of the snapshot, refreshed at once
+            registry = MetadataRegistry(clock=clock)
+            loader = FakeLoader()
+            loader.error = 'endpoint down'
+            registry.register('map', loader)
+            registry.register('derived', lambda: {'derived': registry.get('map')['version']}, derived=True)
+            registry.start({'refresh_interval': 0, 'snapshot_path': path})
+            self.assertEqual({'version': 1}, registry.get('map'))
+            self.assertEqual({'derived': 1}, registry.get('derived'))
+            self.assertEqual(0, loader.calls)
+            status = registry.get_status()
+            self.assertTrue(status['maps']['map']['from_snapshot'])
+            self.assertEqual(1, status['snapshot']['loaded_maps'])
+
+            registry.refresh_interval = 100
+            with self.assertLogs('Metadata', level='ERROR'):
+                self.assertEqual({'map': False}, registry.refresh())
+            self.assertEqual({'version': 1}, registry.get('map'))
+            loader.error = None
+            clock.now = 1000
+            self.assertEqual({'map': True, 'derived': True}, registry.refresh())
+            self.assertEqual({'derived': 2}, registry.get('derived'))
+            self.assertFalse(registry.get_status()['maps']['map']['from_snapshot'])
+
+            # snapshot saved by the refresh
+            registry = MetadataRegistry(clock=clock)
+            registry.register('map', FakeLoader())
+            registry.start({'refresh_interval': 0, 'snapshot_path': path})
+            self.assertEqual({'version': 2}, registry.get('map'))
+
+            # corrupted or unknown snapshots are ignored, as well as code with a valid hash (never unpickled)
+            with open(path, 'rb') as f:
+                data = f.read()
+            pickled = pickle.dumps({'map': {'version': 3}})
+            tampered = json.dumps({'version': 2, 'created_at': '2020-01-01T00:00:00', 'maps': ['map'],
+                                   'sha256': hashlib.sha256(pickled).hexdigest()})
+            for corrupted in [data[:-1] + b'x', b'other', SNAPSHOT_MAGIC + data[len(SNAPSHOT_MAGIC):].replace(
+                    b'"version": 2', b'"version": 0'), SNAPSHOT_MAGIC + tampered.encode() + b'\n' + pickled]:
+                with open(path, 'wb') as f:
+                    f.write(corrupted)
+                registry = MetadataRegistry(clock=clock)
+                registry.register('map', FakeLoader())
+                registry.snapshot_path = path
+                with self.assertLogs('Metadata', level='WARNING'):
+                    self.assertEqual([], registry.load_snapshot())
+                self.assertEqual({'version': 1}, registry.get('map'))
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metadata.shared')
+            clock = FakeClock()
+            workers = []
+            for _ in range(3):
+                registry = MetadataRegistry(clock=clock)
+                loader = FakeTerminology({'MDS:1': 'Paracétamol', 'MDS:2': 'Ibuprofène'})
+                registry.register('map', loader)
+                registry.register('derived', lambda registry=registry: {'size': str(len(registry.get('map')))},
+                                  derived=True)
+                registry.start({'refresh_interval': 100, 'shared_path': path})
+                registry.stop()
+                workers.append((registry, loader))
+
+            # loaded and published by the 1st worker, the others using the shared file
+            self.assertEqual({'map': None, 'derived': None}, workers[0][0].preload())
+            for registry, _ in workers[1:]:
+                self.assertEqual({'derived': None}, registry.preload())
+            self.assertEqual([1, 0, 0], [len(loader.queries) for _, loader in workers])
+            for registry, _ in workers:
+                self.assertEqual('Ibuprofène', registry.lookup('map', 'MDS:2'))
+                self.assertEqual({'size': '2'}, registry.get('derived'))
+                status = registry.get_status()
+                self.assertTrue(status['maps']['map']['from_shared'])
+                self.assertEqual(1, status['shared']['attached_maps'])
+
+            # new process, attached at startup
+            registry = MetadataRegistry(clock=clock)
+            loader = FakeTerminology({})
+            registry.register('map', loader)
+            registry.start({'refresh_interval': 100, 'shared_path': path})
+            self.assertEqual('Paracétamol', registry.lookup('map', 'MDS:1'))
+            self.assertEqual([], loader.queries)
+
+            # refreshed once: the other workers use the maps published by the 1st one
+            clock.now = 1000
+            workers[0][1].terminology['MDS:3'] = 'Aspirine'
+            for registry, _ in workers:
+                self.assertEqual({'map': True, 'derived': True}, registry.refresh())
+                self.assertEqual('Aspirine', registry.lookup('map', 'MDS:3'))
+                self.assertEqual({'size': '3'}, registry.get('derived'))
+            self.assertEqual([2, 0, 0], [len(loader.queries) for _, loader in workers])
+            self.assertEqual({}, workers[1][0].refresh())
+
+            # invalid files are ignored
+            with open(path, 'wb') as f:
+                f.write(b'other')
+            registry = MetadataRegistry(clock=clock)
+            registry.register('map', FakeTerminology({}))
+            registry.shared_path = path
+            with self.assertLogs('Metadata', level='WARNING'):
+                self.assertEqual([], registry.attach_shared())
+
+    def test_lazy_resolver(self):
+        self.assertEqual('VALUES ?label { "a \\"b\\"" "c" }', values_clause('label', ['a "b"', 'c']))
+        self.assertEqual('VALUES ?s { <http://x/1> }', values_clause('s', ['http://x/1'], iri=True))
+
+        clock = FakeClock()
+        loader = FakeTerminology({'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D', 'e': 'E'})
+        resolver = LazyResolver(loader, 'label', False, cache_size=4, ttl=0, negative_ttl=10, batch_size=2,
+                                clock=clock)
+
+        # misses resolved by batches, unknown keys cached too
+        self.assertEqual({'a': 'A', 'b': 'B'}, resolver.resolve(['a', 'b', 'x', 'a']))
+        self.assertEqual(2, len(loader.queries))
+        self.assertEqual('A', resolver.get('a'))
+        self.assertEqual('default', resolver.get('x', 'default'))
+        self.assertEqual(2, len(loader.queries))
+        clock.now = 10
+        self.assertIsNone(resolver.get('x'))
+        self.assertEqual([['x']], loader.queries[2:])
+
+        # bounded, least recently used keys evicted
+        resolver.resolve(['c', 'd', 'e'])
+        status = resolver.get_status()
+        self.assertEqual((4, 1, 5), (status['entries'], status['unknown'], status['queries']))
+        resolver.get('a')
+        self.assertEqual(6, len(loader.queries))
+
+        # without negative caching, keys not found kept until the next prefetch only
+        loader = FakeTerminology({'a': 'A'})
+        resolver = LazyResolver(loader, 'label', False, cache_size=4, ttl=0, negative_ttl=0, batch_size=2,
+                                clock=clock)
+        self.assertEqual({'a': 'A'}, resolver.prefetch(['a', 'x']))
+        self.assertIsNone(resolver.get('x'))
+        self.assertEqual('A', resolver.get('a'))
+        self.assertEqual(1, len(loader.queries))
+        resolver.prefetch(['a', 'y'])
+        self.assertIsNone(resolver.get('x'))
+        self.assertEqual([['y'], ['x']], loader.queries[1:])
+
+        # errors raised, not cached
+        failing = FakeLoader()
+        failing.error = 'endpoint down'
+        resolver = LazyResolver(lambda values: failing(), 'label', False, 10, 0, 10, 10, clock=clock)
+        self.assertRaises(ValueError, resolver.get, 'a')
+        self.assertRaises(ValueError, resolver.get, 'a')
+        self.assertEqual(2, resolver.get_status()['errors'])
+
+    def test_lazy_maps(self):
+        registry = MetadataRegistry()
+        loader = FakeTerminology({'a': 'A', 'b': 'B'})
+        registry.register('map', loader, lazy_key='label')
+        registry.register('whole', FakeLoader())
+        with self.assertLogs('Metadata', level='WARNING'):
+            registry.start({'refresh_interval': 0, 'lazy_maps': 'map, whole'})
+
+        # keys of the rows resolved at once, the map not loaded whole
+        rows = list(registry.iter_prefetched('map', ['a', 'b', 'c'], lambda row: row))
+        self.assertEqual(['a', 'b', 'c'], rows)
+        self.assertEqual([['a', 'b', 'c']], [sorted(keys) for keys in loader.queries])
+        self.assertEqual(('A', 'B', None), tuple(registry.lookup('map', key) for key in 'abc'))
+        self.assertEqual(1, len(loader.queries))
+        self.assertEqual({'whole': None}, registry.preload())
+        status = registry.get_status()['maps']
+        self.assertFalse(status['map']['loaded'])
+        self.assertEqual(3, status['map']['lazy']['entries'])
+        self.assertNotIn('lazy', status['whole'])
+
+        # whole maps otherwise
+        registry.start({'refresh_interval': 0})
+        self.assertEqual('A', registry.lookup('map', 'a'))
+        self.assertEqual([''], [''.join(keys) for keys in loader.queries[1:]])
+        self.assertEqual(rows, registry.iter_prefetched('map', rows, lambda row: row))
+
+    def test_status(self):
+        self._get_route('/patients/1/labResults')
+        response = self._get_route('/status/metadata')
+        self.assertEqual(200, response.status_code)
+        if self.verbose:
+            pprint(response.json)
+        for key in ['refresh_interval', 'retry_interval', 'background_refresh', 'maps']:
+            self.assertIn(key, response.json)
+        if response.json['refresh_interval']:
+            # started in the process serving the requests, not at import
+            self.assertTrue(response.json['background_refresh'])
+        status = response.json['maps']['observation._get_request_1']
+        if 'lazy' in status:
+            # resolved per key (lazy_maps)
+            self.assertLess(0, status['lazy']['entries'])
+        else:
+            self.assertTrue(status['loaded'])
+        self.assertIn('questionnaireResponse._get_structure_index', response.json['maps'])
+
+    # def tearDown(self):
+    #     pass
@@ -1,4 +1,5 @@
 import sys, os
+import json
 sys.path.append(os.path.abspath('..'))
 import unittest
 import fhirclient.models.observation as fhir_observation_mod
@@ -6,7 +7,7 @@ import requests
 from datetime import datetime
 from pprint import pprint
 
-from .utils_test import datetime_fromisoformat
+from .utils_test import datetime_fromisoformat, get_test_client
 from src import web
 
 
@@ -16,7 +17,7 @@ class BiologyTest(unittest.TestCase):
         self.app = None
         self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
         if self.docker_adress is None:
-            self.app = web.app.test_client()
+            self.app = get_test_client(self)
         self.verbose = os.environ.get('TEST_VERBOSE', False)
 
     def _get_route(self, api_path):
@@ -26,6 +27,15 @@ class BiologyTest(unittest.TestCase):
             return res
         else:
             return self.app.get(api_path)
+
+    def _get_ndjson_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            text = res.text
+        else:
+            res = self.app.get(api_path)
+            text = res.get_data(as_text=True)
+        return res.status_code, [json.loads(line) for line in text.splitlines()]
         
     def test_ressource_ok(self):
         # When
@@ -87,6 +97,43 @@ class BiologyTest(unittest.TestCase):
             self.assertIn('referenceRange', res)
             self.assertIn('text', res['referenceRange'][0])
 
+    def test_ressource_stream(self):
+        # When
+        patient_num = 1
+        expected = self._get_route(f'/patients/{patient_num}/labResults').json
+        response = self._get_route(f'/patients/{patient_num}/labResults?_stream=json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(expected, response.json)
+        self._check_ressource(response.json)
+
+        status_code, json_result = self._get_ndjson_route(f'/patients/{patient_num}/labResults?_stream=ndjson')
+        self.assertEqual(200, status_code)
+        self.assertEqual(expected, json_result)
+
+        response = self._get_route('/encounters/test/labResults?_stream=json')
+        self.assertEqual(404, response.status_code)
+
+    def test_ressource_page(self):
+        # When
+        patient_num = 1
+        expected = self._get_route(f'/patients/{patient_num}/labResults').json
+        json_result = []
+        api_path = f'/patients/{patient_num}/labResults?_count=5'
+        while api_path is not None:
+            response = self._get_route(api_path)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('Bundle', response.json['resourceType'])
+            self.assertEqual('searchset', response.json['type'])
+            self.assertLessEqual(len(response.json['entry']), 5)
+            json_result += [entry['resource'] for entry in response.json['entry']]
+            next_links = [link['url'] for link in response.json['link'] if link['relation'] == 'next']
+            api_path = next_links[0][next_links[0].index('/patients'):] if next_links else None
+        self._check_ressource(json_result)
+        self.assertEqual(sorted(expected, key=str), sorted(json_result, key=str))
+
+        response = self._get_route('/patients/test/labResults?_count=5')
+        self.assertEqual(404, response.status_code)
+
     def test_ressource_failure(self):
         # When
         response = self._get_route(f'/patients/test/labResults')
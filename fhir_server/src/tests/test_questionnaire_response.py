@@ -6,8 +6,11 @@ import requests
 from datetime import datetime
 from pprint import pprint
 
-from .utils_test import datetime_fromisoformat
+from .utils_test import datetime_fromisoformat, get_test_client
 from src import web
+# same modules as the ones used by the app, for its database connection
+from utils.db_connect import PostgresqlDB
+import questionnaireResponse
 
 
 class QuestionnaireResponseTest(unittest.TestCase):
@@ -16,7 +19,7 @@ class QuestionnaireResponseTest(unittest.TestCase):
         self.app = None
         self.docker_adress = 'localhost:5000'  # os.environ.get('TEST_DOCKER_ADRESS', None)
         if self.docker_adress is None:
-            self.app = web.app.test_client()
+            self.app = get_test_client(self)
         self.verbose = os.environ.get('TEST_VERBOSE', False)
 
     def _get_route(self, api_path):
@@ -108,5 +111,87 @@ class QuestionnaireResponseTest(unittest.TestCase):
         response = self._get_route('/encounters//questionnaireResponses')
         self.assertEqual(404, response.status_code)
 
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'reads the database of the in-process app')
+    def test_tree(self):
+        # each form, page, section and question is added once, whatever the number of answers
+        rows = PostgresqlDB().fetch_rows('quest_for_patient', 1)
+        self.assertLess(0, len(rows))
+        once = questionnaireResponse._build_quest(rows)
+        twice = questionnaireResponse._build_quest(rows + rows)
+
+        def _link_ids(items):
+            link_ids = [item['linkId'] for item in items]
+            self.assertEqual(len(set(link_ids)), len(link_ids))
+            return {item['linkId']: (_link_ids(item.get('item', [])), len(item.get('answer', [])))
+                    for item in items}
+
+        self.assertEqual(len(once), len(twice))
+        for res_once, res_twice in zip(once, twice):
+            tree_once, tree_twice = _link_ids(res_once['item']), _link_ids(res_twice['item'])
+            self.assertEqual(list(tree_once), list(tree_twice))
+
+            def _check_answers(tree_once, tree_twice):
+                for link_id, (children, nb_answers) in tree_once.items():
+                    self.assertEqual(2 * nb_answers, tree_twice[link_id][1])
+                    _check_answers(children, tree_twice[link_id][0])
+            _check_answers(tree_once, tree_twice)
+
+    def test_structure_index(self):
+        structure = (({'q1': 'Q1', 'q2': 'Q2', 'q3': 'Q3', 'q4': 'Q4'}, {'s1': 'S1', 's2': 'S2', 's3': 'S3'},
+                      {'p1': 'P1', 'p2': 'P2'}, {'f1': 'F1'}),
+                     ({'q1': 's2', 'q3': 's3'}, {'s2': 's1'}, {'s1': 'p1'}, {'q2': 'p1', 'q4': 'p2'}, {'p1': 'f1'}))
+        with self.assertLogs('questionnaireResponse', level='WARNING') as logs:
+            paths, broken = questionnaireResponse.build_structure_index(structure)
+        self.assertEqual(1, len(logs.output))
+
+        self.assertEqual(('f1', 'p1', 's1', 's2', 'q1'), paths['q1'].links)
+        self.assertEqual(('F1', 'P1', 'S1', 'S2', 'Q1'), paths['q1'].texts)
+        self.assertEqual(('f1', 'p1', 'q2'), paths['q2'].links)
+        self.assertEqual({'q3': 'page not found for section s3', 'q4': 'form not found for page p2'}, dict(broken))
+        with self.assertRaises(TypeError):
+            paths['q3'] = paths['q1']
+
+        # questions with a broken link are skipped at request time, without logging again
+        get_structure_index = questionnaireResponse._get_structure_index
+        questionnaireResponse._get_structure_index = lambda: (paths, broken)
+        try:
+            tree = questionnaireResponse.QuestionnaireTree(fhir_quest_mod.QuestionnaireResponse())
+            tree.questionnaire.item = []
+            self.assertIsNone(tree.get_question_item('q3', 'Q3'))
+            self.assertEqual([], tree.questionnaire.item)
+            self.assertEqual('Q2', tree.get_question_item('q2', 'Q2').definition)
+            with self.assertRaises(ValueError):
+                tree.get_question_item('q5', 'Q5')
+        finally:
+            questionnaireResponse._get_structure_index = get_structure_index
+
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'reads the database of the in-process app')
+    def test_page_ties(self):
+        # two forms of different encounters with the same instance and date, and forms without instance or encounter
+        PostgresqlDB.register_statement(
+            'test_quest_ties',
+            """SELECT * FROM (VALUES (1, 10, 7, timestamp '2020-01-02'), (2, 11, 7, timestamp '2020-01-02'),
+                                     (3, 11, 7, timestamp '2020-01-02'), (4, 10, NULL, NULL),
+                                     (5, 12, 6, timestamp '2020-01-01'), (6, NULL, 8, timestamp '2020-01-01'),
+                                     (7, NULL, 8, timestamp '2020-01-03')) AS facts("ROW", "ENCOUNTER_NUM",
+                                                                                   "INSTANCE_NUM", "START_DATE")
+               WHERE $1::int > 0""",
+            page_group=('"ENCOUNTER_NUM"', '"INSTANCE_NUM"'))
+        db = PostgresqlDB()
+        for count in [1, 2, 3]:
+            pages = []
+            key = None
+            while True:
+                rows, key = db.fetch_page('test_quest_ties', (count, key), 1)
+                pages.append([row.ROW for row in rows])
+                if key is None:
+                    break
+            # forms never split between pages, none lost, those with a null page key column last
+            self.assertEqual([5, 2, 3, 1, 4, 6, 7], [row for page in pages for row in page])
+            for group in [[2, 3], [6, 7]]:
+                self.assertIn(group, [page[idx:idx + 2] for page in pages for idx in range(len(page))])
+        self.assertEqual([4, 6, 7], [row.ROW for row in db.fetch_page('test_quest_ties', (3, (11, None)), 1)[0]])
+        self.assertRaises(ValueError, db.fetch_page, 'test_quest_ties', (1, ('2020-01-01', 7)), 1)
+
     # def tearDown(self):
     #     pass
\ No newline at end of file
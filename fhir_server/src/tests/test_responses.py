@@ -0,0 +1,141 @@
+import sys, os
+import json
+sys.path.append(os.path.abspath('..'))
+import unittest
+import gzip
+import requests
+from datetime import date, datetime
+from decimal import Decimal
+
+from .utils_test import get_test_client
+from src import web
+# same module as the one used by the app, for its encoder settings
+from utils.api import accepts_gzip, dumps_resource, get_response_config, parse_format_args, render_data, \
+    set_response_config
+
+
+class ResponsesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path, headers):
+        """response, and its body as sent (compressed or not)"""
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}', headers=headers, stream=True)
+            return res, res.raw.read()
+        else:
+            res = self.app.get(api_path, headers=headers)
+            return res, res.get_data()
+
+    def test_ndjson(self):
+        # When
+        response, body = self._get_route('/patients/1/labResults', {'Accept-Encoding': 'identity'})
+        response_nd, body_nd = self._get_route('/patients/1/labResults?_format=ndjson', {'Accept-Encoding': 'identity'})
+
+        # Then
+        self.assertEqual(200, response_nd.status_code)
+        self.assertEqual('application/x-ndjson', response_nd.headers['Content-Type'])
+        self.assertEqual(json.loads(body), [json.loads(line) for line in body_nd.decode().splitlines()])
+
+        # resources of a bundle
+        response, body = self._get_route('/patients/1/$everything', {'Accept-Encoding': 'identity'})
+        response_nd, body_nd = self._get_route('/patients/1/$everything?_format=ndjson', {'Accept-Encoding': 'identity'})
+        self.assertEqual([entry['resource'] for entry in json.loads(body)['entry']],
+                         [json.loads(line) for line in body_nd.decode().splitlines()])
+
+        for query in ['_format=xml', '_format=ndjson&_count=2', '_format=ndjson&_stream=json']:
+            response, _ = self._get_route(f'/patients/1/labResults?{query}', {})
+            self.assertEqual(400, response.status_code, query)
+
+    def test_gzip(self):
+        # When
+        response, body = self._get_route('/patients/1/labResults', {'Accept-Encoding': 'identity'})
+        response_gz, body_gz = self._get_route('/patients/1/labResults', {'Accept-Encoding': 'gzip, deflate'})
+
+        # Then
+        self.assertEqual(200, response_gz.status_code)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('gzip', response_gz.headers['Content-Encoding'])
+        self.assertEqual(body, gzip.decompress(body_gz))
+        self.assertNotEqual(response.headers['ETag'], response_gz.headers['ETag'])
+
+        response, _ = self._get_route('/patients/1/labResults', {'Accept-Encoding': 'gzip',
+                                                                 'If-None-Match': response_gz.headers['ETag']})
+        self.assertEqual(304, response.status_code)
+
+        # streams
+        response, body = self._get_route('/patients/1/labResults?_stream=ndjson', {'Accept-Encoding': 'identity'})
+        response_gz, body_gz = self._get_route('/patients/1/labResults?_stream=ndjson', {'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response_gz.headers['Content-Encoding'])
+        self.assertEqual(body, gzip.decompress(body_gz))
+
+        # small responses are not compressed
+        response, _ = self._get_route('/patients/1', {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'interrupts a stream of the in-process app')
+    def test_stream_interrupted(self):
+        def _resources():
+            yield {'resourceType': 'Observation', 'id': '1'}
+            raise RuntimeError('connection lost')
+
+        # the error reaches the server, which drops the connection instead of ending the body cleanly
+        for stream_format in ['json', 'ndjson']:
+            with web.app.test_request_context('/', headers={'Accept-Encoding': 'identity'}):
+                response = web.stream_data('test', _resources(), stream_format)
+                with self.assertLogs('Flask', level='ERROR'), self.assertRaises(RuntimeError):
+                    b''.join(response.response)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip('gzip, deflate, br'))
+        self.assertTrue(accepts_gzip('br;q=1.0, gzip;q=0.5'))
+        self.assertTrue(accepts_gzip('*'))
+        self.assertFalse(accepts_gzip('gzip;q=0, *'))
+        self.assertFalse(accepts_gzip('identity'))
+        self.assertFalse(accepts_gzip(None))
+
+    def test_format_args(self):
+        self.assertEqual(('json', None, None), parse_format_args({}, streamable=True, pageable=True))
+        self.assertEqual(('ndjson', None, None), parse_format_args({'_format': 'ndjson'}))
+        self.assertEqual(('json', 'ndjson', None), parse_format_args({'_stream': 'ndjson'}, streamable=True))
+        self.assertEqual(('json', None, (2, None)), parse_format_args({'_count': '2'}, pageable=True))
+        # ignored by the resources that cannot be streamed or paged
+        self.assertEqual(('json', None, None), parse_format_args({'_stream': 'ndjson', '_count': '2'}))
+        for args in [{'_format': 'xml'}, {'_stream': 'xml'}, {'_stream': 'json', '_count': '2'},
+                     {'_format': 'ndjson', '_count': '2'}, {'_format': 'ndjson', '_stream': 'json'}]:
+            self.assertRaises(ValueError, parse_format_args, args, streamable=True, pageable=True)
+
+    def test_encoders(self):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        data = {'date': date(2020, 1, 2), 'datetime': datetime(2020, 1, 2, 3, 4, 5), 'decimal': Decimal('1.5'),
+                'list': [1, 'é', None], 'float': 2.5}
+        if numpy is not None:
+            data.update({'int64': numpy.int64(3), 'array': numpy.array([1, 2])})
+        expected = {'date': '2020-01-02', 'datetime': '2020-01-02T03:04:05', 'decimal': 1.5, 'list': [1, 'é', None],
+                    'float': 2.5, 'int64': 3, 'array': [1, 2]}
+        self.assertEqual({key: expected[key] for key in data}, json.loads(dumps_resource(data)))
+        self.assertEqual(b'{"a":1}\n{"b":2}\n', render_data([{'a': 1}, {'b': 2}], 'ndjson'))
+
+        response_config = get_response_config()
+        try:
+            import orjson
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        try:
+            set_response_config(dict(response_config, json_encoder='orjson'))
+            self.assertEqual({key: expected[key] for key in data}, json.loads(dumps_resource(data)))
+            self.assertEqual('{"a":1,"b":[1.5,"x"]}', dumps_resource({'b': [1.5, 'x'], 'a': 1}))
+        finally:
+            set_response_config(response_config)
+        self.assertRaises(ValueError, set_response_config, {'json_encoder': 'unknown'})
+
+    # def tearDown(self):
+    #     pass
@@ -0,0 +1,109 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import json
+import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from pprint import pprint
+
+from .utils_test import get_test_client
+from src import web
+from src.utils.db_connect import SparqlCsvParser, SparqlDbInit
+
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def test_pools_ok(self):
+        # When
+        self._get_route('/patients/1')
+        response = self._get_route('/status/pools')
+        self.assertEqual(200, response.status_code)
+        if self.verbose:
+            pprint(response.json)
+
+        self.assertIn('postgres_db', response.json)
+        self.assertIn('status', response.json['postgres_db'])
+        self.assertIn('wait', response.json['postgres_db'])
+        self.assertGreaterEqual(response.json['postgres_db']['wait']['count'], 1)
+        for k in ['count', 'total_ms', 'mean_ms', 'max_ms']:
+            self.assertIn(k, response.json['postgres_db']['wait'])
+
+        self.assertIn('sparql_db', response.json)
+        self.assertIn('config', response.json['sparql_db'])
+        self.assertIn('queries', response.json['sparql_db'])
+
+    def test_sparql_csv_parser(self):
+        data = 'label,s,other\r\n"a, ""b""",http://x/1,\r\n"multi\r\nline é",http://x/2,z\r\n'.encode('utf-8')
+        expected = [('http://x/1', 'a, "b"'), ('http://x/2', 'multi\r\nline é')]
+
+        # same rows whatever the chunks, even split inside a quoted value or a character
+        for size in [1, 2, 7, len(data)]:
+            parser = SparqlCsvParser(['s', 'label'])
+            rows = []
+            for i in range(0, len(data), size):
+                rows.extend(parser.feed(data[i:i + size]))
+            rows.extend(parser.close())
+            self.assertEqual(expected, rows)
+
+        parser = SparqlCsvParser(['s', 'missing'])
+        self.assertRaises(ValueError, parser.feed, data)
+        parser = SparqlCsvParser(['s'])
+        parser.feed(b's\r\n"http://x/1')
+        self.assertRaises(ValueError, parser.close)
+
+    def test_sparql_retries(self):
+        # nothing listening on the discard port: connection errors retried, then raised
+        server = SparqlDbInit('http://127.0.0.1:9/sparql', max_retries=2, retry_backoff=0.01)
+        with self.assertLogs('SparqlDb', level='WARNING') as logs:
+            self.assertRaises(ValueError, list, server.load_rows('SELECT * WHERE { ?s ?p ?o }', ['s']))
+        self.assertEqual(2, len([line for line in logs.output if 'retrying' in line]))
+
+    def test_sparql_retried_statuses(self):
+        # endpoint overloaded once: the json query is retried, then succeeds
+        statuses = [503, 200]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status = statuses.pop(0)
+                body = json.dumps({'head': {'vars': ['s']}, 'results': {'bindings': []}}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/sparql-results+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        endpoint = HTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=endpoint.serve_forever, daemon=True).start()
+        try:
+            server = SparqlDbInit(f'http://127.0.0.1:{endpoint.server_port}/sparql', max_retries=1,
+                                  retry_backoff=0.01)
+            with self.assertLogs('SparqlDb', level='WARNING') as logs:
+                results = server.load_data('SELECT * WHERE { ?s ?p ?o }')
+            self.assertEqual({'bindings': []}, results['results'])
+            self.assertIn('503', logs.output[0])
+            self.assertEqual([], statuses)
+        finally:
+            endpoint.shutdown()
+            endpoint.server_close()
+
+    # def tearDown(self):
+    #     pass
@@ -0,0 +1,92 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import logging
+from collections import namedtuple
+from datetime import date
+
+from src import web
+# same modules as the ones used by the app, for its database connection and builders settings
+from utils.api import dumps_resource
+from utils.db_connect import PostgresqlDB
+from utils.fhir_templates import fhir_datetime, get_builders, iter_chunks, set_builders, transform_column
+import observation
+import diagnostic_report
+import medicationAdministration
+import procedure
+import claim
+
+
+# (templates builder, fhirclient builder, search statements)
+BUILDERS = {
+    'labResults': (observation._iter_obs_templates, observation._iter_obs_fhirclient, 'obs_for_{}'),
+    'clinicalReports': (diagnostic_report._iter_report_templates, diagnostic_report._iter_report_fhirclient,
+                        'report_for_{}'),
+    'medicationAdministrations': (medicationAdministration._iter_med_templates,
+                                  medicationAdministration._iter_med_fhirclient, 'med_for_{}'),
+    'procedures': (procedure._iter_proc_templates, procedure._iter_proc_fhirclient, 'proc_for_{}'),
+    'pmsis': (claim._iter_pmsi_templates, claim._iter_pmsi_fhirclient, 'pmsis_for_{}'),
+}
+
+Row = namedtuple('Row', ['PATIENT_NUM', 'ENCOUNTER_NUM', 'INSTANCE_NUM', 'CONCEPT_CD', 'MODIFIER_CD', 'START_DATE',
+                         'NVAL_NUM', 'QUANTITY_NUM', 'UNITS_CD', 'VALUEFLAG_CD', 'OBSERVATION_BLOB'])
+
+
+class TemplatesTest(unittest.TestCase):
+    """differential tests: the templates builders must give the same json as the fhirclient builders"""
+
+    def _assert_same_resources(self, ressource, rows):
+        templates_builder, fhirclient_builder, _ = BUILDERS[ressource]
+        expected = [dumps_resource(resource) for resource in fhirclient_builder(rows)]
+        self.assertEqual(expected, [dumps_resource(resource) for resource in templates_builder(rows)])
+        return expected
+
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'reads the database of the in-process app')
+    def test_fetched_rows(self):
+        connect_to_db = PostgresqlDB()
+        for ressource, (_, _, statement) in BUILDERS.items():
+            nb_resources = 0
+            for kind, nums in [('patient', [1, 22, 2]), ('encounter', [1, 22, 2])]:
+                for num in nums:
+                    rows = connect_to_db.fetch_rows(statement.format(kind), num)
+                    nb_resources += len(self._assert_same_resources(ressource, rows))
+            self.assertLess(0, nb_resources, ressource)
+
+    def test_edge_cases(self):
+        rows = [
+            Row(1, 2, 3, 'BIO|1.0', '@', date(2020, 1, 2), 1.5, 2., 'g/l', 'H', 'text'),
+            Row(1, 2, 3, 'BIO|1', 'DIAG_TYPE', None, None, 0., None, None, None),
+            Row(1, 2, 4, 'PSL|DIAG|ACTE|1', '@', date(999, 12, 31), 0., None, '', '', ''),
+        ]
+        for ressource in BUILDERS:
+            self._assert_same_resources(ressource, rows)
+
+    @unittest.skipIf(os.environ.get('TEST_DOCKER_ADRESS'), 'reads the database of the in-process app')
+    def test_differential(self):
+        builders = get_builders()
+        rows = PostgresqlDB().fetch_rows('obs_for_patient', 1)
+        try:
+            set_builders('differential')
+            with self.assertLogs('fhir_templates', level=logging.WARNING) as logs:
+                logging.getLogger('fhir_templates').warning('checked')
+                resources = list(observation._iter_obs(iter(rows)))
+            self.assertEqual(['WARNING:fhir_templates:checked'], logs.output)
+            self.assertEqual(list(observation._iter_obs_fhirclient(rows)), resources)
+        finally:
+            set_builders(builders)
+        self.assertRaises(ValueError, set_builders, 'unknown')
+
+    def test_columns(self):
+        calls = []
+        self.assertEqual(['1', '2', '1'], transform_column([1, 2, 1], lambda value: calls.append(value) or str(value)))
+        self.assertEqual([1, 2], sorted(calls))
+        self.assertEqual([[0, 1], [2, 3], [4]], list(iter_chunks(iter(range(5)), 2)))
+
+        # resources built across several batches of rows
+        rows = [Row(1, num, num, f'BIO|{num % 3}', '@', date(2020, 1, num % 28 + 1), float(num), None, 'g/l', 'H', '')
+                for num in range(1200)]
+        self.assertEqual(1200, len(self._assert_same_resources('labResults', rows)))
+
+    def test_fhir_datetime(self):
+        self.assertEqual('2020-01-02T00:00:00', fhir_datetime(date(2020, 1, 2)))
+        self.assertIsNone(fhir_datetime(None))
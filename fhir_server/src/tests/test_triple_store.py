@@ -0,0 +1,110 @@
+import sys, os
+sys.path.append(os.path.abspath('..'))
+import unittest
+import gzip
+import requests
+import tempfile
+from pprint import pprint
+
+from .utils_test import get_test_client
+from src import web
+from src.utils.db_connect import EmbeddedSparqlDbInit
+from src.utils.triple_store import TripleStore, parse_ntriples, parse_select
+
+
+NTRIPLES = r'''# metadata dump
+<http://x/drug-1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/drug> .
+<http://x/drug-1> <http://www.w3.org/2004/02/skos/core#prefLabel> "Paracétamol \"500\" mg"@fr .
+<http://x/drug-1> <http://x/hasTarget> <http://x/code-1> .
+<http://x/code-1> <http://www.w3.org/2004/02/skos/core#prefLabel> "MDS:1"^^<http://www.w3.org/2001/XMLSchema#string> .
+<http://x/drug-2> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/drug> .
+<http://x/drug-2> <http://www.w3.org/2004/02/skos/core#prefLabel> "Line\nbreak" .
+<http://x/drug-2> <http://x/hasTarget> _:b0 .
+_:b0 <http://www.w3.org/2004/02/skos/core#prefLabel> "MDS:2" .
+<http://x/drug-2> <http://x/hasTarget> _:b0 .
+'''
+
+DRUG_QUERY = 'SELECT * WHERE { %s ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/drug> .\
+                                 ?s <http://www.w3.org/2004/02/skos/core#prefLabel> ?label .\
+                                 ?s <http://x/hasTarget> ?code .\
+                                 ?code <http://www.w3.org/2004/02/skos/core#prefLabel> ?codeLabel }'
+
+
+class TripleStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = None
+        self.docker_adress = os.environ.get('TEST_DOCKER_ADRESS', None)
+        if self.docker_adress is None:
+            self.app = get_test_client(self)
+        self.verbose = os.environ.get('TEST_VERBOSE', False)
+
+    def _get_route(self, api_path):
+        if self.docker_adress is not None:
+            res = requests.get(f'http://{self.docker_adress}{api_path}')
+            res.json = res.json()
+            return res
+        else:
+            return self.app.get(api_path)
+
+    def test_ntriples(self):
+        triples = list(parse_ntriples(NTRIPLES.splitlines()))
+        self.assertEqual(9, len(triples))
+        self.assertEqual('"Paracétamol "500" mg', triples[1][2])
+        self.assertEqual(('_:b0', 'http://www.w3.org/2004/02/skos/core#prefLabel', '"MDS:2'), triples[7])
+        with self.assertRaises(ValueError) as context:
+            list(parse_ntriples(['<http://x/a> <http://x/b> "c"', '']))
+        self.assertIn('line 1', str(context.exception))
+
+        store = TripleStore()
+        for triple in parse_ntriples(NTRIPLES.splitlines()):
+            store.add(*triple)
+        self.assertEqual(8, len(store))  # duplicates ignored
+
+    def test_select(self):
+        store = TripleStore()
+        for triple in parse_ntriples(NTRIPLES.splitlines()):
+            store.add(*triple)
+
+        variables, rows = store.select(DRUG_QUERY % '')
+        self.assertEqual(['s', 'label', 'code', 'codeLabel'], variables)
+        self.assertEqual([('http://x/drug-1', '"Paracétamol "500" mg', 'http://x/code-1', '"MDS:1'),
+                          ('http://x/drug-2', '"Line\nbreak', '_:b0', '"MDS:2')], sorted(rows))
+
+        # VALUES clause, keys not in the store included
+        variables, rows = store.select(DRUG_QUERY % 'VALUES ?codeLabel { "MDS:2" "MDS:3" }')
+        self.assertEqual(['codeLabel', 's', 'label', 'code'], variables)
+        self.assertEqual([('"MDS:2', 'http://x/drug-2', '"Line\nbreak', '_:b0')], rows)
+        variables, rows = store.select('select ?s ?other where { VALUES ?other { <http://x/unknown> } '
+                                       '?s a <http://x/drug> ; <http://x/hasTarget> <http://x/code-1> }')
+        self.assertEqual([('http://x/drug-1', 'http://x/unknown')], rows)
+        self.assertEqual(1, len(store.select('SELECT ?s WHERE { ?s ?p ?o } LIMIT 1')[1]))
+
+        for query in ['SELECT * WHERE { ?s ?p ?o FILTER (?o = "x") }', 'PREFIX x: <http://x/> SELECT * { ?s ?p ?o }',
+                      'SELECT * WHERE { ?s ?p }', 'SELECT * WHERE { ?s ?p ?o } ORDER BY ?s']:
+            self.assertRaises(ValueError, parse_select, query)
+
+    def test_embedded_db(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metadata.nt.gz')
+            with gzip.open(path, 'wt', encoding='utf-8') as f:
+                f.write(NTRIPLES)
+            server = EmbeddedSparqlDbInit(path, host='http://unused')
+
+        self.assertEqual([('MDS:1', 'Paracétamol "500" mg')],
+                         server.load_rows(DRUG_QUERY % 'VALUES ?s { <http://x/drug-1> }', ['codeLabel', 'label']))
+        results = server.load_data(DRUG_QUERY % 'VALUES ?s { <http://x/drug-2> }')
+        if self.verbose:
+            pprint(results)
+        self.assertEqual({'s': {'type': 'uri', 'value': 'http://x/drug-2'},
+                          'label': {'type': 'literal', 'value': 'Line\nbreak'},
+                          'code': {'type': 'bnode', 'value': 'b0'},
+                          'codeLabel': {'type': 'literal', 'value': 'MDS:2'}}, results['results']['bindings'][0])
+        self.assertRaises(ValueError, server.load_rows, DRUG_QUERY % '', ['missing'])
+        self.assertRaises(ValueError, server.load_data, 'SELECT * WHERE { ?s ?p ?o FILTER (?o = "x") }')
+        status = server.get_pool_status()
+        self.assertEqual(8, status['store']['triples'])
+        self.assertEqual(4, status['queries']['count'])
+
+    # def tearDown(self):
+    #     pass
@@ -1,5 +1,68 @@
 from datetime import datetime
+import json
+import os
 
 
 def datetime_fromisoformat(date_str):
-    return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
\ No newline at end of file
+    return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
+
+
+def get_test_client(test):
+    """
+    In-process client of the app: the flask app of web.py, or the ASGI app of web_async.py if TEST_ASGI is set
+
+    :param test: unittest.TestCase, the ASGI app being started for it and stopped at its end
+    :return: flask test client, or AsgiTestClient
+    """
+    if os.environ.get('TEST_ASGI'):
+        client = AsgiTestClient()
+        test.addCleanup(client.close)
+        return client
+    from src import web
+    return web.app.test_client()
+
+
+class AsgiTestClient:
+    """
+    Client of the ASGI app of web_async.py, its responses having the attributes of those of the flask test client
+    """
+
+    def __init__(self):
+        from starlette.testclient import TestClient
+        from src import web_async
+        # errors are answered as by a server, and the urls of the bundles are the ones of the flask test client
+        self.client = TestClient(web_async.app, base_url='http://localhost', raise_server_exceptions=False)
+        # as the flask test client, no Accept-Encoding unless given
+        del self.client.headers['Accept-Encoding']
+        # the startup and shutdown events (pools, metadata) are only run by the context manager
+        self.client.__enter__()
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+    def get(self, api_path, headers=None):
+        return AsgiResponse(self.client.get(api_path, headers=headers, stream=True, allow_redirects=False))
+
+    def post(self, api_path, json=None, headers=None):
+        return AsgiResponse(self.client.post(api_path, json=json, headers=headers, stream=True,
+                                             allow_redirects=False))
+
+
+class AsgiResponse:
+    """
+    Response of AsgiTestClient, with its body as sent (compressed or not) as the flask test client
+    """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.data = response.raw.read(decode_content=False)
+
+    def get_data(self, as_text=False):
+        return self.data.decode() if as_text else self.data
+
+    @property
+    def json(self):
+        if self.headers.get('Content-Type') != 'application/json':
+            return None
+        return json.loads(self.data)
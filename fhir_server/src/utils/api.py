@@ -0,0 +1,388 @@
+from decimal import Decimal
+import base64
+import datetime
+import json
+import zlib
+
+from utils.cache import etag_matches
+from utils.db_connect import get_pool_config
+
+
+# mimetypes of the responses, by value of the _stream and _format query parameters
+STREAM_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# default response settings, see the responses section of config.yaml
+RESPONSE_DEFAULTS = {
+    'json_encoder': 'json',  # json (standard library) or orjson (requires the orjson package)
+    'gzip_min_size': 1024,  # bytes, smaller responses are not compressed
+    'gzip_level': 6,  # 1 (fastest) to 9 (smallest)
+}
+
+_response_config = dict(RESPONSE_DEFAULTS)
+
+# number of ids of a batch request, and column of the ids by key of the batch request body
+MAX_BATCH_SIZE = 1000
+BATCH_COLUMNS = {
+    'patients': 'PATIENT_NUM',
+    'encounters': 'ENCOUNTER_NUM',
+}
+
+# number of resources in a page, if _cursor is given without _count, and maximum _count
+DEFAULT_PAGE_COUNT = 100
+MAX_PAGE_COUNT = 1000
+
+
+def set_response_config(response_config):
+    """
+    Select the json encoder and the compression of the responses
+
+    :param response_config: dict, responses section of the config, or None
+    """
+    response_config = get_pool_config(response_config or {}, RESPONSE_DEFAULTS)
+    if response_config['json_encoder'] == 'orjson':
+        import orjson
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        response_config['dumps'] = lambda data: orjson.dumps(data, default=_default, option=options).decode()
+    elif response_config['json_encoder'] == 'json':
+        response_config['dumps'] = _dumps_json
+    else:
+        raise ValueError(f"Unknown json encoder: {response_config['json_encoder']}")
+    _response_config.clear()
+    _response_config.update(response_config)
+
+
+def get_response_config():
+    """
+    :return: dict, settings of the responses
+    """
+    return {key: _response_config[key] for key in RESPONSE_DEFAULTS}
+
+
+def _default(value):
+    """
+    Serializable version of the values the json encoders do not handle, so that rows values can be used as they are
+
+    :param value: date, time, Decimal or numpy value
+    :return: str, float or python value
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if type(value).__module__ == 'numpy':
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _dumps_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), default=_default)
+
+
+_response_config['dumps'] = _dumps_json
+
+
+def dumps_resource(resource):
+    """
+    Serialize a resource with the selected json encoder, the standard one giving the same output as flask.jsonify
+
+    :param resource: resource as json
+    :return: str
+    """
+    return _response_config['dumps'](resource)
+
+
+def render_data(data, response_format='json'):
+    """
+    Body of a response
+
+    :param data: resource(s) as json
+    :param response_format: json, or ndjson for one resource per line: the items of a list, or the resources
+        of a searchset bundle
+    :return: bytes
+    """
+    if response_format == 'json':
+        return (dumps_resource(data) + '\n').encode('utf-8')
+    if isinstance(data, dict) and data.get('resourceType') == 'Bundle':
+        data = [entry['resource'] for entry in data['entry']]
+    elif not isinstance(data, list):
+        data = [data]
+    return ''.join(dumps_resource(resource) + '\n' for resource in data).encode('utf-8')
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Check if an Accept-Encoding header allows gzip
+
+    :param accept_encoding: value of the header, or None
+    :return: bool
+    """
+    accepted = {}
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        accepted[name.strip().lower()] = quality
+    return accepted.get('gzip', accepted.get('*', 0.)) > 0
+
+
+def use_gzip(accept_encoding, size):
+    """
+    Check if a response is compressed
+
+    :param accept_encoding: value of the Accept-Encoding header of the request, or None
+    :param size: size of the response body, None for a streamed response
+    :return: bool
+    """
+    return (size is None or size >= _response_config['gzip_min_size']) and accepts_gzip(accept_encoding)
+
+
+def gzip_etag(etag):
+    """
+    Strong ETag of the gzip version of a response
+
+    :param etag: str, quoted ETag of the uncompressed response
+    :return: str, quoted
+    """
+    return etag[:-1] + '-gzip"'
+
+
+def make_gzip_compressor():
+    """
+    :return: zlib compressor writing gzip data, without timestamp so that the output only depends on the input
+    """
+    return zlib.compressobj(_response_config['gzip_level'], zlib.DEFLATED, 31)
+
+
+def iter_gzip(chunks):
+    """
+    Compress a streamed body
+
+    :param chunks: iterable of str
+    :return: generator of bytes, gzip data
+    """
+    compressor = make_gzip_compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_body(body):
+    """
+    :param body: bytes
+    :return: bytes, gzip data
+    """
+    compressor = make_gzip_compressor()
+    return compressor.compress(body) + compressor.flush()
+
+
+def cached_response(cached, accept_encoding, if_none_match):
+    """
+    Response of a cached body, with an ETag, or 304 without body if the request has a matching If-None-Match
+    The body is compressed if the request accepts gzip, its ETag being then the one of the gzip version.
+
+    :param cached: utils.cache.CachedResponse
+    :param accept_encoding: value of the Accept-Encoding header of the request, or None
+    :param if_none_match: value of the If-None-Match header of the request, or None
+    :return: status code, body as bytes (None for 304), headers
+    """
+    compress = use_gzip(accept_encoding, len(cached.body))
+    headers = {'ETag': gzip_etag(cached.etag) if compress else cached.etag, 'Vary': 'Accept-Encoding'}
+    if etag_matches(if_none_match, headers['ETag']):
+        return 304, None, headers
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        return 200, gzip_body(cached.body), headers
+    return 200, cached.body, headers
+
+
+def stream_body(ressource_desc, first, resources, stream_format, accept_encoding, logger):
+    """
+    Body of a streamed response, the resources being written as they are built, either as a json array or as ndjson
+    (one resource per line), compressed if the request accepts gzip
+
+    The first resource is built before answering, so that an invalid request still gets an error code.
+    Errors happening afterwards can only interrupt the stream: they are logged and raised again, so that the server
+    drops the connection, without the end of the chunked body.
+
+    :param ressource_desc: str, description of the resources for the logs
+    :param first: first resource as json, or None if there is none
+    :param resources: generator of the next resources as json, closed at the end of the body
+    :param stream_format: 'json' or 'ndjson'
+    :param accept_encoding: value of the Accept-Encoding header of the request, or None
+    :param logger: logger of the app
+    :return: generator of the chunks of the body (str, or bytes if compressed), headers
+    """
+    def _generate():
+        try:
+            if first is None:
+                yield '[]\n' if stream_format == 'json' else ''
+                return
+            if stream_format == 'json':
+                yield '[' + dumps_resource(first)
+                for resource in resources:
+                    yield ',' + dumps_resource(resource)
+                yield ']\n'
+            else:
+                yield dumps_resource(first) + '\n'
+                for resource in resources:
+                    yield dumps_resource(resource) + '\n'
+        except Exception as e:
+            # the client must not take the truncated body as complete
+            logger.error(f"Stream interrupted for {ressource_desc} : {e}")
+            raise
+        finally:
+            resources.close()
+
+    if use_gzip(accept_encoding, None):
+        return iter_gzip(_generate()), {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+    return _generate(), {'Vary': 'Accept-Encoding'}
+
+
+def encode_page_key(key):
+    """
+    Encode a page key as an opaque url-safe token
+
+    :param key: tuple of str (dates), int and None (null columns), see PostgresqlDB.register_statement
+    :return: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_page_key(token):
+    """
+    Decode a page key encoded by encode_page_key
+
+    :param token: str
+    :return: tuple of str, int and None, checked against the statement by fetch_page
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid page token: {token}')
+    if not isinstance(key, list) or not key or \
+            not all(value is None or isinstance(value, (str, int)) and not isinstance(value, bool) for value in key):
+        raise ValueError(f'Invalid page token: {token}')
+    return tuple(key)
+
+
+def parse_page_args(args):
+    """
+    Read the paging parameters of a request: _count, and _cursor as given by the next link of the previous page
+
+    :param args: query parameters of the request, as a dict
+    :return: (count, page key) or None if no paging is requested
+    :raise: ValueError if the parameters are invalid
+    """
+    if '_count' not in args and '_cursor' not in args:
+        return None
+    count = int(args.get('_count', DEFAULT_PAGE_COUNT))
+    token = args.get('_cursor')
+    key = decode_page_key(token) if token is not None else None
+    if not 0 < count <= MAX_PAGE_COUNT:
+        raise ValueError(f'Invalid page size: {count}')
+    return count, key
+
+
+def parse_format_args(args, streamable=False, pageable=False):
+    """
+    Read the format parameters of a request: _format, _stream for the resources that can be streamed,
+    and the paging parameters for those that can be paged (see parse_page_args)
+
+    :param args: query parameters of the request, as a dict
+    :param streamable: if True, _stream is read
+    :param pageable: if True, _count and _cursor are read
+    :return: response format, stream format or None, (count, page key) or None
+    :raise: ValueError if the parameters are invalid
+    """
+    stream_format = args.get('_stream') if streamable else None
+    if stream_format is not None and stream_format not in STREAM_MIMETYPES:
+        raise ValueError(f'Invalid _stream: {stream_format}')
+    response_format = args.get('_format', 'json')
+    if response_format not in STREAM_MIMETYPES:
+        raise ValueError(f'Invalid _format: {response_format}')
+    page = parse_page_args(args) if pageable else None
+    if page is not None and stream_format is not None:
+        raise ValueError('_stream cannot be used with _count or _cursor')
+    # resources can only be written one per line without next link nor array around them
+    if response_format != 'json' and (page is not None or stream_format is not None):
+        raise ValueError('_format cannot be used with _stream, _count or _cursor')
+    return response_format, stream_format, page
+
+
+def searchset_bundle(resources, self_url, next_url=None):
+    """
+    Wrap a page of resources in a searchset bundle
+
+    :param resources: [resource as json]
+    :param self_url: url of the page
+    :param next_url: url of the next page, or None if there is none
+    :return: fhir.Bundle as json
+    """
+    links = [{'relation': 'self', 'url': self_url}]
+    if next_url is not None:
+        links.append({'relation': 'next', 'url': next_url})
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'link': links,
+        'entry': [{'resource': resource} for resource in resources],
+    }
+
+
+def parse_batch_args(body, kinds):
+    """
+    Read the body of a batch request, {"patients": [ids]} or {"encounters": [ids]}
+
+    :param body: body of the request, parsed as json
+    :param kinds: accepted keys of the body
+    :return: key of the body, [id as int] without duplicates
+    :raise: ValueError if the body is invalid
+    """
+    if not isinstance(body, dict) or len(body) != 1:
+        raise ValueError(f'Invalid batch: {body}')
+    kind, nums = next(iter(body.items()))
+    if kind not in kinds or not isinstance(nums, list) or len(nums) > MAX_BATCH_SIZE:
+        raise ValueError(f'Invalid batch: {body}')
+    parsed_nums = []
+    for num in nums:
+        if isinstance(num, bool) or not isinstance(num, (int, str)):
+            raise ValueError(f'Invalid id: {num}')
+        parsed_nums.append(int(num))
+    return kind, list(dict.fromkeys(parsed_nums))
+
+
+def parse_search_ids(value):
+    """
+    Read the ids of a search parameter, comma separated as in ?patient=1,2
+
+    :param value: str, or None if the parameter is not given
+    :return: [id as int] without duplicates
+    :raise: ValueError if the parameter is missing or invalid
+    """
+    if not value:
+        raise ValueError('Missing search parameter')
+    nums = [int(num) for num in value.split(',')]
+    if len(nums) > MAX_BATCH_SIZE:
+        raise ValueError(f'Too many ids: {len(nums)}')
+    return list(dict.fromkeys(nums))
+
+
+def batch_json(results):
+    """
+    Serializable results of a batch request, by id as str
+
+    :param results: {id as int: resource(s) as json}
+    :return: dict
+    """
+    return {str(num): result for num, result in results.items()}
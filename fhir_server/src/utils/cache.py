@@ -0,0 +1,203 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+import hashlib
+import json
+import logging
+import time
+
+from utils.db_connect import get_pool_config
+
+
+# default cache settings, see the cache section of config.yaml
+CACHE_DEFAULTS = {
+    'backend': 'memory',  # memory, redis or none
+    'ttl': 300.,  # s
+    'max_entries': 1000,
+    'max_bytes': 100 * 1024 * 1024,
+    'redis_url': 'redis://localhost:6379/0',
+}
+
+# a cached response: body as bytes, its mimetype and its strong ETag (quoted)
+CachedResponse = namedtuple('CachedResponse', ['body', 'mimetype', 'etag'])
+
+
+def make_etag(body):
+    """
+    Strong ETag of a response, derived from its content
+
+    :param body: bytes
+    :return: str, quoted
+    """
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header against an ETag (weak comparison, as required for If-None-Match)
+
+    :param if_none_match: value of the header, or None
+    :param etag: str, quoted
+    :return: bool
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def make_cache_key(endpoint, view_args, query_string):
+    """
+    Cache key of a GET request: its route, its ids and its query parameters
+
+    :param endpoint: name of the route
+    :param view_args: {name: value} of the path parameters
+    :param query_string: str
+    :return: str
+    """
+    return endpoint + ':' + json.dumps(view_args, sort_keys=True, separators=(',', ':')) + '?' + query_string
+
+
+def get_cache(cache_config):
+    """
+    Create the response cache described by the cache section of the config
+
+    :param cache_config: dict, or None
+    :return: MemoryCache, RedisCache or None if the cache is disabled
+    """
+    cache_config = get_pool_config(cache_config or {}, CACHE_DEFAULTS)
+    if cache_config['backend'] == 'memory':
+        return MemoryCache(cache_config['ttl'], cache_config['max_entries'], cache_config['max_bytes'])
+    if cache_config['backend'] == 'redis':
+        return RedisCache(cache_config['ttl'], cache_config['redis_url'])
+    if cache_config['backend'] == 'none':
+        return None
+    raise ValueError(f"Unknown cache backend: {cache_config['backend']}")
+
+
+class MemoryCache:
+    """
+    In-process LRU cache of responses, bounded in number of entries and in bytes, entries expiring after ttl seconds
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes, clock=time.monotonic):
+        """
+        :param ttl: float, s
+        :param max_entries: int
+        :param max_bytes: int, total size of the cached bodies
+        :param clock: function giving the current time in seconds
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries = OrderedDict()  # {key: (expiry time, CachedResponse)}, least recently used first
+        self._nb_bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: CachedResponse or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, response):
+        """
+        :param key: str
+        :param response: CachedResponse, not cached if bigger than max_bytes
+        """
+        if len(response.body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + self.ttl, response)
+            self._nb_bytes += len(response.body)
+            while len(self._entries) > self.max_entries or self._nb_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        with self._lock:
+            return {'backend': 'memory', 'entries': len(self._entries), 'bytes': self._nb_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self._nb_bytes -= len(response.body)
+
+
+class RedisCache:
+    """
+    Response cache shared between processes, in a redis server (requires the redis package)
+    Entries expire after ttl seconds, the size of the cache is bounded by the redis server settings (maxmemory).
+    Redis errors are logged and treated as cache misses.
+    """
+
+    def __init__(self, ttl, redis_url, client=None, prefix='fhir_api:'):
+        """
+        :param ttl: float, s
+        :param redis_url: url of the redis server
+        :param client: redis client, or any object with the get(key) and set(key, value, px=ms) methods of redis.Redis
+        :param prefix: prefix of the keys
+        """
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(redis_url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.logger = logging.getLogger('RedisCache')
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: CachedResponse or None
+        """
+        try:
+            data = self.client.get(self.prefix + key)
+        except Exception as err:
+            self.logger.warning(str(err))
+            return None
+        if data is None:
+            return None
+        etag, mimetype, body = data.split(b'\n', 2)
+        return CachedResponse(body, mimetype.decode(), etag.decode())
+
+    def set(self, key, response):
+        """
+        :param key: str
+        :param response: CachedResponse
+        """
+        data = response.etag.encode() + b'\n' + response.mimetype.encode() + b'\n' + response.body
+        try:
+            self.client.set(self.prefix + key, data, px=int(self.ttl * 1000))
+        except Exception as err:
+            self.logger.warning(str(err))
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        return {'backend': 'redis', 'ttl': self.ttl}
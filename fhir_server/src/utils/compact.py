@@ -0,0 +1,406 @@
+from array import array
+from collections.abc import Mapping
+import json
+import mmap
+import os
+import time
+import uuid
+import zlib
+
+
+# shared file: SHARED_MAGIC, a json header line (version, publication, layout of the maps), then the arrays of the
+# maps, aligned on 8 bytes, mapped in memory by the processes reading it
+SHARED_MAGIC = b'FHIR_METADATA_SHARED\n'
+SHARED_VERSION = 2
+
+
+class StringTable:
+    """
+    Strings stored once in a single utf-8 buffer, the IRIs as the id of their namespace and their local name,
+    shared by the maps of a metadata value
+    """
+
+    def __init__(self):
+        self._ids = {}  # {str: id}, while the table is built
+        self.namespaces = ['']
+        self._namespace_ids = {'': 0}
+        self._buffer = bytearray()
+        self._offsets = array('I', [0])  # local name of string i: buffer[offsets[i]:offsets[i + 1]]
+        self._namespace = array('I')  # namespace id of each string
+
+    def split(self, value):
+        """
+        :param value: str
+        :return: namespace, local name (namespace '' for the strings which are not IRIs)
+        """
+        if '://' not in value:
+            return '', value
+        end = max(value.rfind('#'), value.rfind('/')) + 1
+        return value[:end], value[end:]
+
+    def add(self, value):
+        """
+        :param value: str
+        :return: int, id of the string
+        """
+        string_id = self._ids.get(value)
+        if string_id is None:
+            namespace, local = self.split(value)
+            namespace_id = self._namespace_ids.get(namespace)
+            if namespace_id is None:
+                namespace_id = self._namespace_ids[namespace] = len(self.namespaces)
+                self.namespaces.append(namespace)
+            string_id = self._ids[value] = len(self._namespace)
+            self._namespace.append(namespace_id)
+            self._buffer += local.encode('utf-8')
+            self._offsets.append(len(self._buffer))
+        return string_id
+
+    def freeze(self):
+        """
+        Drop the index used to add strings, the table being read-only afterwards
+        """
+        self._ids = None
+        self._buffer = bytes(self._buffer)
+
+    def get(self, string_id):
+        """
+        :param string_id: int
+        :return: str
+        """
+        return self.namespaces[self._namespace[string_id]] + \
+            str(self._buffer[self._offsets[string_id]:self._offsets[string_id + 1]], 'utf-8')
+
+    def find(self, value):
+        """
+        :param value: str
+        :return: (namespace id, local name as utf-8), namespace id None if no string has its namespace
+        """
+        namespace, local = self.split(value)
+        return self._namespace_ids.get(namespace), local.encode('utf-8')
+
+    def equals(self, string_id, namespace_id, local):
+        """
+        :param string_id: int
+        :param namespace_id: int, see find
+        :param local: bytes, see find
+        :return: bool, True if the string is the one given by find
+        """
+        start = self._offsets[string_id]
+        return self._namespace[string_id] == namespace_id and \
+            self._offsets[string_id + 1] - start == len(local) and self._buffer[start:start + len(local)] == local
+
+    def __len__(self):
+        return len(self._namespace)
+
+    def __getstate__(self):
+        # arrays mapped from a shared file are copied
+        return dict(self.__dict__, _buffer=bytes(self._buffer), _offsets=_to_array('I', self._offsets),
+                    _namespace=_to_array('I', self._namespace))
+
+
+def _shape(value):
+    """
+    :param value: str or tuple of them (nested)
+    :return: None for a str, tuple of the shapes of the elements of a tuple
+    :raise TypeError: for other values
+    """
+    if isinstance(value, str):
+        return None
+    if isinstance(value, tuple):
+        return tuple(_shape(element) for element in value)
+    raise TypeError(f'{type(value).__name__} values cannot be compacted')
+
+
+def _width(shape):
+    return 1 if shape is None else sum(_width(element) for element in shape)
+
+
+def _flatten(value):
+    if isinstance(value, str):
+        yield value
+    else:
+        for element in value:
+            yield from _flatten(element)
+
+
+class CompactMap(Mapping):
+    """
+    Read-only map of strings to strings (or tuples of strings of the same shape), stored as arrays of the ids of
+    a StringTable, looked up in an open addressing hash table. Its keys and values are decoded at each access.
+    """
+
+    def __init__(self, mapping, strings):
+        """
+        :param mapping: dict
+        :param strings: StringTable, being built
+        :raise TypeError: if the map cannot be compacted
+        """
+        shapes = {_shape(value) for value in mapping.values()}
+        if len(shapes) > 1:
+            raise TypeError('values of different shapes cannot be compacted')
+        if not all(isinstance(key, str) for key in mapping):
+            raise TypeError('only str keys can be compacted')
+        self._strings = strings
+        self._shape = shapes.pop() if shapes else None
+        self._width = _width(self._shape)
+        self._keys = array('I', (strings.add(key) for key in mapping))
+        self._values = array('I', (strings.add(element) for value in mapping.values()
+                                   for element in _flatten(value)))
+        size = 8
+        while size < 2 * len(mapping):
+            size *= 2
+        self._slots = array('i', [-1]) * size
+        for index, key in enumerate(mapping):
+            slot = zlib.crc32(key.encode('utf-8')) & (size - 1)
+            while self._slots[slot] >= 0:
+                slot = (slot + 1) & (size - 1)
+            self._slots[slot] = index
+
+    def _find(self, key):
+        """
+        :return: index of a key, -1 if not found
+        """
+        if not isinstance(key, str):
+            return -1
+        namespace_id, local = self._strings.find(key)
+        if namespace_id is None:
+            return -1
+        mask = len(self._slots) - 1
+        slot = zlib.crc32(key.encode('utf-8')) & mask
+        while True:
+            index = self._slots[slot]
+            if index < 0 or self._strings.equals(self._keys[index], namespace_id, local):
+                return index
+            slot = (slot + 1) & mask
+
+    def _value(self, index):
+        if self._shape is None:
+            return self._strings.get(self._values[index])
+        ids = iter(self._values[index * self._width:(index + 1) * self._width])
+        return self._build(self._shape, ids)
+
+    def _build(self, shape, ids):
+        if shape is None:
+            return self._strings.get(next(ids))
+        return tuple(self._build(element, ids) for element in shape)
+
+    def __getitem__(self, key):
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._value(index)
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        return default if index < 0 else self._value(index)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return (self._strings.get(string_id) for string_id in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f'CompactMap({len(self)} entries)'
+
+    def __getstate__(self):
+        # arrays mapped from a shared file are copied
+        return dict(self.__dict__, _keys=_to_array('I', self._keys), _values=_to_array('I', self._values),
+                    _slots=_to_array('i', self._slots))
+
+
+def _to_array(typecode, values):
+    if isinstance(values, array):
+        return values
+    result = array(typecode)
+    result.frombytes(values.cast('B'))
+    return result
+
+
+def compact(value, strings=None):
+    """
+    Compact the dicts of a metadata value (a dict, or tuples of them) in CompactMaps sharing a StringTable,
+    the dicts which cannot be compacted being kept as is
+
+    :param value: metadata value
+    :param strings: StringTable, a new one if None
+    :return: value with CompactMaps instead of dicts
+    """
+    if strings is None:
+        strings = StringTable()
+        value = compact(value, strings)
+        strings.freeze()
+        return value
+    if type(value) is dict:
+        try:
+            return CompactMap(value, strings)
+        except TypeError:
+            return value
+    if type(value) is tuple:
+        return tuple(compact(element, strings) for element in value)
+    return value
+
+
+def to_json(value):
+    """
+    Encode a metadata value as json, tuples and maps (CompactMaps included) being tagged so that they are decoded
+    as such: the files written by the service are read without executing any code, unlike pickle
+
+    :param value: metadata value, made of maps, tuples, lists, str, numbers, bools and None
+    :return: value which can be serialized by json.dumps
+    :raise TypeError: for other values
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, Mapping):
+        return {'map': [[to_json(key), to_json(element)] for key, element in value.items()]}
+    if isinstance(value, tuple):
+        return {'tuple': [to_json(element) for element in value]}
+    if isinstance(value, list):
+        return [to_json(element) for element in value]
+    raise TypeError(f'{type(value).__name__} values cannot be saved')
+
+
+def from_json(value):
+    """
+    :param value: value encoded by to_json, read by json.loads
+    :return: metadata value, maps as dicts
+    :raise ValueError: if the value was not encoded by to_json
+    """
+    if isinstance(value, list):
+        return [from_json(element) for element in value]
+    if not isinstance(value, dict):
+        return value
+    try:
+        if 'tuple' in value:
+            return tuple(from_json(element) for element in value['tuple'])
+        if 'map' in value:
+            return {from_json(key): from_json(element) for key, element in value['map']}
+    except TypeError:
+        raise ValueError('invalid value')
+    raise ValueError('invalid value')
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_shared(path, maps):
+    """
+    Write metadata values in a shared file, replaced at once so that processes reading it never see a partial file.
+    The arrays of the CompactMaps are written as is, the other values as json (see to_json).
+
+    :param path: str
+    :param maps: {name: metadata value}
+    :return: dict, header of the file
+    """
+    sections = []
+    size = 0
+    tables = {}  # {id(StringTable): index}
+    table_layouts = []
+
+    def _section(data):
+        nonlocal size
+        data = memoryview(data).cast('B')
+        sections.append((size, data))
+        layout = [size, len(data)]
+        size = _align(size + len(data))
+        return layout
+
+    def _table(strings):
+        if id(strings) not in tables:
+            tables[id(strings)] = len(table_layouts)
+            table_layouts.append({'namespaces': strings.namespaces, 'buffer': _section(strings._buffer),
+                                  'offsets': _section(strings._offsets), 'namespace': _section(strings._namespace)})
+        return tables[id(strings)]
+
+    def _layout(value):
+        if isinstance(value, CompactMap):
+            return {'map': _table(value._strings), 'shape': value._shape, 'keys': _section(value._keys),
+                    'values': _section(value._values), 'slots': _section(value._slots)}
+        if type(value) is tuple:
+            return {'tuple': [_layout(element) for element in value]}
+        return {'json': _section(json.dumps(to_json(value)).encode())}
+
+    layouts = {name: _layout(value) for name, value in maps.items()}
+    published_at = time.time()
+    header = {'version': SHARED_VERSION, 'id': uuid.uuid4().hex, 'pid': os.getpid(), 'published_at': published_at,
+              'created_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(published_at)), 'size': size,
+              'tables': table_layouts, 'maps': layouts}
+    start = SHARED_MAGIC + json.dumps(header).encode() + b'\n'
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(start + bytes(_align(len(start)) - len(start)))
+        for offset, data in sections:
+            f.write(bytes(_align(len(start)) + offset - f.tell()))
+            f.write(data)
+        f.write(bytes(_align(len(start)) + size - f.tell()))
+    os.replace(tmp_path, path)
+    return header
+
+
+def read_shared(path):
+    """
+    Map a shared file in memory: the arrays of its CompactMaps are read from the file, shared with the other
+    processes mapping it, without copy
+
+    :param path: str
+    :return: header as a dict, {name: metadata value}
+    :raise ValueError: if the file is not a shared file of the current version
+    :raise OSError: if the file cannot be read
+    """
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError('empty file')
+    if mapped[:len(SHARED_MAGIC)] != SHARED_MAGIC:
+        raise ValueError('not a metadata shared file')
+    end = mapped.find(b'\n', len(SHARED_MAGIC))
+    try:
+        header = json.loads(mapped[len(SHARED_MAGIC):end].decode())
+    except ValueError:
+        raise ValueError('invalid header')
+    if header.get('version') != SHARED_VERSION:
+        raise ValueError(f"version {header.get('version')}, expected {SHARED_VERSION}")
+    data = memoryview(mapped)[_align(end + 1):]
+    if len(data) < header['size']:
+        raise ValueError('truncated file')
+
+    def _section(layout, typecode='B'):
+        offset, length = layout
+        return data[offset:offset + length].cast(typecode)
+
+    def _tuple_shape(shape):
+        return None if shape is None else tuple(_tuple_shape(element) for element in shape)
+
+    tables = []
+    for layout in header['tables']:
+        strings = StringTable()
+        strings._ids = None
+        strings.namespaces = layout['namespaces']
+        strings._namespace_ids = {namespace: index for index, namespace in enumerate(strings.namespaces)}
+        strings._buffer = _section(layout['buffer'])
+        strings._offsets = _section(layout['offsets'], 'I')
+        strings._namespace = _section(layout['namespace'], 'I')
+        tables.append(strings)
+
+    def _value(layout):
+        if 'map' in layout:
+            value = CompactMap.__new__(CompactMap)
+            value._strings = tables[layout['map']]
+            value._shape = _tuple_shape(layout['shape'])
+            value._width = _width(value._shape)
+            value._keys = _section(layout['keys'], 'I')
+            value._values = _section(layout['values'], 'I')
+            value._slots = _section(layout['slots'], 'i')
+            return value
+        if 'tuple' in layout:
+            return tuple(_value(element) for element in layout['tuple'])
+        return from_json(json.loads(str(_section(layout['json']), 'utf-8')))
+
+    return header, {name: _value(layout) for name, layout in header['maps'].items()}
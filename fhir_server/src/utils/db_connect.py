@@ -1,8 +1,394 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool
 from pymantic import sparql
+from requests.adapters import HTTPAdapter
+import psycopg2
 import pandas as pd
+import requests
+from collections import namedtuple
+from threading import Lock
+from uuid import uuid4
+import codecs
+import csv
 import logging
+import re
+import time
+
+from utils.triple_store import load_store, term_json, term_value
+
+
+# python type of the columns fetched by PostgresqlDbInit.fetch_rows, whatever their sql type
+COLUMN_TYPES = {
+    'PATIENT_NUM': int,
+    'ENCOUNTER_NUM': int,
+    'INSTANCE_NUM': int,
+    'UPLOAD_ID': int,
+    'NVAL_NUM': float,
+    'QUANTITY_NUM': float,
+}
+
+# postgres type oids already returned with the right python type by psycopg2
+_NATIVE_TYPE_CODES = {
+    int: {20, 21, 23},  # int8, int2, int4
+    float: {700, 701},  # float4, float8
+}
+
+
+# number of rows fetched at once from a server-side cursor
+STREAM_BATCH_SIZE = 500
+
+# $1, $2, ... placeholders of the registered statements
+_PLACEHOLDER_REGEX = re.compile(r'\$(\d+)')
+
+# suffixes of the keyset paginated variants of a statement: for the resources whose page key columns are all set,
+# then for those with a null page key column, paged after the others
+PAGE_SUFFIX = '_page'
+PAGE_NULLS_SUFFIX = '_page_nulls'
+
+# paginated statement: SELECT {columns} FROM ... WHERE {conditions}, its ORDER BY (by default "START_DATE") then
+# sorting the rows of each resource
+_STATEMENT_REGEX = re.compile(r'^\s*SELECT\s(.*?)\s+(FROM\s.*\sWHERE)\s(.*?)(\s+ORDER BY\s[^)]*)?\s*$', re.DOTALL)
+
+# keyset paginated variant of a statement: the resources (groups of rows) are sorted by their page key descending,
+# made of the page_group columns ({key}). The key is compared on the columns themselves, in the WHERE clause of the
+# statement ({from_where}), so that an index on the columns of its conditions then on the page_group columns seeks
+# the rows before the page key ({cursor} placeholders) in order: the subquery gives the key of the last of the
+# {count} next resources, the page holding the rows between both keys.
+# The page key is returned in the "PAGE_KEY_<i>" columns ({page_key}), the dates as text to accept 'infinity'.
+_PAGE_TEMPLATE = """
+    SELECT {columns}, {page_key}
+    {from_where} AND {not_null} AND ({key}) < ({cursor}) AND ({key}) >= (
+        SELECT * FROM (
+            SELECT DISTINCT {key}
+            {from_where} AND {not_null} AND ({key}) < ({cursor})
+            ORDER BY {key_desc} LIMIT {count}) AS page_keys
+        ORDER BY {key} LIMIT 1)
+    ORDER BY {key_desc}, {order} """
+
+# variant for the resources with a null page_group column: they are sorted by their page key descending, nulls last,
+# the key being compared column by column ({after_cursor}, {after_last}) since rows with nulls cannot be compared
+# at once. These resources are expected to be few, and are found by the IS NULL conditions ({any_null}).
+_PAGE_NULLS_TEMPLATE = """
+    SELECT base.*, {page_key}
+    FROM (
+        SELECT {columns}
+        {from_where} AND ({any_null})) AS base, (
+        SELECT * FROM (
+            SELECT DISTINCT {key}
+            {from_where} AND ({any_null}) AND {after_cursor}
+            ORDER BY {key_desc} LIMIT {count}) AS page_keys
+        ORDER BY {key_asc} LIMIT 1) AS page_last
+    WHERE {after_cursor_base} AND NOT {after_last}
+    ORDER BY {key_desc_base}, {order} """
+
+# rows of a resource, by default
+PAGE_GROUP = ('"START_DATE"', '"INSTANCE_NUM"')
+
+# page key columns: "START_DATE" given as text (timestamp), the other columns as bigint
+_PAGE_DATE_COLUMN = '"START_DATE"'
+_BIGINT_MAX = 9223372036854775807
+
+
+def _page_key_cast(column):
+    """
+    :param column: page_group column, quoted
+    :return: sql cast of its placeholder
+    """
+    return '::text::timestamp' if column == _PAGE_DATE_COLUMN else '::bigint'
+
+
+def _after_key(columns, cursor):
+    """
+    :param columns: sql expressions of the page key columns
+    :param cursor: sql expressions of the page key values, possibly null
+    :return: sql condition of the rows strictly after the page key, sorted descending nulls last
+    """
+    conditions = []
+    for idx, (column, value) in enumerate(zip(columns, cursor)):
+        equal = [f'{previous} IS NOT DISTINCT FROM {previous_value} AND '
+                 for previous, previous_value in zip(columns[:idx], cursor[:idx])]
+        conditions.append(f"({''.join(equal)}{value} IS NOT NULL AND ({column} < {value} OR {column} IS NULL))")
+    return f"({' OR '.join(conditions)})"
+
+
+def make_page_statements(sql_query, page_group):
+    """
+    Build the keyset paginated variants of a statement
+
+    :param sql_query: sql query, SELECT ... FROM ... WHERE ..., with $1, $2, ... as parameters placeholders
+    :param page_group: columns identifying the rows of a same resource, "START_DATE" or integer columns
+    :return: sql queries of the resources with a complete page key and of those with a null page key column,
+        with the placeholders of the page key and of the number of resources after those of sql_query
+    :raise ValueError: if the query has no WHERE clause
+    """
+    match = _STATEMENT_REGEX.match(sql_query)
+    if match is None:
+        raise ValueError(f'Paginated statements must be SELECT ... FROM ... WHERE ...: {sql_query}')
+    columns, from_where, conditions, order = match.group(1, 2, 3, 4)
+    order = order.strip()[len('ORDER BY'):].strip() if order else '"START_DATE"'
+    from_where = f'{from_where} ({conditions})'
+    nb_params = max([int(idx) for idx in _PLACEHOLDER_REGEX.findall(sql_query)], default=0)
+    names = [f'"PAGE_KEY_{idx}"' for idx in range(1, len(page_group) + 1)]
+    cursor = [f'${nb_params + idx}{_page_key_cast(column)}' for idx, column in enumerate(page_group, 1)]
+    base = [f'base.{column}' for column in page_group]
+    last = [f'page_last.{column}' for column in page_group]
+
+    def _page_key(key):
+        return ', '.join(f'{expression}{"::text" if column == _PAGE_DATE_COLUMN else ""} AS {name}'
+                         for column, expression, name in zip(page_group, key, names))
+
+    page_statement = _PAGE_TEMPLATE.format(
+        columns=columns, from_where=from_where, page_key=_page_key(page_group),
+        not_null=' AND '.join(f'{column} IS NOT NULL' for column in page_group),
+        key=', '.join(page_group), cursor=', '.join(cursor), count=f'${nb_params + len(page_group) + 1}',
+        key_desc=', '.join(f'{column} DESC' for column in page_group), order=order)
+    nulls_statement = _PAGE_NULLS_TEMPLATE.format(
+        columns=columns, from_where=from_where, page_key=_page_key(base),
+        any_null=' OR '.join(f'{column} IS NULL' for column in page_group),
+        key=', '.join(page_group), count=f'${nb_params + len(page_group) + 1}',
+        after_cursor=_after_key(page_group, cursor), after_cursor_base=_after_key(base, cursor),
+        after_last=_after_key(base, last),
+        key_desc=', '.join(f'{column} DESC NULLS LAST' for column in page_group),
+        key_asc=', '.join(f'{column} NULLS FIRST' for column in page_group),
+        key_desc_base=', '.join(f'{column} DESC NULLS LAST' for column in base), order=order)
+    return page_statement, nulls_statement
+
+
+def first_page_key(page_group):
+    """
+    :param page_group: page_group of a statement
+    :return: page key before the first resource
+    """
+    return tuple('infinity' if column == _PAGE_DATE_COLUMN else _BIGINT_MAX for column in page_group)
+
+
+def check_page_key(page_group, key):
+    """
+    :param page_group: page_group of a statement
+    :param key: page key given by a client
+    :raise ValueError: if the key is not a page key of the statement
+    """
+    if len(key) != len(page_group) or any(
+            value is not None and (not isinstance(value, str if column == _PAGE_DATE_COLUMN else int) or
+                                   isinstance(value, bool))
+            for column, value in zip(page_group, key)):
+        raise ValueError(f'Invalid page key: {key}')
+
+
+def page_statement(name, key, count):
+    """
+    Paginated variant of a statement to run for a page, see PostgresqlDbInit.fetch_page
+
+    :param name: name of the statement
+    :param key: page key of the last resource of the previous page, checked, or None for the first page
+    :param count: number of resources to fetch
+    :return: name of the paginated statement, its parameters after those of the statement
+    """
+    if key is None:
+        return name + PAGE_SUFFIX, (*first_page_key(PostgresqlDbInit.page_groups[name]), count)
+    if None in key:
+        return name + PAGE_NULLS_SUFFIX, (*key, count)
+    return name + PAGE_SUFFIX, (*key, count)
+
+
+def nb_page_keys(rows):
+    """
+    :param rows: [namedtuple] fetched by a paginated statement
+    :return: number of resources (distinct page keys) of the rows
+    """
+    key_indexes = [idx for idx, field in enumerate(rows[0]._fields) if field.startswith('PAGE_KEY_')] if rows else []
+    return len({tuple(row[idx] for idx in key_indexes) for row in rows})
+
+
+# default settings of the connection pools, overloaded by the postgres_db and sparql_db config sections
+POSTGRES_POOL_DEFAULTS = {
+    'pool_size': 10,  # connections kept open
+    'max_overflow': 10,  # connections opened on top of pool_size under load
+    'pool_timeout': 10.,  # seconds to wait for a connection before failing
+    'pool_recycle': 1800,  # seconds after which a connection is replaced
+    'pool_pre_ping': True,  # check connections before using them
+    'statement_timeout': 60000,  # milliseconds, 0 to disable
+}
+SPARQL_POOL_DEFAULTS = {
+    'pool_maxsize': 10,  # keep-alive connections to the sparql endpoint
+    'connect_timeout': 5.,  # seconds
+    'read_timeout': 60.,  # seconds
+    'max_retries': 0,  # retries on connection errors, timeouts and SPARQL_RETRY_STATUSES
+    'retry_backoff': 0.5,  # seconds before the first retry, doubled at each retry
+}
+
+# http statuses of an overloaded or restarting sparql endpoint, for which a query is retried
+SPARQL_RETRY_STATUSES = (502, 503, 504)
+
+# bytes read at once from a sparql response
+SPARQL_CHUNK_SIZE = 64 * 1024
+
+
+def _to_bool(value):
+    """
+    Read a boolean config value, which may come from an environment variable as a string
+
+    :param value: bool or str
+    :return: bool
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', '1')
+    return bool(value)
+
+
+def get_pool_config(db_config, defaults):
+    """
+    Get the pool settings of a config section, typed as their default value
+
+    :param db_config: dict, config section (postgres_db or sparql_db)
+    :param defaults: dict, default pool settings
+    :return: dict
+    """
+    pool_config = {}
+    for key, default in defaults.items():
+        value = db_config.get(key)
+        if value is None:
+            pool_config[key] = default
+        elif isinstance(default, bool):
+            pool_config[key] = _to_bool(value)
+        else:
+            pool_config[key] = type(default)(value)
+    return pool_config
+
+
+def get_engine_options(db_config):
+    """
+    Build the sqlalchemy engine options from the postgres_db config section
+
+    :param db_config: dict
+    :return: dict, usable as SQLALCHEMY_ENGINE_OPTIONS
+    """
+    pool_config = get_pool_config(db_config, POSTGRES_POOL_DEFAULTS)
+    options = {key: pool_config[key] for key in ['pool_size', 'max_overflow', 'pool_timeout',
+                                                 'pool_recycle', 'pool_pre_ping']}
+    if pool_config['statement_timeout']:
+        options['connect_args'] = {'options': f"-c statement_timeout={pool_config['statement_timeout']}"}
+    return options
+
+
+class TimingStats:
+    """
+    Thread-safe count, total and max of durations
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        """
+        :param duration: float, in seconds
+        """
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+
+    def as_json(self):
+        """
+        :return: dict, durations in milliseconds
+        """
+        with self._lock:
+            return {
+                'count': self.count,
+                'total_ms': round(self.total * 1000, 3),
+                'mean_ms': round(self.total * 1000 / self.count, 3) if self.count else 0.,
+                'max_ms': round(self.max * 1000, 3),
+            }
+
+
+def make_row_type(name, columns):
+    """
+    Build the namedtuple type of the rows of a statement, and the converters to apply to them
+
+    :param name: name of the statement
+    :param columns: [(column name, postgres type oid)]
+    :return: namedtuple type, [(column index, converter)]
+    """
+    row_type = namedtuple(name + '_row', [column[0] for column in columns], rename=True)
+    converters = []
+    for idx, (column_name, type_code) in enumerate(columns):
+        column_type = COLUMN_TYPES.get(column_name)
+        if column_type is not None and type_code not in _NATIVE_TYPE_CODES[column_type]:
+            converters.append((idx, column_type))
+    return row_type, converters
+
+
+def split_page(rows, count):
+    """
+    Keep the rows of the first `count` resources of rows fetched by a paginated statement
+
+    :param rows: [namedtuple], with the PAGE_KEY_<i> columns, sorted by them
+    :param count: number of resources in the page
+    :return: [namedtuple], page key of the last resource if there are more rows else None
+    """
+    page_rows = []
+    last_key = None
+    nb_keys = 0
+    key_indexes = [idx for idx, field in enumerate(rows[0]._fields) if field.startswith('PAGE_KEY_')] if rows else []
+    for row in rows:
+        row_key = tuple(row[idx] for idx in key_indexes)
+        if row_key != last_key:
+            nb_keys += 1
+            if nb_keys > count:
+                return page_rows, last_key
+            last_key = row_key
+        page_rows.append(row)
+    return page_rows, None
+
+
+def group_rows(rows, column, keys):
+    """
+    Group the rows fetched by a batch statement by the value of one of their columns, keeping their order
+
+    :param rows: iterable of namedtuple
+    :param column: name of the column holding the key of each row
+    :param keys: keys of the batch, all present in the result even without rows
+    :return: {key: [namedtuple]}
+    """
+    groups = {key: [] for key in keys}
+    for row in rows:
+        groups.setdefault(getattr(row, column), []).append(row)
+    return groups
+
+
+def make_row(record, row_type, converters):
+    """
+    Build a typed namedtuple from a fetched record
+
+    :param record: tuple, as fetched by the cursor
+    :param row_type: namedtuple type of the row
+    :param converters: [(column index, converter)] to apply on non null values
+    :return: namedtuple
+    """
+    if converters:
+        record = list(record)
+        for idx, converter in converters:
+            if record[idx] is not None:
+                record[idx] = converter(record[idx])
+    return row_type._make(record)
+
+
+def make_rows(records, row_type, converters):
+    """
+    Build typed namedtuples from fetched records
+
+    :param records: [tuple], as fetched by the cursor
+    :param row_type: namedtuple type of the rows
+    :param converters: [(column index, converter)] to apply on non null values
+    :return: [namedtuple]
+    """
+    if not converters:
+        return [row_type._make(record) for record in records]
+    return [make_row(record, row_type, converters) for record in records]
 
 
 class PostgresqlDB:
@@ -16,17 +402,53 @@ class PostgresqlDB:
     def __getattr__(self, name):
         return getattr(self.instance, name)
 
+    @staticmethod
+    def register_statement(name, sql_query, page_group=None):
+        """
+        Register a named statement, usable through fetch_rows once the db is initialized
+
+        If page_group is given, keyset paginated variants are also registered, usable through fetch_page.
+        The statement must then be a SELECT ... FROM ... WHERE ..., selecting "START_DATE" and the page_group columns.
+
+        :param name: name of the statement, must be a valid sql identifier
+        :param sql_query: sql query, with $1, $2, ... as parameters placeholders
+        :param page_group: columns identifying the rows of a same resource, which are never split between pages,
+                           "START_DATE" or integer columns: the resources are sorted by them, descending, those
+                           with a null page_group column last (see PAGE_GROUP)
+        """
+        PostgresqlDbInit.statements[name] = sql_query
+        if page_group is not None:
+            PostgresqlDbInit.statements[name + PAGE_SUFFIX], PostgresqlDbInit.statements[name + PAGE_NULLS_SUFFIX] = \
+                make_page_statements(sql_query, page_group)
+            PostgresqlDbInit.page_groups[name] = tuple(page_group)
+
 
 class PostgresqlDbInit:
-    def __init__(self, app, host=None, db_name=None, user=None, pwd=None):
+
+    # named statements, shared by all connections: {name: sql_query}
+    statements = {}
+    # page_group of the statements registered with a paginated variant: {name: page_group}
+    page_groups = {}
+
+    def __init__(self, app, host=None, db_name=None, user=None, pwd=None, **pool_config):
+        """
+        :param app: flask app, its SQLALCHEMY_ENGINE_OPTIONS configure the pool (see get_engine_options)
+        :param host: used if no app is given, as the following parameters
+        :param db_name: str
+        :param user: str
+        :param pwd: str
+        :param pool_config: pool settings (see POSTGRES_POOL_DEFAULTS)
+        """
         if app:
             self.db = SQLAlchemy(app)
             self.connexion = self.db.get_engine()
         else:
             self.db = SQLAlchemy()
             self.connexion = self.db.create_engine('postgresql://'+user+':'+pwd+'@'+host+'/'+db_name,
-                                                   {})
+                                                   get_engine_options(pool_config))
         self.logger = logging.getLogger('PostgresqlDb')
+        self._row_types = {}
+        self.pool_wait = TimingStats()
 
     def load_data(self, sql_query):
         self.logger.debug(sql_query)
@@ -40,23 +462,262 @@ class PostgresqlDbInit:
             self.logger.error(str(err))
             raise ValueError(str(err))
 
+    def fetch_rows(self, name, *params):
+        """
+        Execute a registered statement with bound parameters and fetch its rows.
+
+        The statement is prepared server-side the first time it is used on a pooled connection,
+        its plan is then reused by every following call on this connection.
+        Rows are namedtuples named after the selected columns, values are typed according to COLUMN_TYPES.
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param params: values of the statement parameters, in order
+        :return: [namedtuple]
+        """
+        self.logger.debug(f'{name} {params}')
+        connection = self._get_connection()
+        try:
+            cursor = connection.cursor()
+            self._execute_statement(connection, cursor, name, params)
+            row_type, converters = self._get_row_type(name, cursor.description)
+            return make_rows(cursor.fetchall(), row_type, converters)
+        except psycopg2.OperationalError as err:
+            self.logger.error(str(err))
+            raise RuntimeError(str(err))
+        except Exception as err:
+            self.logger.error(str(err))
+            raise ValueError(str(err))
+        finally:
+            connection.close()
+
+    def fetch_page(self, name, page, *params):
+        """
+        Fetch a page of rows of a statement registered with a page_group, most recent first.
+
+        The page holds the rows of at most `count` resources (groups of rows), strictly after the page key.
+        One more resource is fetched to know whether a next page exists.
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param page: (count, key), key being the page key of the last resource of the previous page,
+                     or None for the first page
+        :param params: values of the statement parameters, in order
+        :return: [namedtuple], page key of the last resource if there is a next page else None
+        """
+        count, key = page
+        if key is not None:
+            check_page_key(self.page_groups[name], key)
+        statement_name, page_params = page_statement(name, key, count + 1)
+        rows = self.fetch_rows(statement_name, *params, *page_params)
+        if statement_name.endswith(PAGE_SUFFIX) and nb_page_keys(rows) <= count:
+            # end of the resources with a complete page key, followed by those with a null page key column
+            rows += self.fetch_rows(name + PAGE_NULLS_SUFFIX, *params, *first_page_key(self.page_groups[name]),
+                                    count + 1 - nb_page_keys(rows))
+        return split_page(rows, count)
+
+    def iter_rows(self, name, *params, batch_size=STREAM_BATCH_SIZE):
+        """
+        Execute a registered statement with bound parameters through a server-side cursor, and yield its rows.
+
+        Rows are fetched by batches of batch_size, so memory usage does not depend on the number of rows.
+        The pooled connection is held until the generator is exhausted or closed.
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param params: values of the statement parameters, in order
+        :param batch_size: number of rows fetched at once
+        :return: generator of namedtuple
+        """
+        self.logger.debug(f'{name} {params} (streamed)')
+        sql_query = _PLACEHOLDER_REGEX.sub(r'%(p\1)s', self.statements[name].replace('%', '%%'))
+        connection = self._get_connection()
+        try:
+            cursor = connection.cursor(name=f'{name}_{uuid4().hex}')
+            cursor.itersize = batch_size
+            cursor.execute(sql_query, {f'p{idx}': param for idx, param in enumerate(params, 1)})
+            records = cursor.fetchmany(batch_size)
+            row_type, converters = self._get_row_type(name, cursor.description)
+            while records:
+                for record in records:
+                    yield make_row(record, row_type, converters)
+                records = cursor.fetchmany(batch_size)
+            cursor.close()
+        except psycopg2.OperationalError as err:
+            self.logger.error(str(err))
+            raise RuntimeError(str(err))
+        except psycopg2.Error as err:
+            self.logger.error(str(err))
+            raise ValueError(str(err))
+        finally:
+            connection.close()
+
+    def get_pool_status(self):
+        """
+        Get the state of the connection pool and the time spent waiting for connections
+
+        :return: dict
+        """
+        pool = self.connexion.pool
+        status = {'status': pool.status(), 'wait': self.pool_wait.as_json()}
+        if isinstance(pool, QueuePool):
+            status.update({'size': pool.size(), 'checked_in': pool.checkedin(),
+                           'checked_out': pool.checkedout(), 'overflow': pool.overflow()})
+        return status
+
+    def _get_connection(self):
+        """
+        Get a connection from the pool, reporting the time spent waiting for it
+
+        :return: pooled dbapi connection
+        """
+        start = time.perf_counter()
+        try:
+            connection = self.connexion.raw_connection()
+        except SQLAlchemyError as err:
+            self.logger.error(str(err))
+            raise RuntimeError(str(err))
+        finally:
+            wait = time.perf_counter() - start
+            self.pool_wait.add(wait)
+        self.logger.debug(f'Waited {wait * 1000:.1f}ms for a connection')
+        return connection
+
+    def _get_row_type(self, name, description):
+        """
+        Get (and cache) the namedtuple type of the rows of a statement, and the converters to apply to them
+
+        :param name: name of the statement
+        :param description: cursor description of the executed statement
+        :return: namedtuple type, [(column index, converter)]
+        """
+        key = (name, tuple((desc[0], desc[1]) for desc in description))
+        if key not in self._row_types:
+            self._row_types[key] = make_row_type(name, key[1])
+        return self._row_types[key]
+
+    def _execute_statement(self, connection, cursor, name, params):
+        """
+        Prepare the statement on the connection if needed, then execute it
+
+        :param connection: pooled connection, its info dict keeps track of the prepared statements
+        :param cursor: cursor to execute the statement on
+        :param name: name of the statement
+        :param params: values of the statement parameters
+        """
+        prepared_statements = connection.info.setdefault('prepared_statements', set())
+        if name not in prepared_statements:
+            cursor.execute(f'PREPARE {name} AS {self.statements[name]}')
+            prepared_statements.add(name)
+        if params:
+            cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cursor.execute(f'EXECUTE {name}')
+
+
+def retry_delay(pool_config, attempt):
+    """
+    Time to wait before retrying a sparql query
+
+    :param pool_config: sparql pool settings
+    :param attempt: int, 0 for the first retry
+    :return: float, s
+    """
+    return pool_config['retry_backoff'] * 2 ** attempt
+
+
+class SparqlCsvParser:
+    """
+    Incremental parser of sparql select results in the csv format (text/csv), a row being parsed as soon as
+    it is received. Unbound values are read as ''.
+    """
+
+    def __init__(self, variables):
+        """
+        :param variables: [str], variables of the rows, in their order
+        """
+        self.variables = list(variables)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._line = ''  # received data after the last line break
+        self._record = []  # lines of a record not terminated yet (quoted line breaks)
+        self._quotes = 0
+        self._indexes = None
+
+    def feed(self, data):
+        """
+        :param data: bytes, next part of the response
+        :return: [tuple of str], rows completed by data
+        """
+        lines = (self._line + self._decoder.decode(data)).split('\n')
+        self._line = lines.pop()
+        return self._parse(lines)
+
+    def close(self):
+        """
+        :return: [tuple of str], last rows
+        """
+        line = self._line + self._decoder.decode(b'', final=True)
+        self._line = ''
+        rows = self._parse([line] if line else [])
+        if self._record:
+            raise ValueError('unterminated quoted value in the sparql results')
+        if self._indexes is None:
+            raise ValueError('no header in the sparql results')
+        return rows
+
+    def _parse(self, lines):
+        records = []
+        for line in lines:
+            self._record.append(line)
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                records.append('\n'.join(self._record))
+                self._record = []
+                self._quotes = 0
+        rows = []
+        for fields in csv.reader(records):
+            if not fields:
+                continue
+            if self._indexes is None:
+                missing = [variable for variable in self.variables if variable not in fields]
+                if missing:
+                    raise ValueError(f"variables {', '.join(missing)} not in the sparql results")
+                self._indexes = [fields.index(variable) for variable in self.variables]
+                continue
+            rows.append(tuple(fields[index] for index in self._indexes))
+        return rows
+
 
 class SparqlDB:
     instance = None
 
     def __init__(self, **kwargs):
         if not SparqlDB.instance:
-            SparqlDB.instance = SparqlDbInit(**kwargs)
+            if kwargs.get('store_path'):
+                SparqlDB.instance = EmbeddedSparqlDbInit(**kwargs)
+            else:
+                SparqlDB.instance = SparqlDbInit(**kwargs)
 
     def __getattr__(self, name):
         return getattr(self.instance, name)
 
 
 class SparqlDbInit:
-    def __init__(self, host, use_metadata=True):
+    def __init__(self, host, use_metadata=True, **pool_config):
+        """
+        :param host: url of the sparql endpoint
+        :param use_metadata: if False, no query is sent
+        :param pool_config: http pool settings (see SPARQL_POOL_DEFAULTS)
+        """
         self.connexion = sparql.SPARQLServer(host)
+        self.pool_config = get_pool_config(pool_config, SPARQL_POOL_DEFAULTS)
+        # keep-alive connections shared by all the queries, and timeouts so that a slow endpoint cannot hang a request
+        # (failed queries are retried by _send, with a backoff)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_config['pool_maxsize'])
+        self.connexion.s.mount('http://', adapter)
+        self.connexion.s.mount('https://', adapter)
+        self.connexion.requests_kwargs['timeout'] = (self.pool_config['connect_timeout'],
+                                                     self.pool_config['read_timeout'])
         self.logger = logging.getLogger('SparqlDb')
         self.use_metadata = use_metadata
+        self.query_time = TimingStats()
         if not self.use_metadata:
             self.logger.warn("Sparql link is deactivated")
 
@@ -66,7 +727,152 @@ class SparqlDbInit:
             if not self.use_metadata:
                 return None
             self.logger.debug(sparql_query)
-            return self.connexion.query(sparql_query)
+            start = time.perf_counter()
+            try:
+                return self._send(lambda: self._get_json(sparql_query))
+            finally:
+                self.query_time.add(time.perf_counter() - start)
+        except Exception as err:
+            self.logger.error(str(err))
+            raise ValueError(str(err))
+
+    def load_rows(self, sparql_query, variables):
+        """
+        Send a select query, its results being read in the csv format and parsed while they are received
+
+        :param sparql_query: str
+        :param variables: [str], variables of the rows
+        :return: generator of tuples of str, with the values of the variables ('' if unbound)
+        """
+        if not self.use_metadata:
+            return
+        self.logger.debug(sparql_query)
+        start = time.perf_counter()
+        try:
+            response = self._send(lambda: self._get_csv(sparql_query))
+            with response:
+                parser = SparqlCsvParser(variables)
+                for chunk in response.iter_content(chunk_size=SPARQL_CHUNK_SIZE):
+                    yield from parser.feed(chunk)
+                yield from parser.close()
+        except Exception as err:
+            self.logger.error(str(err))
+            raise ValueError(str(err))
+        finally:
+            self.query_time.add(time.perf_counter() - start)
+
+    def _get_json(self, sparql_query):
+        # sent by the session instead of pymantic, which raises the same exception for all the http errors:
+        # the statuses are needed by _send
+        response = self.connexion.s.get(self.connexion.query_url, params={'query': sparql_query},
+                                        headers={'Accept': 'application/sparql-results+json'},
+                                        **self.connexion.requests_kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def _get_csv(self, sparql_query):
+        response = self.connexion.s.get(self.connexion.query_url, params={'query': sparql_query},
+                                        headers={'Accept': 'text/csv'}, stream=True,
+                                        **self.connexion.requests_kwargs)
+        if response.status_code >= 400:
+            response.close()
+        response.raise_for_status()
+        return response
+
+    def _send(self, query):
+        """
+        Send a query, retried on connection errors, timeouts and SPARQL_RETRY_STATUSES
+
+        :param query: function sending the query
+        :return: result of query
+        """
+        for attempt in range(self.pool_config['max_retries'] + 1):
+            try:
+                return query()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as err:
+                if attempt == self.pool_config['max_retries'] or (
+                        isinstance(err, requests.HTTPError) and
+                        getattr(err.response, 'status_code', None) not in SPARQL_RETRY_STATUSES):
+                    raise
+                delay = retry_delay(self.pool_config, attempt)
+                self.logger.warning(f'{err}, retrying in {delay}s')
+                time.sleep(delay)
+
+    def get_pool_status(self):
+        """
+        Get the http pool settings and the time spent by queries
+
+        :return: dict
+        """
+        return {'config': self.pool_config, 'queries': self.query_time.as_json()}
+
+
+class EmbeddedSparqlDbInit:
+    """
+    Same interface as SparqlDbInit, the queries being answered by an in-process TripleStore loaded from a N-Triples
+    dump of the metadata, without sparql endpoint
+    """
+
+    def __init__(self, store_path, use_metadata=True, host=None, **pool_config):
+        """
+        :param store_path: .nt or .nt.gz file
+        :param use_metadata: if False, no query is answered
+        :param host: ignored, the dump replacing the sparql endpoint
+        :param pool_config: ignored
+        """
+        self.store_path = store_path
+        self.use_metadata = use_metadata
+        self.logger = logging.getLogger('SparqlDb')
+        self.query_time = TimingStats()
+        self.store = load_store(store_path) if self.use_metadata else None
+        if not self.use_metadata:
+            self.logger.warning("Sparql link is deactivated")
+
+    def load_data(self, sparql_query):
+        """
+        :param sparql_query: str
+        :return: results as the json results of a sparql endpoint
+        """
+        if not self.use_metadata:
+            return None
+        variables, rows = self._select(sparql_query)
+        return {'head': {'vars': variables},
+                'results': {'bindings': [{variable: term_json(term) for variable, term in zip(variables, row)
+                                          if term is not None} for row in rows]}}
+
+    def load_rows(self, sparql_query, variables):
+        """
+        :param sparql_query: str
+        :param variables: [str], variables of the rows
+        :return: [tuple of str], values of the variables ('' if unbound)
+        """
+        if not self.use_metadata:
+            return []
+        selected, rows = self._select(sparql_query)
+        try:
+            indexes = [selected.index(variable) for variable in variables]
+        except ValueError:
+            missing = [variable for variable in variables if variable not in selected]
+            raise ValueError(f"variables {', '.join(missing)} not in the sparql results")
+        return [tuple(term_value(row[index]) for index in indexes) for row in rows]
+
+    def _select(self, sparql_query):
+        self.logger.debug(sparql_query)
+        start = time.perf_counter()
+        try:
+            return self.store.select(sparql_query)
         except Exception as err:
             self.logger.error(str(err))
-            raise ValueError(str(err))
\ No newline at end of file
+            raise ValueError(str(err))
+        finally:
+            self.query_time.add(time.perf_counter() - start)
+
+    def get_pool_status(self):
+        """
+        Get the store size and the time spent by queries
+
+        :return: dict
+        """
+        return {'config': {'store_path': self.store_path},
+                'store': self.store.get_status() if self.store is not None else None,
+                'queries': self.query_time.as_json()}
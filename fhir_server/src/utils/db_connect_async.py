@@ -0,0 +1,426 @@
+import asyncpg
+import httpx
+import asyncio
+import logging
+import threading
+import time
+from decimal import Decimal
+
+from utils.db_connect import PostgresqlDbInit, TimingStats, get_pool_config, make_row_type, make_rows, split_page, \
+    PAGE_SUFFIX, PAGE_NULLS_SUFFIX, first_page_key, check_page_key, nb_page_keys, page_statement, STREAM_BATCH_SIZE, POSTGRES_POOL_DEFAULTS, SPARQL_POOL_DEFAULTS, \
+    SPARQL_RETRY_STATUSES, SPARQL_CHUNK_SIZE, SparqlCsvParser, retry_delay
+
+
+# python type expected by asyncpg for the statement parameters, by postgres type name
+# (psycopg2 sends every parameter as a literal, asyncpg needs them typed)
+_PARAM_TYPES = {
+    'int2': int,
+    'int4': int,
+    'int8': int,
+    'float4': float,
+    'float8': float,
+    'numeric': Decimal,
+    'text': str,
+    'varchar': str,
+}
+
+
+def _convert_params(parameters, params):
+    """
+    Convert the parameters of a statement to the python type of their postgres type
+
+    :param parameters: [asyncpg Type], parameters of the statement
+    :param params: values of the statement parameters, in order
+    :return: [converted values]
+    :raise: ValueError if a value cannot be converted
+    """
+    converted = []
+    for param_type, param in zip(parameters, params):
+        if param_type.kind == 'array' and param is not None:
+            # arrays are named after their element type, prefixed by an underscore
+            param = [_convert_param(param_type.name[1:], item) for item in param]
+        else:
+            param = _convert_param(param_type.name, param)
+        converted.append(param)
+    return converted
+
+
+def _convert_param(type_name, param):
+    """
+    Convert a parameter value to the python type of a postgres type
+
+    :param type_name: name of the postgres type
+    :param param: value
+    :return: converted value
+    :raise: ValueError if the value cannot be converted
+    """
+    converter = _PARAM_TYPES.get(type_name)
+    if converter is not None and param is not None and not isinstance(param, converter):
+        try:
+            param = converter(param)
+        except (ValueError, ArithmeticError):
+            raise ValueError(f'invalid input for type {type_name}: "{param}"')
+    return param
+
+
+class AsyncPostgresqlDbInit:
+    """
+    asyncpg version of PostgresqlDbInit: same registered statements, same typed rows, coroutines instead of functions
+
+    Statements are executed through the asyncpg statement cache: prepared once per connection, and reused by the
+    following requests.
+    """
+
+    def __init__(self, host, db_name, user, pwd, **pool_config):
+        """
+        :param host: str
+        :param db_name: str
+        :param user: str
+        :param pwd: str
+        :param pool_config: pool settings (see POSTGRES_POOL_DEFAULTS)
+        """
+        self.dsn = 'postgresql://' + user + ':' + pwd + '@' + host + '/' + db_name
+        self.pool_config = get_pool_config(pool_config, POSTGRES_POOL_DEFAULTS)
+        self.pool = None
+        self.logger = logging.getLogger('AsyncPostgresqlDb')
+        self._row_types = {}
+        self._statement_types = {}
+        self.pool_wait = TimingStats()
+
+    async def open(self):
+        """
+        Open the connection pool. pool_recycle is applied to idle connections only,
+        pool_pre_ping is not needed: asyncpg resets and checks connections when they are released.
+        """
+        server_settings = {}
+        if self.pool_config['statement_timeout']:
+            server_settings['statement_timeout'] = str(self.pool_config['statement_timeout'])
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.pool_config['pool_size'],
+            max_size=self.pool_config['pool_size'] + self.pool_config['max_overflow'],
+            max_inactive_connection_lifetime=self.pool_config['pool_recycle'],
+            server_settings=server_settings,
+            # every registered statement stays prepared
+            statement_cache_size=max(100, len(PostgresqlDbInit.statements)))
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def fetch_rows(self, name, *params):
+        """
+        Execute a registered statement with bound parameters and fetch its rows, see PostgresqlDbInit.fetch_rows
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param params: values of the statement parameters, in order
+        :return: [namedtuple]
+        """
+        self.logger.debug(f'{name} {params}')
+        connection = await self._get_connection()
+        try:
+            parameters, attributes = await self._get_statement_types(connection, name)
+            records = await connection.fetch(PostgresqlDbInit.statements[name], *_convert_params(parameters, params))
+            row_type, converters = self._get_row_type(name, attributes)
+            return make_rows(records, row_type, converters)
+        except Exception as err:
+            raise self._convert_error(err)
+        finally:
+            await self.pool.release(connection)
+
+    async def fetch_page(self, name, page, *params):
+        """
+        Fetch a page of rows of a statement registered with a page_group, see PostgresqlDbInit.fetch_page
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param page: (count, key), key being the page key of the last resource of the previous page,
+                     or None for the first page
+        :param params: values of the statement parameters, in order
+        :return: [namedtuple], page key of the last resource if there is a next page else None
+        """
+        count, key = page
+        if key is not None:
+            check_page_key(PostgresqlDbInit.page_groups[name], key)
+        statement_name, page_params = page_statement(name, key, count + 1)
+        rows = await self.fetch_rows(statement_name, *params, *page_params)
+        if statement_name.endswith(PAGE_SUFFIX) and nb_page_keys(rows) <= count:
+            rows += await self.fetch_rows(name + PAGE_NULLS_SUFFIX, *params,
+                                          *first_page_key(PostgresqlDbInit.page_groups[name]),
+                                          count + 1 - nb_page_keys(rows))
+        return split_page(rows, count)
+
+    async def iter_batches(self, name, *params, batch_size=STREAM_BATCH_SIZE):
+        """
+        Execute a registered statement through a server-side cursor, and yield its rows by batches
+
+        The connection is held until the generator is exhausted or closed (aclose).
+
+        :param name: name of the statement (see PostgresqlDB.register_statement)
+        :param params: values of the statement parameters, in order
+        :param batch_size: number of rows fetched at once
+        :return: async generator of [namedtuple]
+        """
+        self.logger.debug(f'{name} {params} (streamed)')
+        connection = await self._get_connection()
+        try:
+            async with connection.transaction():
+                parameters, attributes = await self._get_statement_types(connection, name)
+                cursor = await connection.cursor(PostgresqlDbInit.statements[name],
+                                                 *_convert_params(parameters, params))
+                row_type, converters = self._get_row_type(name, attributes)
+                while True:
+                    records = await cursor.fetch(batch_size)
+                    if not records:
+                        break
+                    yield make_rows(records, row_type, converters)
+        except GeneratorExit:
+            raise
+        except Exception as err:
+            raise self._convert_error(err)
+        finally:
+            await self.pool.release(connection)
+
+    def get_pool_status(self):
+        """
+        Get the state of the connection pool and the time spent waiting for connections
+
+        :return: dict
+        """
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {'status': f'Pool size: {size}  Idle connections: {idle}', 'wait': self.pool_wait.as_json(),
+                'size': size, 'checked_in': idle, 'checked_out': size - idle,
+                'max_size': self.pool.get_max_size()}
+
+    async def _get_connection(self):
+        """
+        Get a connection from the pool, reporting the time spent waiting for it
+
+        :return: asyncpg connection, to be released to the pool
+        """
+        start = time.perf_counter()
+        try:
+            connection = await asyncio.wait_for(self.pool.acquire(), timeout=self.pool_config['pool_timeout'])
+        except Exception as err:
+            self.logger.error(str(err))
+            raise RuntimeError(str(err))
+        finally:
+            wait = time.perf_counter() - start
+            self.pool_wait.add(wait)
+        self.logger.debug(f'Waited {wait * 1000:.1f}ms for a connection')
+        return connection
+
+    async def _get_statement_types(self, connection, name):
+        """
+        Get (and cache) the parameter and column types of a statement, read once from a statement prepared apart
+
+        :param connection: pooled connection
+        :param name: name of the statement
+        :return: [asyncpg Type] of the parameters, [asyncpg Attribute] of the columns
+        """
+        if name not in self._statement_types:
+            statement = await connection.prepare(PostgresqlDbInit.statements[name])
+            self._statement_types[name] = statement.get_parameters(), statement.get_attributes()
+        return self._statement_types[name]
+
+    def _get_row_type(self, name, attributes):
+        """
+        Get (and cache) the namedtuple type of the rows of a statement, and the converters to apply to them
+
+        :param name: name of the statement
+        :param attributes: [asyncpg Attribute], columns of the statement
+        :return: namedtuple type, [(column index, converter)]
+        """
+        key = (name, tuple((attribute.name, attribute.type.oid) for attribute in attributes))
+        if key not in self._row_types:
+            self._row_types[key] = make_row_type(name, key[1])
+        return self._row_types[key]
+
+    def _convert_error(self, err):
+        """
+        Convert an error the way PostgresqlDbInit does: RuntimeError for connection errors and timeouts,
+        ValueError for anything else (mostly invalid parameters)
+
+        :param err: Exception
+        :return: RuntimeError or ValueError
+        """
+        self.logger.error(str(err))
+        if isinstance(err, ValueError):
+            return ValueError(str(err))
+        if isinstance(err, (OSError, asyncio.TimeoutError, asyncpg.InterfaceError,
+                            asyncpg.PostgresConnectionError, asyncpg.InsufficientResourcesError,
+                            asyncpg.OperatorInterventionError)):
+            return RuntimeError(str(err))
+        return ValueError(str(err))
+
+
+class AsyncSparqlDbInit:
+    """
+    httpx version of SparqlDbInit. Queries are sent by the event loop, load_data keeps the sync interface
+    for the metadata functions of the resource modules, which must then run in worker threads.
+    """
+
+    def __init__(self, host, use_metadata=True, **pool_config):
+        """
+        :param host: url of the sparql endpoint
+        :param use_metadata: if False, no query is sent
+        :param pool_config: http pool settings (see SPARQL_POOL_DEFAULTS)
+        """
+        self.host = host
+        self.use_metadata = use_metadata
+        self.pool_config = get_pool_config(pool_config, SPARQL_POOL_DEFAULTS)
+        self.client = None
+        self.loop = None
+        self._loop_thread = None
+        self.logger = logging.getLogger('AsyncSparqlDb')
+        self.query_time = TimingStats()
+        if not self.use_metadata:
+            self.logger.warning("Sparql link is deactivated")
+
+    async def open(self):
+        self.loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_config['pool_maxsize'],
+                                max_keepalive_connections=self.pool_config['pool_maxsize']),
+            timeout=httpx.Timeout(self.pool_config['read_timeout'], connect=self.pool_config['connect_timeout']),
+            transport=httpx.AsyncHTTPTransport(retries=0))  # failed queries are retried by _send, with a backoff
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def query(self, sparql_query):
+        """
+        Send a select query
+
+        :param sparql_query: str
+        :return: sparql results as json
+        """
+        start = time.perf_counter()
+        try:
+            response = await self._send(lambda: self.client.get(
+                self.host, params={'query': sparql_query}, headers={'Accept': 'application/sparql-results+json'}))
+            return response.json()
+        finally:
+            self.query_time.add(time.perf_counter() - start)
+
+    async def query_rows(self, sparql_query, variables):
+        """
+        Send a select query, its results being read in the csv format and parsed while they are received
+
+        :param sparql_query: str
+        :param variables: [str], variables of the rows
+        :return: [tuple of str], values of the variables ('' if unbound)
+        """
+        start = time.perf_counter()
+        try:
+            return await self._send(lambda: self._get_rows(sparql_query, variables))
+        finally:
+            self.query_time.add(time.perf_counter() - start)
+
+    async def _get_rows(self, sparql_query, variables):
+        rows = []
+        async with self.client.stream('GET', self.host, params={'query': sparql_query},
+                                      headers={'Accept': 'text/csv'}) as response:
+            response.raise_for_status()
+            parser = SparqlCsvParser(variables)
+            async for chunk in response.aiter_bytes(SPARQL_CHUNK_SIZE):
+                rows.extend(parser.feed(chunk))
+            rows.extend(parser.close())
+        return rows
+
+    async def _send(self, query):
+        """
+        Same as SparqlDbInit._send
+
+        :param query: function returning the awaitable sending the query
+        :return: result of query
+        """
+        for attempt in range(self.pool_config['max_retries'] + 1):
+            try:
+                response = await query()
+                if isinstance(response, httpx.Response):
+                    response.raise_for_status()
+                return response
+            except (httpx.TransportError, httpx.HTTPStatusError) as err:
+                if attempt == self.pool_config['max_retries'] or (
+                        isinstance(err, httpx.HTTPStatusError) and
+                        err.response.status_code not in SPARQL_RETRY_STATUSES):
+                    raise
+                delay = retry_delay(self.pool_config, attempt)
+                self.logger.warning(f'{err}, retrying in {delay}s')
+                await asyncio.sleep(delay)
+
+    def load_data(self, sparql_query):
+        """
+        Same as SparqlDbInit.load_data, to be called from a worker thread
+
+        :param sparql_query: str
+        :return: sparql results as json
+        """
+        return self._run(self.query(sparql_query), sparql_query)
+
+    def load_rows(self, sparql_query, variables):
+        """
+        Same as SparqlDbInit.load_rows, to be called from a worker thread
+
+        :param sparql_query: str
+        :param variables: [str], variables of the rows
+        :return: [tuple of str]
+        """
+        if not self.use_metadata:
+            return []
+        return self._run(self.query_rows(sparql_query, variables), sparql_query)
+
+    def _run(self, coroutine, sparql_query):
+        try:
+            # Load the data
+            if not self.use_metadata:
+                coroutine.close()
+                return None
+            if threading.get_ident() == self._loop_thread:
+                coroutine.close()
+                raise RuntimeError('Sparql queries cannot be sent synchronously from the event loop')
+            self.logger.debug(sparql_query)
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        except Exception as err:
+            self.logger.error(str(err))
+            raise ValueError(str(err))
+
+    def get_pool_status(self):
+        """
+        Get the http pool settings and the time spent by queries
+
+        :return: dict
+        """
+        return {'config': self.pool_config, 'queries': self.query_time.as_json()}
+
+
+class SyncRows:
+    """
+    Sync iterator over the batches of rows of AsyncPostgresqlDbInit.iter_batches, so that the row processing
+    functions of the resource modules can consume them from a worker thread while the event loop fetches them
+    """
+
+    def __init__(self, batches, loop):
+        """
+        :param batches: async generator of [namedtuple]
+        :param loop: event loop running the generator
+        """
+        self.batches = batches
+        self.loop = loop
+        self._batch = iter(())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for row in self._batch:
+            return row
+        try:
+            batch = asyncio.run_coroutine_threadsafe(self.batches.__anext__(), self.loop).result()
+        except StopAsyncIteration:
+            raise StopIteration
+        self._batch = iter(batch)
+        return next(self._batch)
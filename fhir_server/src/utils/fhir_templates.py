@@ -0,0 +1,125 @@
+from itertools import islice, tee, zip_longest
+import logging
+
+from utils.api import dumps_resource
+from utils.db_connect import STREAM_BATCH_SIZE
+
+
+# how resources are built:
+# - templates: json dicts built directly from the rows, see the _iter_*_templates functions
+# - fhirclient: through the fhirclient object model and its validation, see the _iter_*_fhirclient functions
+# - differential: both, the json of the fhirclient builders being returned and any difference being logged
+BUILDERS = ('templates', 'fhirclient', 'differential')
+
+_builders = {'mode': 'templates'}
+
+
+def set_builders(mode):
+    """
+    Select how resources are built
+
+    :param mode: one of BUILDERS, templates if None
+    """
+    mode = mode or 'templates'
+    if mode not in BUILDERS:
+        raise ValueError(f"Unknown builders: {mode}, expected one of {', '.join(BUILDERS)}")
+    _builders['mode'] = mode
+
+
+def get_builders():
+    """
+    :return: str, one of BUILDERS
+    """
+    return _builders['mode']
+
+
+def iter_resources(rows, templates_builder, fhirclient_builder):
+    """
+    Build resources from rows with the selected builders
+
+    :param rows: iterable of namedtuple
+    :param templates_builder: function building resources as json dicts from rows
+    :param fhirclient_builder: function building the same resources through fhirclient from rows
+    :return: generator of resources as json
+    """
+    mode = _builders['mode']
+    if mode == 'templates':
+        return templates_builder(rows)
+    if mode == 'fhirclient':
+        return fhirclient_builder(rows)
+    return _iter_differential(rows, templates_builder, fhirclient_builder)
+
+
+def _iter_differential(rows, templates_builder, fhirclient_builder):
+    """
+    Build resources with both builders, rows being read once, and log the resources that differ
+
+    :return: generator of resources as json, built by fhirclient_builder
+    """
+    logger = logging.getLogger('fhir_templates')
+    templates_rows, fhirclient_rows = tee(rows)
+    missing = object()
+    for built, expected in zip_longest(templates_builder(templates_rows), fhirclient_builder(fhirclient_rows),
+                                       fillvalue=missing):
+        if built is missing or expected is missing or dumps_resource(built) != dumps_resource(expected):
+            logger.warning('templates and fhirclient builders differ: %s != %s',
+                           None if built is missing else dumps_resource(built),
+                           None if expected is missing else dumps_resource(expected))
+        if expected is not missing:
+            yield expected
+
+
+def fhir_datetime(date):
+    """
+    Json of a fhirclient FHIRDate set to date_to_datetime(date)
+
+    :param date: date, datetime or None
+    :return: str or None
+    """
+    if date is None:
+        return None
+    return f'{date.year:04d}-{date.month:02d}-{date.day:02d}T00:00:00'
+
+
+def make_coding(system, code, display=None):
+    """
+    Json of a fhirclient Coding, None values being left out as fhirclient does
+
+    :param system: str
+    :param code: str or None
+    :param display: str or None
+    :return: dict
+    """
+    coding = {'system': system}
+    if code is not None:
+        coding['code'] = code
+    if display is not None:
+        coding['display'] = display
+    return coding
+
+
+def iter_chunks(rows, size=STREAM_BATCH_SIZE):
+    """
+    Split rows in lists, for their columns to be transformed at once, streamed rows being read batch by batch
+
+    :param rows: iterable of namedtuple
+    :param size: maximum number of rows of a list
+    :return: generator of [namedtuple]
+    """
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+def transform_column(values, func):
+    """
+    Apply a function to a column, once per distinct value
+
+    :param values: [hashable value]
+    :param func: function of a value
+    :return: [func(value) for value in values]
+    """
+    results = {value: func(value) for value in set(values)}
+    return [results[value] for value in values]
@@ -0,0 +1,808 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from itertools import islice
+from threading import Event, Lock, Thread
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+from utils.compact import compact, from_json, read_shared, to_json, write_shared
+from utils.db_connect import get_pool_config
+
+
+# default metadata settings, see the metadata section of config.yaml
+METADATA_DEFAULTS = {
+    'refresh_interval': 86400.,  # s, between two refreshes of a map, 0 to disable the background refresh
+    'retry_interval': 300.,  # s, before retrying a failed refresh
+    'snapshot_path': '',  # file where the maps are saved, loaded at startup, '' to disable
+    'preload_workers': 4,  # maps loaded concurrently by the preload
+    'preload_fail_fast': False,  # if True, the preload stops at the first error, else failed maps are loaded on use
+    'lazy_maps': '',  # maps resolved per key instead of being loaded whole, comma separated, 'all' for all of them
+    'lazy_cache_size': 100000,  # keys kept by each lazy map, unknown keys included
+    'lazy_negative_ttl': 3600.,  # s, before looking again for a key not found, 0 to keep it until the next prefetch
+    'lazy_batch_size': 200,  # keys resolved by a VALUES query
+    'compact_maps': True,  # if True, the maps are stored as arrays of interned strings instead of dicts
+    'shared_path': '',  # file where the maps are published for the processes of the host, '' to disable
+}
+
+# snapshot file: SNAPSHOT_MAGIC, a json header line (version, creation date, sha256 of the payload, maps)
+# then the maps as json {name: map}, see utils.compact.to_json: reading it never executes code
+SNAPSHOT_MAGIC = b'FHIR_METADATA\n'
+SNAPSHOT_VERSION = 2
+
+# characters which cannot appear in an IRI written between <>
+_INVALID_IRI_CHARS = set('<>"{}|^`\\ \t\r\n')
+
+# cached value of the keys not found by a lazy map
+_UNKNOWN = object()
+
+
+def _size(value):
+    """
+    Number of entries of a metadata map, or of the maps of a tuple
+
+    :param value: loaded metadata
+    :return: int or None
+    """
+    if isinstance(value, tuple):
+        sizes = [_size(elt) for elt in value]
+        return None if None in sizes else sum(sizes)
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def values_clause(variable, keys, iri=False):
+    """
+    VALUES clause restricting a sparql query to some keys
+
+    :param variable: str, variable of the keys, without ?
+    :param keys: [str]
+    :param iri: True if the keys are IRIs, False if they are literals
+    :return: str
+    """
+    if iri:
+        terms = ['<' + key + '>' for key in keys]
+    else:
+        terms = ['"' + key.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r') + '"'
+                 for key in keys]
+    return f"VALUES ?{variable} {{ {' '.join(terms)} }}"
+
+
+class LazyResolver:
+    """
+    Per-key resolution of a metadata map, for large terminologies: the keys used are looked up by batches with
+    VALUES queries, and kept in a bounded LRU with the keys not found (negative caching)
+    """
+
+    def __init__(self, loader, key, iri, cache_size, ttl, negative_ttl, batch_size, clock=time.monotonic):
+        """
+        :param loader: loader of the map, called with a VALUES clause restricting its query
+        :param key: str, sparql variable of the keys of the map
+        :param iri: True if the keys are IRIs
+        :param cache_size: int, keys kept
+        :param ttl: float, s before looking again for a key found, 0 to keep it until evicted
+        :param negative_ttl: float, s before looking again for a key not found, 0 to keep it only until the next
+            prefetch (the lookups of a batch of rows never query it again)
+        :param batch_size: int, keys by query
+        :param clock: function giving the current time in seconds
+        """
+        self.loader = loader
+        self.key = key
+        self.iri = iri
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.batch_size = batch_size
+        self.clock = clock
+        self._entries = OrderedDict()  # {key: (expiry time or None, value or _UNKNOWN)}, least recently used first
+        self._batch_unknown = set()  # keys not found since the last prefetch, if negative_ttl is 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.errors = 0
+        self.last_error = None
+
+    def get(self, key, default=None):
+        """
+        :param key: str
+        :param default: value returned if the key is not found
+        :return: value of the key in the map
+        """
+        return self.resolve([key]).get(key, default)
+
+    def prefetch(self, keys):
+        """
+        Resolve the keys about to be looked up for a batch of rows
+
+        :param keys: iterable of str
+        :return: {key: value} for the keys found
+        """
+        with self._lock:
+            self._batch_unknown.clear()
+        return self.resolve(keys)
+
+    def resolve(self, keys):
+        """
+        Look for keys, the ones not cached being resolved by batch_size
+
+        :param keys: iterable of str
+        :return: {key: value} for the keys found
+        :raise: the error of the loader
+        """
+        results, missing = {}, []
+        now = self.clock()
+        with self._lock:
+            for key in set(keys):
+                if key in self._batch_unknown:
+                    self.hits += 1
+                    continue
+                entry = self._entries.get(key)
+                if entry is None or (entry[0] is not None and entry[0] <= now):
+                    missing.append(key)
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if entry[1] is not _UNKNOWN:
+                    results[key] = entry[1]
+            self.misses += len(missing)
+        if self.iri:
+            # keys which cannot be IRIs are not sent, and not found
+            self._store({key for key in missing if _INVALID_IRI_CHARS.intersection(key)}, {})
+            missing = [key for key in missing if not _INVALID_IRI_CHARS.intersection(key)]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            self.queries += 1
+            try:
+                found = self.loader(values_clause(self.key, batch, self.iri))
+            except Exception as err:
+                self.errors += 1
+                self.last_error = str(err)
+                raise
+            self._store(batch, found)
+            results.update((key, found[key]) for key in batch if key in found)
+        return results
+
+    def _store(self, keys, found):
+        now = self.clock()
+        with self._lock:
+            for key in keys:
+                if key in found:
+                    self._entries[key] = (now + self.ttl if self.ttl else None, found[key])
+                elif self.negative_ttl:
+                    self._entries[key] = (now + self.negative_ttl, _UNKNOWN)
+                else:
+                    self._batch_unknown.add(key)
+                    continue
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.cache_size:
+                self._entries.popitem(last=False)
+            if len(self._batch_unknown) > self.cache_size:
+                self._batch_unknown.clear()
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        with self._lock:
+            unknown = sum(value is _UNKNOWN for _, value in self._entries.values()) + len(self._batch_unknown)
+            return {'entries': len(self._entries), 'unknown': unknown, 'hits': self.hits, 'misses': self.misses,
+                    'queries': self.queries, 'errors': self.errors, 'last_error': self.last_error}
+
+
+class MetadataEntry:
+    """
+    A metadata map and the function loading it
+    """
+
+    def __init__(self, name, loader, derived=False, lazy_key=None, lazy_iri=False):
+        """
+        :param name: str
+        :param loader: function without parameters returning the map, from sparql queries
+        :param derived: True for a map computed from other maps, see MetadataRegistry.register
+        :param lazy_key: sparql variable of the keys, if the map can be resolved per key, see MetadataRegistry.register
+        :param lazy_iri: True if the keys are IRIs
+        """
+        self.name = name
+        self.loader = loader
+        self.derived = derived
+        self.lazy_key = lazy_key
+        self.lazy_iri = lazy_iri
+        self.resolver = None  # LazyResolver, if the map is resolved per key
+        self.from_snapshot = False
+        self.from_shared = False
+        # (map, loading date) swapped at once, so that readers never see a partially refreshed state
+        self.state = None
+        self.load_ms = None
+        self.last_attempt = None  # clock time of the last load
+        self.refreshes = 0
+        self.errors = 0
+        self.last_error = None
+        self.lock = Lock()
+
+    def get_status(self, now, next_refresh):
+        """
+        :param now: clock time
+        :param next_refresh: clock time of the next refresh, or None
+        :return: dict
+        """
+        status = {'loaded': self.state is not None, 'from_snapshot': self.from_snapshot,
+                  'from_shared': self.from_shared, 'refreshes': self.refreshes,
+                  'errors': self.errors, 'last_error': self.last_error}
+        if self.resolver is not None:
+            status['lazy'] = self.resolver.get_status()
+        if self.state is not None:
+            value, loaded_at = self.state
+            status.update({'size': _size(value), 'loaded_at': loaded_at, 'load_ms': self.load_ms,
+                           'next_refresh_s': None if next_refresh is None else round(max(next_refresh - now, 0.), 3)})
+        return status
+
+
+class MetadataRegistry:
+    """
+    Metadata maps of the resource modules, loaded on first use and refreshed in the background.
+    A failed refresh keeps the previous map, which is served until a refresh succeeds.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: function giving the current time in seconds
+        """
+        self.clock = clock
+        self.refresh_interval = METADATA_DEFAULTS['refresh_interval']
+        self.retry_interval = METADATA_DEFAULTS['retry_interval']
+        self.snapshot_path = METADATA_DEFAULTS['snapshot_path']
+        self.snapshot_status = {}
+        self.preload_workers = METADATA_DEFAULTS['preload_workers']
+        self.preload_fail_fast = METADATA_DEFAULTS['preload_fail_fast']
+        self.preload_status = {}
+        self.compact_maps = METADATA_DEFAULTS['compact_maps']
+        self.shared_path = METADATA_DEFAULTS['shared_path']
+        self.shared_status = {}
+        self._shared_id = None  # id of the shared file last attached or published
+        self.lazy_config = {key: METADATA_DEFAULTS[key] for key in ['lazy_maps', 'lazy_cache_size',
+                                                                     'lazy_negative_ttl', 'lazy_batch_size']}
+        self._entries = OrderedDict()
+        self._thread = None
+        self._stop = Event()
+        self.refresh_errors = 0  # errors of the background refresh itself, not of the loaders
+        self.last_refresh_error = None
+
+    def register(self, name, loader, derived=False, lazy_key=None, lazy_iri=False):
+        """
+        Register a metadata map, refreshed in the order of registration
+
+        :param name: str, replaces the map already registered under this name
+        :param loader: function without parameters returning the map
+        :param derived: True for a map computed from other maps (registered before it): it is not saved in the
+            snapshot, and is recomputed after each refresh of the other maps
+        :param lazy_key: sparql variable of the keys of the map, if it can be resolved per key (lazy_maps setting):
+            the loader is then called with a VALUES clause as parameter, to be inserted in its query
+        :param lazy_iri: True if the keys are IRIs, False if they are literals
+        """
+        self._entries[name] = MetadataEntry(name, loader, derived, lazy_key, lazy_iri)
+
+    def names(self):
+        """
+        :return: [str], registered maps
+        """
+        return list(self._entries)
+
+    def get(self, name):
+        """
+        Get a metadata map, loading it if needed
+
+        :param name: str
+        :return: the map returned by the loader
+        :raise: the error of the loader, if the map could not be loaded yet
+        """
+        entry = self._entries[name]
+        state = entry.state
+        if state is None:
+            state = self._load(entry, initial=True)
+        return state[0]
+
+    def lookup(self, name, key, default=None):
+        """
+        Get the value of a key in a metadata map, resolved per key for the lazy maps
+
+        :param name: str
+        :param key: str
+        :param default: value returned if the key is not found
+        :return: value of the key
+        """
+        entry = self._entries[name]
+        if entry.resolver is not None:
+            return entry.resolver.get(key, default)
+        return self.get(name).get(key, default)
+
+    def prefetch(self, name, keys):
+        """
+        Resolve at once the keys about to be looked up in a lazy map, nothing being done for the other maps
+
+        :param name: str
+        :param keys: iterable of str
+        """
+        entry = self._entries[name]
+        if entry.resolver is not None:
+            entry.resolver.prefetch(keys)
+
+    def iter_prefetched(self, name, rows, key):
+        """
+        Iterate over rows, the keys of a lazy map they need being resolved for a batch of rows at a time
+
+        :param name: str
+        :param rows: iterable of namedtuple
+        :param key: function of a row giving the key it needs, or None
+        :return: iterable of namedtuple
+        """
+        if self._entries[name].resolver is None:
+            return rows
+        return self._iter_prefetched(name, rows, key)
+
+    def _iter_prefetched(self, name, rows, key):
+        rows = iter(rows)
+        chunk = list(islice(rows, self.lazy_config['lazy_batch_size']))
+        while chunk:
+            self.prefetch(name, [k for k in map(key, chunk) if k is not None])
+            yield from chunk
+            chunk = list(islice(rows, self.lazy_config['lazy_batch_size']))
+
+    def load(self, name):
+        """
+        (Re)load a metadata map now, the previous one being kept if the loader fails
+
+        :param name: str
+        :return: bool, True if the map was loaded
+        """
+        try:
+            self._load(self._entries[name], initial=False)
+        except Exception:
+            return False
+        return True
+
+    def refresh(self, force=False):
+        """
+        Reload the loaded maps whose refresh is due.
+        With a shared file, the maps published by another process since the last refresh are used instead of being
+        reloaded, and the reloaded maps are published: the maps are loaded once per host.
+
+        :param force: if True, reload all the loaded maps
+        :return: {name: bool} for the reloaded maps
+        """
+        if not self.shared_path:
+            return self._refresh(force)
+        with _locked(self.shared_path):
+            results = {name: True for name in self.attach_shared(only_new=True)}
+            if results:
+                results.update(self._reload_derived(results))
+            reloaded = self._refresh(force)
+            if any(reloaded.values()):
+                self.publish_shared()
+            results.update(reloaded)
+            return results
+
+    def _refresh(self, force):
+        now = self.clock()
+        due = [entry.name for entry in list(self._entries.values()) if entry.state is not None and
+               (force or (self._next_refresh(entry) is not None and self._next_refresh(entry) <= now))]
+        results = {name: self.load(name) for name in due}
+        if any(results.values()):
+            results.update(self._reload_derived(results))
+            self.save_snapshot()
+        return results
+
+    def _reload_derived(self, reloaded):
+        """
+        :param reloaded: names of the maps reloaded, the derived maps among them being skipped
+        :return: {name: bool} for the derived maps loaded
+        """
+        return {entry.name: self.load(entry.name) for entry in list(self._entries.values())
+                if entry.derived and entry.state is not None and entry.name not in reloaded}
+
+    def _next_refresh(self, entry):
+        """
+        :return: clock time of the next refresh of a loaded map, None if the refresh is disabled
+        """
+        if not self.refresh_interval:
+            return None
+        if entry.last_attempt is None:
+            # loaded from the snapshot, refreshed at once
+            return float('-inf') if entry.from_snapshot else None
+        return entry.last_attempt + (self.retry_interval if entry.last_error is not None else self.refresh_interval)
+
+    def preload(self, workers=None, fail_fast=None):
+        """
+        Load the maps not loaded yet, preload_workers at a time, the derived maps being loaded after the others.
+        The duration and size of each map are logged, and the loaded maps saved in the snapshot.
+        With a shared file, a single process of the host preloads at a time: the maps published by another process
+        are used, and the maps loaded are published.
+
+        :param workers: int, preload_workers if None
+        :param fail_fast: bool, preload_fail_fast if None
+        :return: {name: None, or the error message if the map could not be loaded}
+        :raise: the first error of a loader, if fail_fast, without waiting for the loads in progress
+        """
+        if not self.shared_path:
+            return self._preload(workers, fail_fast)
+        with _locked(self.shared_path):
+            # published by another process while waiting for the lock
+            self.attach_shared(only_new=True)
+            results = self._preload(workers, fail_fast)
+            if any(error is None and not self._entries[name].derived for name, error in results.items()):
+                self.publish_shared()
+            return results
+
+    def _preload(self, workers, fail_fast):
+        workers = workers or self.preload_workers
+        fail_fast = self.preload_fail_fast if fail_fast is None else fail_fast
+        logger = logging.getLogger('Metadata')
+        start = self.clock()
+        entries = [entry for entry in list(self._entries.values()) if entry.state is None and entry.resolver is None]
+        results = {}
+
+        def _loaded(entry, load):
+            try:
+                load()
+            except Exception as err:
+                results[entry.name] = str(err)
+                logger.error(f'{entry.name} not preloaded: {err}')
+                if fail_fast:
+                    raise
+                return
+            results[entry.name] = None
+            logger.info(f'       {entry.name}: {_size(entry.state[0])} entries in {entry.load_ms} ms')
+
+        try:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = {executor.submit(self._load, entry, True): entry for entry in entries if not entry.derived}
+            try:
+                for future in as_completed(futures):
+                    _loaded(futures[future], future.result)
+            except Exception:
+                # fail_fast: the queued loads are cancelled, the error raised without waiting for the loads in
+                # progress, which complete in the background
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+                raise
+            executor.shutdown()
+            for entry in entries:
+                if entry.derived:
+                    _loaded(entry, lambda: self._load(entry, True))
+        finally:
+            self.preload_status = {'duration_ms': round((self.clock() - start) * 1000, 3), 'workers': workers,
+                                   'loaded': sum(error is None for error in results.values()),
+                                   'failed': sorted(name for name, error in results.items() if error is not None)}
+            logger.info(f"{self.preload_status['loaded']} metadata maps preloaded in "
+                        f"{self.preload_status['duration_ms']} ms")
+        self.save_snapshot()
+        return results
+
+    def _load(self, entry, initial):
+        with entry.lock:
+            if initial and entry.state is not None:
+                # loaded by another thread in the meantime
+                return entry.state
+            start = entry.last_attempt = self.clock()
+            try:
+                value = entry.loader()
+            except Exception as err:
+                entry.errors += 1
+                entry.last_error = str(err)
+                if entry.state is not None:
+                    logging.getLogger('Metadata').error(f'refresh of {entry.name} failed, previous map kept: {err}')
+                raise
+            if self.compact_maps and not entry.derived:
+                value = compact(value)
+            entry.load_ms = round((self.clock() - start) * 1000, 3)
+            if entry.state is not None:
+                entry.refreshes += 1
+            entry.last_error = None
+            entry.state = (value, datetime.now().isoformat(timespec='seconds'))
+            entry.from_snapshot = False
+            entry.from_shared = False
+            return entry.state
+
+    def save_snapshot(self):
+        """
+        Save the loaded maps in the snapshot file, if enabled.
+        The file is replaced at once, so that processes reading it never see a partial snapshot.
+
+        :return: bool, True if the snapshot was saved
+        """
+        if not self.snapshot_path:
+            return False
+        maps = {entry.name: entry.state[0] for entry in list(self._entries.values())
+                if not entry.derived and entry.state is not None}
+        if not maps:
+            return False
+        try:
+            payload = json.dumps({name: to_json(value) for name, value in maps.items()}).encode()
+        except TypeError as err:
+            logging.getLogger('Metadata').error(f'could not save the metadata snapshot: {err}')
+            return False
+        header = {'version': SNAPSHOT_VERSION, 'created_at': datetime.now().isoformat(timespec='seconds'),
+                  'sha256': hashlib.sha256(payload).hexdigest(), 'maps': sorted(maps)}
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC + json.dumps(header).encode() + b'\n' + payload)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as err:
+            logging.getLogger('Metadata').error(f'could not save the metadata snapshot: {err}')
+            return False
+        self.snapshot_status.update({'saved_at': header['created_at'], 'saved_sha256': header['sha256']})
+        return True
+
+    def load_snapshot(self):
+        """
+        Load the maps of the snapshot file, if enabled and valid, for the maps not loaded yet.
+        They are refreshed from sparql by the background refresh, as soon as it starts.
+
+        :return: [str], names of the maps loaded
+        """
+        if not self.snapshot_path:
+            return []
+        logger = logging.getLogger('Metadata')
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            logger.info(f'no metadata snapshot at {self.snapshot_path}')
+            return []
+        except OSError as err:
+            logger.warning(f'could not read the metadata snapshot: {err}')
+            return []
+        try:
+            header, maps = read_snapshot(data)
+        except ValueError as err:
+            logger.warning(f'metadata snapshot {self.snapshot_path} ignored: {err}')
+            return []
+        loaded = []
+        for name, value in maps.items():
+            entry = self._entries.get(name)
+            if entry is None or entry.derived or entry.resolver is not None:
+                continue
+            with entry.lock:
+                if entry.state is None:
+                    entry.state = (compact(value) if self.compact_maps else value, header['created_at'])
+                    entry.from_snapshot = True
+                    loaded.append(name)
+        self.snapshot_status.update({'created_at': header['created_at'], 'sha256': header['sha256'],
+                                     'loaded_maps': len(loaded)})
+        logger.info(f'{len(loaded)} metadata maps loaded from the snapshot of {header["created_at"]}')
+        return loaded
+
+    def publish_shared(self):
+        """
+        Publish the loaded maps in the shared file, if enabled, then use the published maps, shared with the other
+        processes of the host instead of being held by this process
+
+        :return: bool, True if the maps were published
+        """
+        if not self.shared_path:
+            return False
+        maps = {entry.name: entry.state[0] for entry in list(self._entries.values())
+                if not entry.derived and entry.resolver is None and entry.state is not None}
+        if not maps:
+            return False
+        try:
+            header = write_shared(self.shared_path, maps)
+        except (OSError, TypeError) as err:
+            logging.getLogger('Metadata').error(f'could not publish the metadata maps: {err}')
+            return False
+        logging.getLogger('Metadata').info(f"{len(maps)} metadata maps published in {self.shared_path} "
+                                           f"({header['size']} bytes)")
+        self.attach_shared(own=True)
+        return True
+
+    def attach_shared(self, only_new=False, own=False):
+        """
+        Use the maps of the shared file, if enabled: their arrays are mapped in memory, shared by the processes of
+        the host. They are refreshed when they are refresh_interval old, as if loaded by this process.
+
+        :param only_new: if True, only if the file was published after the last file attached or published
+        :param own: True for the file just published by this process, the maps being swapped without changing the
+            refresh schedule
+        :return: [str], names of the maps attached
+        """
+        if not self.shared_path:
+            return []
+        logger = logging.getLogger('Metadata')
+        try:
+            header, maps = read_shared(self.shared_path)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as err:
+            logger.warning(f'metadata shared file {self.shared_path} ignored: {err}')
+            return []
+        if only_new and header['id'] == self._shared_id:
+            return []
+        age = max(time.time() - header['published_at'], 0.)
+        attached = []
+        for name, value in maps.items():
+            entry = self._entries.get(name)
+            if entry is None or entry.derived or entry.resolver is not None:
+                continue
+            with entry.lock:
+                if own:
+                    if entry.state is None:
+                        continue
+                    entry.state = (value, entry.state[1])
+                else:
+                    if entry.state is not None:
+                        entry.refreshes += 1
+                    entry.state = (value, header['created_at'])
+                    entry.last_attempt = self.clock() - age
+                    entry.last_error = None
+                    entry.from_snapshot = False
+                entry.from_shared = True
+            attached.append(name)
+        self._shared_id = header['id']
+        self.shared_status.update({'published_at': header['created_at'], 'published_by': header['pid'],
+                                   'size': header['size'], 'attached_maps': len(attached)})
+        if not own:
+            logger.info(f'{len(attached)} metadata maps attached from {self.shared_path}, published by process '
+                        f"{header['pid']} at {header['created_at']}")
+        return attached
+
+    def start(self, metadata_config=None):
+        """
+        Read the metadata section of the config, attach the shared file, load the snapshot and start the background
+        refresh, if enabled
+
+        :param metadata_config: dict, or None
+        """
+        metadata_config = get_pool_config(metadata_config or {}, METADATA_DEFAULTS)
+        self.refresh_interval = metadata_config['refresh_interval']
+        self.retry_interval = metadata_config['retry_interval']
+        self.snapshot_path = metadata_config['snapshot_path']
+        self.preload_workers = metadata_config['preload_workers']
+        self.preload_fail_fast = metadata_config['preload_fail_fast']
+        self.compact_maps = metadata_config['compact_maps']
+        self.shared_path = metadata_config['shared_path']
+        self.lazy_config = {key: metadata_config[key] for key in self.lazy_config}
+        self._set_lazy_maps()
+        self.attach_shared()
+        self.load_snapshot()
+        if not self.refresh_interval or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='metadata-refresh', daemon=True)
+        self._thread.start()
+
+    def _set_lazy_maps(self):
+        names = [name.strip() for name in self.lazy_config['lazy_maps'].split(',') if name.strip()]
+        if names == ['all']:
+            names = [entry.name for entry in self._entries.values() if entry.lazy_key is not None]
+        for name in names:
+            entry = self._entries.get(name)
+            if entry is None or entry.lazy_key is None:
+                logging.getLogger('Metadata').warning(f'{name} cannot be resolved per key, loaded whole')
+        for entry in self._entries.values():
+            entry.resolver = None
+            if entry.name in names and entry.lazy_key is not None:
+                entry.resolver = LazyResolver(
+                    entry.loader, entry.lazy_key, entry.lazy_iri, self.lazy_config['lazy_cache_size'],
+                    self.refresh_interval, self.lazy_config['lazy_negative_ttl'],
+                    self.lazy_config['lazy_batch_size'], self.clock)
+
+    def stop(self):
+        """
+        Stop the background refresh
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            now = self.clock()
+            due = [self._next_refresh(entry) for entry in list(self._entries.values()) if entry.state is not None]
+            due = [next_refresh for next_refresh in due if next_refresh is not None]
+            wait = min(max(min(due) - now, 0.), self.refresh_interval) if due else self.refresh_interval
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+            except Exception as err:
+                # shared file or snapshot error: the thread keeps running, the refresh being retried later
+                self.refresh_errors += 1
+                self.last_refresh_error = str(err)
+                logging.getLogger('Metadata').exception(f'background refresh failed: {err}')
+                if self._stop.wait(self.retry_interval):
+                    return
+            else:
+                self.last_refresh_error = None
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        now = self.clock()
+        return {'refresh_interval': self.refresh_interval, 'retry_interval': self.retry_interval,
+                'background_refresh': self._thread is not None and self._thread.is_alive(),
+                'refresh_errors': self.refresh_errors, 'last_refresh_error': self.last_refresh_error,
+                'snapshot': dict(self.snapshot_status, path=self.snapshot_path or None),
+                'preload': self.preload_status, 'compact_maps': self.compact_maps,
+                'shared': dict(self.shared_status, path=self.shared_path or None),
+                'maps': {name: entry.get_status(now, self._next_refresh(entry))
+                         for name, entry in list(self._entries.items())}}
+
+
+@contextmanager
+def _locked(shared_path):
+    """
+    Exclusive lock of the processes of the host sharing a file, on shared_path.lock
+    """
+    with open(f'{shared_path}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield  # released when the file is closed
+
+
+def read_snapshot(data):
+    """
+    Check and decode a snapshot file
+
+    :param data: bytes, content of the file
+    :return: header as a dict, {name: map}
+    :raise ValueError: if the file is not a snapshot of the current version, or if its payload is corrupted
+    """
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError('not a metadata snapshot')
+    header, _, payload = data[len(SNAPSHOT_MAGIC):].partition(b'\n')
+    try:
+        header = json.loads(header.decode())
+    except ValueError:
+        raise ValueError('invalid header')
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"version {header.get('version')}, expected {SNAPSHOT_VERSION}")
+    if hashlib.sha256(payload).hexdigest() != header.get('sha256'):
+        raise ValueError('content does not match its hash')
+    maps = json.loads(payload.decode())
+    if not isinstance(maps, dict):
+        raise ValueError('invalid content')
+    return header, {name: from_json(value) for name, value in maps.items()}
+
+
+# maps of all the resource modules
+registry = MetadataRegistry()
+
+
+def metadata(loader=None, derived=False, lazy_key=None, lazy_iri=False):
+    """
+    Decorator registering a function loading a metadata map, which then returns the current map.
+    Used as @metadata, as @metadata(derived=True) for the maps computed from other maps,
+    or as @metadata(lazy_key=variable) for the maps which can be resolved per key.
+    The keys are then looked up with get_map.lookup(key, default), get_map.prefetch(keys)
+    and get_map.iter_prefetched(rows, key) resolving the keys needed by a request at once.
+
+    :param loader: function without parameters (with a VALUES clause as parameter, for lazy_key)
+    :param derived: see MetadataRegistry.register
+    :param lazy_key: see MetadataRegistry.register
+    :param lazy_iri: see MetadataRegistry.register
+    :return: function without parameters
+    """
+    if loader is None:
+        return lambda func: metadata(func, derived=derived, lazy_key=lazy_key, lazy_iri=lazy_iri)
+    name = f'{loader.__module__}.{loader.__name__}'
+    registry.register(name, loader, derived, lazy_key, lazy_iri)
+
+    @wraps(loader)
+    def get_map():
+        return registry.get(name)
+    get_map.lookup = lambda key, default=None: registry.lookup(name, key, default)
+    get_map.prefetch = lambda keys: registry.prefetch(name, keys)
+    get_map.iter_prefetched = lambda rows, key: registry.iter_prefetched(name, rows, key)
+    return get_map
@@ -0,0 +1,327 @@
+from collections import defaultdict
+from itertools import chain
+import gzip
+import logging
+import re
+import time
+
+
+# terms of the store: IRIs as is, literals prefixed with LITERAL_PREFIX (language and datatype dropped, as in the
+# csv results of a sparql endpoint), blank nodes as _:label
+LITERAL_PREFIX = '"'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+
+_TOKENS = re.compile(r'''
+    \s*(?:
+      <(?P<iri>[^<>"{}|^`\\\s]*)>
+    | "(?P<literal>(?:[^"\\]|\\.)*)"(?:@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*|\^\^<[^<>\s]*>)?
+    | (?P<bnode>_:[\w.-]*\w)
+    | [?$](?P<var>\w+)
+    | (?P<number>\d+)
+    | (?P<word>[A-Za-z]+)
+    | (?P<punct>[{}.;,*])
+    | \#[^\n]*
+    )''', re.VERBOSE)
+
+_ESCAPES = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_ESCAPED_CHARS = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape(value):
+    def _char(match):
+        code = match.group(1) or match.group(2)
+        if code:
+            return chr(int(code, 16))
+        if match.group(3) not in _ESCAPED_CHARS:
+            raise ValueError(f'invalid escape \\{match.group(3)}')
+        return _ESCAPED_CHARS[match.group(3)]
+    return _ESCAPES.sub(_char, value) if '\\' in value else value
+
+
+def tokenize(text):
+    """
+    Split N-Triples or a sparql query in tokens
+
+    :param text: str
+    :return: generator of (kind, value): iri, literal (unescaped), bnode, var, number, word or punct
+    :raise ValueError: at the first unexpected character
+    """
+    position = 0
+    end = len(text.rstrip())
+    while position < end:
+        match = _TOKENS.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f'unexpected text: {text[position:position + 40]!r}')
+        position = match.end()
+        kind = match.lastgroup
+        if kind is None:
+            continue  # comment
+        value = match.group(kind)
+        yield kind, _unescape(value) if kind == 'literal' else value
+
+
+def _term(kind, value):
+    if kind == 'iri' or kind == 'bnode':
+        return value
+    if kind == 'literal':
+        return LITERAL_PREFIX + value
+    raise ValueError(f'unexpected {kind} {value!r}')
+
+
+def parse_ntriples(lines):
+    """
+    Read N-Triples
+
+    :param lines: iterable of str
+    :return: generator of (subject, predicate, object) terms
+    :raise ValueError: for an invalid line, with its number
+    """
+    for number, line in enumerate(lines, 1):
+        try:
+            tokens = list(tokenize(line))
+            if not tokens:
+                continue
+            if len(tokens) != 4 or tokens[3] != ('punct', '.'):
+                raise ValueError('expected subject predicate object .')
+            yield tuple(_term(kind, value) for kind, value in tokens[:3])
+        except ValueError as err:
+            raise ValueError(f'line {number}: {err}')
+
+
+def parse_select(sparql_query):
+    """
+    Read a select query made of a basic graph pattern, with a VALUES clause: the subset of sparql used for the
+    metadata. Prefixes, filters, optional and union parts are not supported.
+
+    :param sparql_query: str
+    :return: (variables selected or None for *, [(variable, [term])] for the VALUES clauses,
+        [(subject, predicate, object)] terms or ('?', name) for variables, limit or None)
+    :raise ValueError: if the query is not supported
+    """
+    # keywords are case insensitive
+    tokens = [(kind, value.upper() if kind == 'word' and value != 'a' else value)
+              for kind, value in tokenize(sparql_query)]
+    tokens.append((None, None))
+    position = 0
+
+    def _next(*expected):
+        nonlocal position
+        kind, value = tokens[position]
+        if expected and (kind, value) not in expected and kind not in expected:
+            raise ValueError(f"unsupported sparql query: {value!r} found, {' or '.join(map(str, expected))} expected")
+        position += 1
+        return kind, value
+
+    def _pattern_term():
+        kind, value = _next('iri', 'literal', 'bnode', 'var', ('word', 'a'))
+        if kind == 'var':
+            return '?', value
+        if kind == 'word':
+            return RDF_TYPE
+        return _term(kind, value)
+
+    _next(('word', 'SELECT'))
+    variables = []
+    while tokens[position][0] == 'var':
+        variables.append(_next()[1])
+    if not variables:
+        _next(('punct', '*'))
+    if tokens[position] == ('word', 'WHERE'):
+        _next()
+    _next(('punct', '{'))
+    values, patterns = [], []
+    while tokens[position] != ('punct', '}'):
+        if tokens[position] == ('word', 'VALUES'):
+            _next()
+            variable = _next('var')[1]
+            _next(('punct', '{'))
+            terms = []
+            while tokens[position] != ('punct', '}'):
+                terms.append(_term(*_next('iri', 'literal')))
+            _next()
+            values.append((variable, terms))
+            continue
+        subject = _pattern_term()
+        while True:
+            predicate = _pattern_term()
+            while True:
+                patterns.append((subject, predicate, _pattern_term()))
+                if tokens[position] != ('punct', ','):
+                    break
+                _next()
+            if tokens[position] != ('punct', ';'):
+                break
+            _next()
+        if tokens[position] == ('punct', '.'):
+            _next()
+    _next()
+    limit = None
+    if tokens[position] == ('word', 'LIMIT'):
+        _next()
+        limit = int(_next('number')[1])
+    _next((None, None))
+    return variables or None, values, patterns, limit
+
+
+class TripleStore:
+    """
+    In-process triple store, indexed by predicate and subject and by predicate and object, the terms being stored
+    once as integers. It answers the select queries of parse_select, without sparql endpoint.
+    """
+
+    def __init__(self):
+        self._ids = {}  # {term: id}
+        self._terms = []  # terms by id
+        self._spo = defaultdict(lambda: defaultdict(list))  # {predicate: {subject: [object]}}
+        self._pos = defaultdict(lambda: defaultdict(list))  # {predicate: {object: [subject]}}
+        self.nb_triples = 0
+
+    def _id(self, term):
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+        return term_id
+
+    def add(self, subject, predicate, obj):
+        """
+        Add a triple, ignored if already in the store
+
+        :param subject: term
+        :param predicate: term
+        :param obj: term
+        """
+        s, p, o = self._id(subject), self._id(predicate), self._id(obj)
+        objects = self._spo[p][s]
+        if o in objects:
+            return
+        objects.append(o)
+        self._pos[p][o].append(s)
+        self.nb_triples += 1
+
+    def load(self, path):
+        """
+        Add the triples of a N-Triples file
+
+        :param path: .nt file, or .nt.gz
+        :return: int, number of triples added
+        """
+        nb_triples = self.nb_triples
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for triple in parse_ntriples(f):
+                self.add(*triple)
+        return self.nb_triples - nb_triples
+
+    def __len__(self):
+        return self.nb_triples
+
+    def select(self, sparql_query):
+        """
+        Answer a select query
+
+        :param sparql_query: str, see parse_select
+        :return: variables, [tuple of terms, None if unbound]
+        """
+        selected, values, patterns, limit = parse_select(sparql_query)
+        variables = selected or list(dict.fromkeys(chain(
+            (variable for variable, _ in values),
+            (term[1] for pattern in patterns for term in pattern if isinstance(term, tuple)))))
+        unknown = []  # terms of the VALUES clauses not in the store, given negative ids
+
+        def _values_id(term):
+            term_id = self._ids.get(term)
+            if term_id is None:
+                unknown.append(term)
+                term_id = -len(unknown)
+            return term_id
+
+        solutions = [{}]
+        for variable, terms in values:
+            ids = [_values_id(term) for term in terms]
+            solutions = [dict(solution, **{variable: term_id}) for solution in solutions for term_id in ids
+                         if solution.get(variable, term_id) == term_id]
+        remaining = list(patterns)
+        while remaining and solutions:
+            # most bound pattern first, so that each pattern is an index lookup
+            pattern = max(remaining, key=lambda pattern: sum(not isinstance(term, tuple) or term[1] in solutions[0]
+                                                             for term in pattern))
+            remaining.remove(pattern)
+            solutions = [extended for solution in solutions for extended in self._match(pattern, solution)]
+        if limit is not None:
+            solutions = solutions[:limit]
+        terms = self._terms
+
+        def _term_of(term_id):
+            if term_id is None:
+                return None
+            return terms[term_id] if term_id >= 0 else unknown[-term_id - 1]
+        return variables, [tuple(_term_of(solution.get(variable)) for variable in variables) for solution in solutions]
+
+    def _match(self, pattern, solution):
+        bound = []
+        for term in pattern:
+            if isinstance(term, tuple):
+                bound.append(solution.get(term[1]))
+            else:
+                term_id = self._ids.get(term)
+                if term_id is None:
+                    return
+                bound.append(term_id)
+        s, p, o = bound
+        for predicate in ([p] if p is not None else list(self._spo)):
+            if s is not None:
+                triples = ((s, obj) for obj in self._spo.get(predicate, {}).get(s, ()) if o is None or obj == o)
+            elif o is not None:
+                triples = ((subject, o) for subject in self._pos.get(predicate, {}).get(o, ()))
+            else:
+                triples = ((subject, obj) for subject, objects in self._spo.get(predicate, {}).items()
+                           for obj in objects)
+            for subject, obj in triples:
+                extended = dict(solution)
+                if all(extended.setdefault(term[1], value) == value
+                       for term, value in zip(pattern, (subject, predicate, obj)) if isinstance(term, tuple)):
+                    yield extended
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        return {'triples': self.nb_triples, 'terms': len(self._terms), 'predicates': len(self._spo)}
+
+
+def term_value(term):
+    """
+    :param term: term of the store, or None
+    :return: str, value of the term as in the csv results of a sparql endpoint ('' if unbound)
+    """
+    if term is None:
+        return ''
+    return term[len(LITERAL_PREFIX):] if term.startswith(LITERAL_PREFIX) else term
+
+
+def term_json(term):
+    """
+    :param term: term of the store
+    :return: dict, term in the json results of a sparql endpoint
+    """
+    if term.startswith(LITERAL_PREFIX):
+        return {'type': 'literal', 'value': term[len(LITERAL_PREFIX):]}
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    return {'type': 'uri', 'value': term}
+
+
+def load_store(path):
+    """
+    Load a N-Triples dump in a TripleStore, logging its size and loading time
+
+    :param path: .nt or .nt.gz file
+    :return: TripleStore
+    """
+    start = time.perf_counter()
+    store = TripleStore()
+    store.load(path)
+    logging.getLogger('TripleStore').info(f'{len(store)} triples loaded from {path} in '
+                                          f'{round((time.perf_counter() - start) * 1000, 3)} ms')
+    return store
@@ -2,6 +2,8 @@ from datetime import datetime
 
 
 def date_to_datetime(date):
+    if date is None:
+        return None
     return datetime.combine(date, datetime.min.time())
 
 
@@ -1,10 +1,15 @@
-from flask import Flask, abort, jsonify
+from flask import Flask, Response, abort, jsonify, request, stream_with_context, url_for
 from werkzeug.exceptions import HTTPException
 import json
 import logging.config
 
 from utils.db_connect import PostgresqlDB, SparqlDB
 from utils.config_parser import get_local_file, parse_full_config
+from utils.fhir_templates import set_builders
+from utils.metadata import registry as metadata_registry
+from utils.cache import CachedResponse, get_cache, make_cache_key, make_etag
+from utils.api import STREAM_MIMETYPES, batch_json, cached_response, encode_page_key, parse_batch_args, \
+    parse_format_args, parse_search_ids, render_data, searchset_bundle, set_response_config, stream_body
 import patient
 import encounter
 import observation
@@ -14,6 +19,7 @@ import procedure
 import claim
 import questionnaireResponse
 import bacteriologie
+import everything
 
 # init postgres DB
 config = parse_full_config(get_local_file('config.yaml'), get_local_file('config_env.yaml'))
@@ -29,6 +35,11 @@ app.config.from_object('config.Config')
 
 postgres_db = PostgresqlDB(app)
 sparql_db = SparqlDB(**config['sparql_db'])
+response_cache = get_cache(config.get('cache'))
+set_builders(config['app'].get('builders'))
+set_response_config(config.get('responses'))
+# started in each process serving requests, see start_metadata
+metadata_started = False
 
 
 ##########
@@ -69,15 +80,125 @@ def resource_not_found(e):
 # API routes
 #######
 
-def process_data(ressource_desc, func, *args):
+def make_searchset(resources, count, next_key):
+    """
+    Wrap a page of resources in a searchset bundle, with a next link if there is a next page
+
+    :param resources: [resource as json]
+    :param count: number of resources by page
+    :param next_key: page key of the next page, or None
+    :return: fhir.Bundle as json
+    """
+    next_url = None
+    if next_key is not None:
+        next_url = url_for(request.endpoint, _external=True, _count=count,
+                           _cursor=encode_page_key(next_key), **request.view_args)
+    return searchset_bundle(resources, request.url, next_url)
+
+
+def process_data(ressource_desc, func, *args, streamable=False, pageable=False):
     try:
-        return jsonify(func(*args))
+        response_format, stream_format, page = parse_format_args(request.args, streamable, pageable)
+    except ValueError as e:
+        logger.debug(str(e))
+        abort(400)
+    cache_key = get_cache_key() if stream_format is None else None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return make_cached_response(cached)
+    try:
+        if page is not None:
+            resources, next_key = func(*args, page=page)
+            body = render_data(make_searchset(resources, page[0], next_key))
+        elif stream_format is not None:
+            return stream_data(ressource_desc, func(*args, stream=True), stream_format)
+        else:
+            body = render_data(func(*args), response_format)
     except ValueError as e:
         print(e)
         abort(404, description=f"Resource not found : {ressource_desc}")
     except Exception as e:
         print(e)
         abort(500, description=f"Unknow error : {e}")
+    cached = CachedResponse(body, STREAM_MIMETYPES[response_format], make_etag(body))
+    if cache_key is not None:
+        response_cache.set(cache_key, cached)
+    return make_cached_response(cached)
+
+
+def get_cache_key():
+    """
+    Cache key of the request, see utils.cache.make_cache_key
+
+    :return: str, or None if the response must not be cached
+    """
+    if response_cache is None or request.method != 'GET':
+        return None
+    return make_cache_key(request.endpoint, request.view_args, request.query_string.decode())
+
+
+def make_cached_response(cached):
+    """
+    Response of a cached body, see utils.api.cached_response
+
+    :param cached: utils.cache.CachedResponse
+    :return: flask.Response
+    """
+    status, body, headers = cached_response(cached, request.headers.get('Accept-Encoding'),
+                                            request.headers.get('If-None-Match'))
+    if body is None:
+        return Response(status=status, headers=headers)
+    return Response(body, mimetype=cached.mimetype, headers=headers)
+
+
+def process_batch(ressource_desc, funcs):
+    """
+    Process a batch request, see utils.api.parse_batch_args
+
+    :param ressource_desc: str, description of the resources for the errors
+    :param funcs: {key of the request body: function taking [id] and returning {id: resource(s) as json}}
+    :return: flask.Response, {id: resource(s)} as json
+    """
+    try:
+        kind, nums = parse_batch_args(request.get_json(force=True, silent=True), funcs)
+    except ValueError as e:
+        logger.debug(str(e))
+        abort(400)
+    return process_data(f"{ressource_desc} for {kind} {nums}", lambda *args: batch_json(funcs[kind](*args)), nums)
+
+
+def stream_data(ressource_desc, resources, stream_format):
+    """
+    Stream resources as they are built, see utils.api.stream_body
+
+    :param ressource_desc: str, description of the resources for the logs
+    :param resources: generator of resources as json
+    :param stream_format: 'json' or 'ndjson'
+    :return: flask.Response
+    """
+    first = next(resources, None)
+    chunks, headers = stream_body(ressource_desc, first, resources, stream_format,
+                                  request.headers.get('Accept-Encoding'), logger)
+    return Response(stream_with_context(chunks), mimetype=STREAM_MIMETYPES[stream_format], headers=headers)
+
+
+@app.route('/status/pools')
+def get_pools_status():
+    return jsonify({
+        'postgres_db': postgres_db.get_pool_status(),
+        'sparql_db': sparql_db.get_pool_status(),
+    })
+
+
+@app.route('/status/cache')
+def get_cache_status():
+    return jsonify(response_cache.get_status() if response_cache is not None else {'backend': 'none'})
+
+
+@app.route('/status/metadata')
+def get_metadata_status():
+    return jsonify(metadata_registry.get_status())
 
 
 @app.route('/patients/<patient_num>')
@@ -92,76 +213,99 @@ def get_encounter(encounter_num):
                         encounter.get_encounter, encounter_num)
 
 
+@app.route('/encounters')
+def get_encounters_patient():
+    try:
+        patient_nums = parse_search_ids(request.args.get('patient'))
+    except ValueError as e:
+        logger.debug(str(e))
+        abort(400)
+    return process_data(f"Encounters for PATIENT_NUM = {patient_nums}",
+                        encounter.get_encounters_for_patients, patient_nums)
+
+
 @app.route('/patients/<patient_num>/labResults')
 def get_labresults_patient(patient_num):
     return process_data(f"Observations for PATIENT_NUM = {patient_num}",
-                        observation.get_obs_for_patient, patient_num)
+                        observation.get_obs_for_patient, patient_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/labResults')
 def get_labresults_encounter(encounter_num):
     return process_data(f"Observations for ENCOUNTER_NUM = {encounter_num}",
-                        observation.get_obs_for_encounter, encounter_num)
+                        observation.get_obs_for_encounter, encounter_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/patients/<patient_num>/clinicalReports')
 def get_clinicalreport_patient(patient_num):
     return process_data(f"Diag Reports for PATIENT_NUM = {patient_num}",
-                        diagnostic_report.get_report_for_patient, patient_num)
+                        diagnostic_report.get_report_for_patient, patient_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/clinicalReports')
 def get_clinicalreport_encounter(encounter_num):
     return process_data(f"Diag Reports for ENCOUNTER_NUM = {encounter_num}",
-                        diagnostic_report.get_report_for_encounter, encounter_num)
+                        diagnostic_report.get_report_for_encounter, encounter_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/patients/<patient_num>/medicationAdministrations')
 def get_medication_patient(patient_num):
     return process_data(f"Medication Administrations for PATIENT_NUM = {patient_num}",
-                        medicationAdministration.get_med_for_patient, patient_num)
+                        medicationAdministration.get_med_for_patient, patient_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/medicationAdministrations')
 def get_medication_encounter(encounter_num):
     return process_data(f"Medication Administrations for ENCOUNTER_NUM = {encounter_num}",
-                        medicationAdministration.get_med_for_encounter, encounter_num)
+                        medicationAdministration.get_med_for_encounter, encounter_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/patients/<patient_num>/procedures')
 def get_procedure_patient(patient_num):
     return process_data(f"Procedures for PATIENT_NUM = {patient_num}",
-                        procedure.get_proc_for_patient, patient_num)
+                        procedure.get_proc_for_patient, patient_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/procedures')
 def get_procedure_encounter(encounter_num):
     return process_data(f"Procedures for ENCOUNTER_NUM = {encounter_num}",
-                        procedure.get_proc_for_encounter, encounter_num)
+                        procedure.get_proc_for_encounter, encounter_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/patients/<patient_num>/pmsis')
 def get_pmsi_patient(patient_num):
     return process_data(f"PMSIs for PATIENT_NUM = {patient_num}",
-                        claim.get_pmsis_for_patient, patient_num)
+                        claim.get_pmsis_for_patient, patient_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/pmsis')
 def get_pmsi_encounter(encounter_num):
     return process_data(f"PMSIs for ENCOUNTER_NUM = {encounter_num}",
-                        claim.get_pmsis_for_encounter, encounter_num)
+                        claim.get_pmsis_for_encounter, encounter_num,
+                        streamable=True, pageable=True)
 
 
 @app.route('/patients/<patient_num>/questionnaireResponses')
 def get_quest_patient(patient_num):
     return process_data(f"Questionnaire Responses for PATIENT_NUM = {patient_num}",
-                        questionnaireResponse.get_quest_for_patient, patient_num)
+                        questionnaireResponse.get_quest_for_patient, patient_num,
+                        pageable=True)
 
 
 @app.route('/encounters/<encounter_num>/questionnaireResponses')
 def get_quest_encounter(encounter_num):
     return process_data(f"Questionnaire Responses for ENCOUNTER_NUM = {encounter_num}",
-                        questionnaireResponse.get_quest_for_encounter, encounter_num)
+                        questionnaireResponse.get_quest_for_encounter, encounter_num,
+                        pageable=True)
 
 
 @app.route('/patients/<patient_num>/bacteriology')
@@ -176,29 +320,94 @@ def get_bacterio_encounter(encounter_num):
                         bacteriologie.get_synergy_for_encounter, encounter_num)
 
 
+@app.route('/patients/<patient_num>/$everything')
+def get_everything_patient(patient_num):
+    return process_data(f"Everything for PATIENT_NUM = {patient_num}",
+                        lambda num: searchset_bundle(everything.get_everything_for_patient(num), request.url),
+                        patient_num)
+
+
+@app.route('/patients/_batch', methods=['POST'])
+def get_patients_batch():
+    return process_batch("Patients", {'patients': patient.get_patients})
+
+
+@app.route('/encounters/_batch', methods=['POST'])
+def get_encounters_batch():
+    return process_batch("Encounters", {'encounters': encounter.get_encounters})
+
+
+@app.route('/labResults/_batch', methods=['POST'])
+def get_labresults_batch():
+    return process_batch("Observations", {'patients': observation.get_obs_for_patients,
+                                          'encounters': observation.get_obs_for_encounters})
+
+
+@app.route('/clinicalReports/_batch', methods=['POST'])
+def get_clinicalreport_batch():
+    return process_batch("Diag Reports", {'patients': diagnostic_report.get_report_for_patients,
+                                          'encounters': diagnostic_report.get_report_for_encounters})
+
+
+@app.route('/medicationAdministrations/_batch', methods=['POST'])
+def get_medication_batch():
+    return process_batch("Medication Administrations", {'patients': medicationAdministration.get_med_for_patients,
+                                                        'encounters': medicationAdministration.get_med_for_encounters})
+
+
+@app.route('/procedures/_batch', methods=['POST'])
+def get_procedure_batch():
+    return process_batch("Procedures", {'patients': procedure.get_proc_for_patients,
+                                        'encounters': procedure.get_proc_for_encounters})
+
+
+@app.route('/pmsis/_batch', methods=['POST'])
+def get_pmsi_batch():
+    return process_batch("PMSIs", {'patients': claim.get_pmsis_for_patients,
+                                   'encounters': claim.get_pmsis_for_encounters})
+
+
+@app.route('/questionnaireResponses/_batch', methods=['POST'])
+def get_quest_batch():
+    return process_batch("Questionnaire Responses", {'patients': questionnaireResponse.get_quest_for_patients,
+                                                     'encounters': questionnaireResponse.get_quest_for_encounters})
+
+
+@app.route('/bacteriology/_batch', methods=['POST'])
+def get_bacterio_batch():
+    return process_batch("Bacteriology", {'patients': bacteriologie.get_synergy_for_patients,
+                                          'encounters': bacteriologie.get_synergy_for_encounters})
+
+
+@app.before_first_request
+def start_metadata():
+    """
+    Read the metadata section of the config and start the background refresh, once per process.
+    Called here, on the first request, or from a post-fork hook of the WSGI server (e.g. post_fork of gunicorn):
+    a refresh thread started before the fork would not run in the workers.
+    """
+    global metadata_started
+    if metadata_started:
+        return
+    metadata_started = True
+    metadata_registry.start(config.get('metadata'))
+
+
+def preload_metadata():
+    """
+    Load the metadata maps concurrently, see the metadata section of the config, once started by start_metadata.
+    To be called before serving requests, here or from a startup hook of the WSGI server
+    (e.g. post_worker_init of gunicorn).
+    """
+    start_metadata()
+    logger.info('Preloading metadata...')
+    metadata_registry.preload()
+
+
 if __name__ == "__main__":
+    start_metadata()
     if config['app']['preload_metadata']:
-        logger.info('Preloading metadata...')
-        logger.info('       for observations')
-        observation._get_request_1()
-        logger.info('       for diagnostic reports')
-        diagnostic_report._get_request_1()
-        logger.info('       for medication administrations')
-        medicationAdministration._get_request_1()
-        logger.info('       for procedures')
-        procedure._get_request_1()
-        procedure._get_request_2()
-        logger.info('       for claims')
-        claim._get_request_1()
-        claim._get_request_2()
-        logger.info('       for questionnaireResponses')
-        questionnaireResponse._get_request_1()
-        questionnaireResponse._get_request_2()
-        questionnaireResponse._get_request_3()
-        questionnaireResponse._get_request_4()
-        logger.info('       for bacteriology')
-        bacteriologie._get_request_1()
-        bacteriologie._get_request_2()
+        preload_metadata()
 
     logger.info('Starting FHIR API')
     app.run()
\ No newline at end of file
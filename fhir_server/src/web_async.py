@@ -0,0 +1,639 @@
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import HTMLResponse, Response, StreamingResponse
+from starlette.routing import Route
+from http import HTTPStatus
+from urllib.parse import quote, urlencode
+import asyncio
+import json
+import logging.config
+import uvicorn
+
+from utils.db_connect import SparqlDB, group_rows
+from utils.db_connect_async import AsyncPostgresqlDbInit, AsyncSparqlDbInit, SyncRows
+from utils.config_parser import get_local_file, parse_full_config
+from utils.fhir_templates import set_builders
+from utils.metadata import registry as metadata_registry
+from utils.cache import CachedResponse, get_cache, make_cache_key, make_etag
+from utils.api import BATCH_COLUMNS, STREAM_MIMETYPES, batch_json, cached_response, dumps_resource, \
+    encode_page_key, parse_batch_args, parse_format_args, parse_search_ids, render_data, searchset_bundle, \
+    set_response_config, stream_body
+import patient
+import encounter
+import observation
+import diagnostic_report
+import medicationAdministration
+import procedure
+import claim
+import questionnaireResponse
+import bacteriologie
+import everything
+
+# Same API as web.py, served by an ASGI app: database and sparql queries are sent by the event loop,
+# resources are built in worker threads by the functions of the resource modules.
+
+config = parse_full_config(get_local_file('config.yaml'), get_local_file('config_env.yaml'))
+# the loggers already created stay enabled (modules imported above, or web.py in the tests)
+logging.config.fileConfig(get_local_file('logging.ini'), disable_existing_loggers=False)
+logging.getLogger().setLevel(config['app']['log_level'])
+
+logger = logging.getLogger('Starlette')
+logger.debug('Creating app')
+
+postgres_db = AsyncPostgresqlDbInit(**config['postgres_db'])
+# the resource modules use SparqlDB() for their metadata, so the async client is installed as its instance,
+# unless the metadata are answered in process from a dump (store_path)
+if not config['sparql_db'].get('store_path'):
+    SparqlDB.instance = AsyncSparqlDbInit(**config['sparql_db'])
+sparql_db = SparqlDB(**config['sparql_db'])
+response_cache = get_cache(config.get('cache'))
+set_builders(config['app'].get('builders'))
+set_response_config(config.get('responses'))
+
+NOT_FOUND_DESCRIPTION = 'The requested URL was not found on the server. ' \
+                        'If you entered the URL manually please check your spelling and try again.'
+
+
+class JSONResponse(Response):
+    """Serializes its content the way flask.jsonify does, so that both servers answer the same bytes"""
+    media_type = 'application/json'
+
+    def render(self, content):
+        return (dumps_resource(content) + '\n').encode('utf-8')
+
+
+##########
+# Handle errors
+##########
+
+def bad_request(description=''):
+    logger.debug(description)
+    return HTMLResponse('bad request!', status_code=400)
+
+
+def resource_not_found(description=NOT_FOUND_DESCRIPTION):
+    message = f'404 {HTTPStatus(404).phrase}: {description}'
+    logger.info(message)
+    return JSONResponse({'error': message}, status_code=404)
+
+
+def http_error(status_code, description=''):
+    """Return JSON instead of HTML for HTTP errors."""
+    logger.error(f'{status_code} {HTTPStatus(status_code).phrase}: {description}')
+    return Response(json.dumps({
+        "code": status_code,
+        "name": HTTPStatus(status_code).phrase,
+    }), status_code=status_code, media_type='application/json')
+
+
+async def handle_exception(request, exc):
+    if exc.status_code == 400:
+        return bad_request(exc.detail)
+    if exc.status_code == 404:
+        return resource_not_found()
+    return http_error(exc.status_code, exc.detail)
+
+
+async def handle_server_error(request, exc):
+    return http_error(500, str(exc))
+
+
+########
+# API routes
+#######
+
+def request_url(request):
+    """
+    Url of the request, with its path quoted as flask's request.url
+
+    :param request: starlette.requests.Request
+    :return: str
+    """
+    return str(request.url.replace(path=quote(request.url.path, safe='/:')))
+
+
+def make_searchset(request, resources, count, next_key):
+    """
+    Wrap a page of resources in a searchset bundle, with a next link if there is a next page
+
+    :param request: starlette.requests.Request
+    :param resources: [resource as json]
+    :param count: number of resources by page
+    :param next_key: page key of the next page, or None
+    :return: fhir.Bundle as json
+    """
+    next_url = None
+    if next_key is not None:
+        next_url = request.url_for(request.scope['endpoint'].__name__, **request.path_params) \
+                   + '?' + urlencode({'_count': count, '_cursor': encode_page_key(next_key)})
+    return searchset_bundle(resources, request_url(request), next_url)
+
+
+async def process_data(request, ressource_desc, func, *args):
+    """
+    Run a coroutine and build the response from its result, with the error codes of web.process_data
+
+    :param request: starlette.requests.Request
+    :param ressource_desc: str, description of the resource for the errors
+    :param func: coroutine function returning the resource(s) as json
+    :param args: arguments of func
+    :return: starlette.responses.Response
+    """
+    try:
+        response_format, _, _ = parse_format_args(request.query_params)
+    except ValueError as e:
+        return bad_request(str(e))
+    cache_key = get_cache_key(request)
+    if cache_key is not None:
+        cached = await run_in_threadpool(response_cache.get, cache_key)
+        if cached is not None:
+            return make_cached_response(request, cached)
+    try:
+        body = await run_in_threadpool(render_data, await func(*args), response_format)
+    except ValueError as e:
+        logger.debug(str(e))
+        return resource_not_found(f"Resource not found : {ressource_desc}")
+    except Exception as e:
+        logger.debug(str(e))
+        return http_error(500, f"Unknow error : {e}")
+    cached = CachedResponse(body, STREAM_MIMETYPES[response_format], make_etag(body))
+    if cache_key is not None:
+        await run_in_threadpool(response_cache.set, cache_key, cached)
+    return make_cached_response(request, cached)
+
+
+def get_cache_key(request):
+    """
+    Cache key of the request, see utils.cache.make_cache_key
+
+    :param request: starlette.requests.Request
+    :return: str, or None if the response must not be cached
+    """
+    if response_cache is None or request.method != 'GET':
+        return None
+    return make_cache_key(request.scope['endpoint'].__name__, request.path_params, request.url.query)
+
+
+def make_cached_response(request, cached):
+    """
+    Response of a cached body, see utils.api.cached_response
+
+    :param request: starlette.requests.Request
+    :param cached: utils.cache.CachedResponse
+    :return: starlette.responses.Response
+    """
+    status, body, headers = cached_response(cached, request.headers.get('Accept-Encoding'),
+                                            request.headers.get('If-None-Match'))
+    if body is None:
+        return Response(status_code=status, headers=headers)
+    return Response(body, media_type=cached.mimetype, headers=headers)
+
+
+async def process_list(request, ressource_desc, build, statement_name, *params, streamable=False, pageable=False):
+    """
+    Fetch the rows of a registered statement and build a list of resources from them,
+    with the same _stream, _count and _cursor parameters as web.py
+
+    :param request: starlette.requests.Request
+    :param ressource_desc: str, description of the resources for the errors
+    :param build: function building the resources from an iterable of rows
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param streamable: if True, the _stream parameter is accepted
+    :param pageable: if True, the _count and _cursor parameters are accepted
+    :return: starlette.responses.Response
+    """
+    try:
+        _, stream_format, page = parse_format_args(request.query_params, streamable, pageable)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    if stream_format is not None:
+        return await stream_data(request, ressource_desc, build, statement_name, params, stream_format)
+
+    async def _fetch_and_build():
+        if page is not None:
+            rows, next_key = await postgres_db.fetch_page(statement_name, page, *params)
+            resources = await run_in_threadpool(lambda: list(build(rows)))
+            return make_searchset(request, resources, page[0], next_key)
+        rows = await postgres_db.fetch_rows(statement_name, *params)
+        return await run_in_threadpool(lambda: list(build(rows)))
+
+    return await process_data(request, ressource_desc, _fetch_and_build)
+
+
+async def read_batch(request, kinds):
+    """
+    Read the body of a batch request, see utils.api.parse_batch_args
+
+    :param request: starlette.requests.Request
+    :param kinds: accepted keys of the body
+    :return: key of the body, [id as int]
+    :raise: ValueError if the body is invalid
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    return parse_batch_args(body, kinds)
+
+
+async def process_batch(request, ressource_desc, statements, build, keep_empty=True):
+    """
+    Process a batch request with a batch statement, the same way as web.process_batch
+
+    :param request: starlette.requests.Request
+    :param ressource_desc: str, description of the resources for the errors
+    :param statements: {key of the request body: name of the batch statement, taking an array of ids}
+    :param build: function building the resource(s) of an id from its rows
+    :param keep_empty: if False, the ids without rows are not in the response
+    :return: starlette.responses.Response
+    """
+    try:
+        kind, nums = await read_batch(request, statements)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    async def _fetch_and_build():
+        rows = await postgres_db.fetch_rows(statements[kind], nums)
+        rows_by_num = group_rows(rows, BATCH_COLUMNS[kind], nums if keep_empty else [])
+        return batch_json(await run_in_threadpool(
+            lambda: {num: _as_list(build(num_rows)) for num, num_rows in rows_by_num.items()}))
+
+    return await process_data(request, f"{ressource_desc} for {kind} {nums}", _fetch_and_build)
+
+
+def _as_list(resources):
+    """list of the resources built by a generator, the other builders return a resource or a list"""
+    return resources if isinstance(resources, (dict, list)) else list(resources)
+
+
+async def stream_data(request, ressource_desc, build, statement_name, params, stream_format):
+    """
+    Stream resources as they are built, see utils.api.stream_body
+
+    Rows are fetched by batches by the event loop, and consumed by build in worker threads, where the chunks of the
+    body are written.
+
+    :param request: starlette.requests.Request
+    :param ressource_desc: str, description of the resources for the errors
+    :param build: function building a generator of resources from an iterable of rows
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :param stream_format: 'json' or 'ndjson'
+    :return: starlette.responses.Response
+    """
+    batches = postgres_db.iter_batches(statement_name, *params)
+    resources = build(SyncRows(batches, asyncio.get_event_loop()))
+    try:
+        first = await run_in_threadpool(next, resources, None)
+    except Exception as e:
+        await batches.aclose()
+        if isinstance(e, ValueError):
+            return resource_not_found(f"Resource not found : {ressource_desc}")
+        return http_error(500, f"Unknow error : {e}")
+
+    chunks, headers = stream_body(ressource_desc, first, resources, stream_format,
+                                  request.headers.get('Accept-Encoding'), logger)
+
+    async def _generate():
+        try:
+            while True:
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
+            await batches.aclose()
+
+    return StreamingResponse(_generate(), media_type=STREAM_MIMETYPES[stream_format], headers=headers)
+
+
+async def fetch_synergy(statement_name, *params):
+    """
+    async version of bacteriologie._process_synergy_request
+
+    :param statement_name: name of the search statement
+    :param params: parameters of the search statement
+    :return: [fhirclient.models.bundle.Bundle() as json]
+    """
+    data_prelevements = await postgres_db.fetch_rows(statement_name, *params)
+    instances_nums_results = bacteriologie._get_results_instances(data_prelevements)
+    instances_nums_res = [instance_num_res for instance_nums_res in instances_nums_results.values()
+                          for instance_num_res in instance_nums_res]
+    results_observations_data = group_rows(await postgres_db.fetch_rows('synergy_results', instances_nums_res),
+                                           'INSTANCE_NUM', instances_nums_res)
+    return await run_in_threadpool(bacteriologie._build_synergy, data_prelevements, instances_nums_results,
+                                   results_observations_data)
+
+
+async def fetch_synergy_batch(statement_name, column, nums):
+    """
+    async version of bacteriologie._process_synergy_batch
+
+    :param statement_name: name of the batch search statement, taking an array of nums
+    :param column: column of the nums, PATIENT_NUM or ENCOUNTER_NUM
+    :param nums: [int]
+    :return: {num as str: [fhirclient.models.bundle.Bundle() as json]}
+    """
+    rows_by_num = group_rows(await postgres_db.fetch_rows(statement_name, nums), column, nums)
+    instances_by_num = {num: bacteriologie._get_results_instances(num_rows) for num, num_rows in rows_by_num.items()}
+    instances_nums_res = [instance_num_res for instances_nums_results in instances_by_num.values()
+                          for instance_nums_res in instances_nums_results.values()
+                          for instance_num_res in instance_nums_res]
+    results_observations_data = group_rows(await postgres_db.fetch_rows('synergy_results', instances_nums_res),
+                                           'INSTANCE_NUM', instances_nums_res)
+    return batch_json(await run_in_threadpool(
+        lambda: {num: bacteriologie._build_synergy(rows_by_num[num], instances_by_num[num], results_observations_data)
+                 for num in rows_by_num}))
+
+
+async def fetch_everything(request, patient_num):
+    """
+    async version of everything.get_everything_for_patient, wrapped in a searchset bundle
+
+    :param request: starlette.requests.Request
+    :param patient_num: str
+    :return: fhir.Bundle as json
+    """
+    # unknown patients are answered before scanning the facts of all the source systems
+    patient_resource = patient._build_patient(await postgres_db.fetch_rows('patient', patient_num))
+    rows = await postgres_db.fetch_rows('everything_for_patient', patient_num)
+    resources = await run_in_threadpool(everything._build_everything, patient_resource, rows)
+    return searchset_bundle(resources, request_url(request))
+
+
+async def fetch_and_build(build, statement_name, *params):
+    rows = await postgres_db.fetch_rows(statement_name, *params)
+    return await run_in_threadpool(build, rows)
+
+
+async def get_pools_status(request):
+    return JSONResponse({
+        'postgres_db': postgres_db.get_pool_status(),
+        'sparql_db': sparql_db.get_pool_status(),
+    })
+
+
+async def get_cache_status(request):
+    return JSONResponse(response_cache.get_status() if response_cache is not None else {'backend': 'none'})
+
+
+async def get_metadata_status(request):
+    return JSONResponse(metadata_registry.get_status())
+
+
+async def get_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_data(request, f"Patient with PATIENT_NUM = {patient_num}",
+                              fetch_and_build, patient._build_patient, 'patient', patient_num)
+
+
+async def get_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_data(request, f"Encounter with ENCOUNTER_NUM = {encounter_num}",
+                              fetch_and_build, encounter._build_encounter, 'encounter', encounter_num)
+
+
+async def get_encounters_patient(request):
+    try:
+        patient_nums = parse_search_ids(request.query_params.get('patient'))
+    except ValueError as e:
+        return bad_request(str(e))
+    return await process_data(request, f"Encounters for PATIENT_NUM = {patient_nums}",
+                              fetch_and_build, encounter._build_encounters, 'encounters_for_patients', patient_nums)
+
+
+async def get_labresults_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"Observations for PATIENT_NUM = {patient_num}",
+                              observation._iter_obs, 'obs_for_patient', patient_num,
+                              streamable=True, pageable=True)
+
+
+async def get_labresults_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"Observations for ENCOUNTER_NUM = {encounter_num}",
+                              observation._iter_obs, 'obs_for_encounter', encounter_num,
+                              streamable=True, pageable=True)
+
+
+async def get_clinicalreport_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"Diag Reports for PATIENT_NUM = {patient_num}",
+                              diagnostic_report._iter_report, 'report_for_patient', patient_num,
+                              streamable=True, pageable=True)
+
+
+async def get_clinicalreport_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"Diag Reports for ENCOUNTER_NUM = {encounter_num}",
+                              diagnostic_report._iter_report, 'report_for_encounter', encounter_num,
+                              streamable=True, pageable=True)
+
+
+async def get_medication_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"Medication Administrations for PATIENT_NUM = {patient_num}",
+                              medicationAdministration._iter_med, 'med_for_patient', patient_num,
+                              streamable=True, pageable=True)
+
+
+async def get_medication_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"Medication Administrations for ENCOUNTER_NUM = {encounter_num}",
+                              medicationAdministration._iter_med, 'med_for_encounter', encounter_num,
+                              streamable=True, pageable=True)
+
+
+async def get_procedure_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"Procedures for PATIENT_NUM = {patient_num}",
+                              procedure._iter_proc, 'proc_for_patient', patient_num,
+                              streamable=True, pageable=True)
+
+
+async def get_procedure_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"Procedures for ENCOUNTER_NUM = {encounter_num}",
+                              procedure._iter_proc, 'proc_for_encounter', encounter_num,
+                              streamable=True, pageable=True)
+
+
+async def get_pmsi_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"PMSIs for PATIENT_NUM = {patient_num}",
+                              claim._iter_pmsi, 'pmsis_for_patient', patient_num,
+                              streamable=True, pageable=True)
+
+
+async def get_pmsi_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"PMSIs for ENCOUNTER_NUM = {encounter_num}",
+                              claim._iter_pmsi, 'pmsis_for_encounter', encounter_num,
+                              streamable=True, pageable=True)
+
+
+async def get_quest_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_list(request, f"Questionnaire Responses for PATIENT_NUM = {patient_num}",
+                              questionnaireResponse._build_quest, 'quest_for_patient', patient_num,
+                              pageable=True)
+
+
+async def get_quest_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_list(request, f"Questionnaire Responses for ENCOUNTER_NUM = {encounter_num}",
+                              questionnaireResponse._build_quest, 'quest_for_encounter', encounter_num,
+                              pageable=True)
+
+
+async def get_bacterio_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_data(request, f"Bacteriology for PATIENT_NUM = {patient_num}",
+                              fetch_synergy, 'synergy_for_patient', patient_num)
+
+
+async def get_bacterio_encounter(request):
+    encounter_num = request.path_params['encounter_num']
+    return await process_data(request, f"Bacteriology for ENCOUNTER_NUM = {encounter_num}",
+                              fetch_synergy, 'synergy_for_encounter', encounter_num)
+
+
+async def get_everything_patient(request):
+    patient_num = request.path_params['patient_num']
+    return await process_data(request, f"Everything for PATIENT_NUM = {patient_num}",
+                              fetch_everything, request, patient_num)
+
+
+async def get_patients_batch(request):
+    return await process_batch(request, "Patients", {'patients': 'patients'}, patient._build_patient,
+                               keep_empty=False)
+
+
+async def get_encounters_batch(request):
+    return await process_batch(request, "Encounters", {'encounters': 'encounters'}, encounter._build_encounter,
+                               keep_empty=False)
+
+
+async def get_labresults_batch(request):
+    return await process_batch(request, "Observations", {'patients': 'obs_for_patients',
+                                                         'encounters': 'obs_for_encounters'},
+                               observation._iter_obs)
+
+
+async def get_clinicalreport_batch(request):
+    return await process_batch(request, "Diag Reports", {'patients': 'report_for_patients',
+                                                         'encounters': 'report_for_encounters'},
+                               diagnostic_report._iter_report)
+
+
+async def get_medication_batch(request):
+    return await process_batch(request, "Medication Administrations", {'patients': 'med_for_patients',
+                                                                       'encounters': 'med_for_encounters'},
+                               medicationAdministration._iter_med)
+
+
+async def get_procedure_batch(request):
+    return await process_batch(request, "Procedures", {'patients': 'proc_for_patients',
+                                                       'encounters': 'proc_for_encounters'},
+                               procedure._iter_proc)
+
+
+async def get_pmsi_batch(request):
+    return await process_batch(request, "PMSIs", {'patients': 'pmsis_for_patients',
+                                                  'encounters': 'pmsis_for_encounters'},
+                               claim._iter_pmsi)
+
+
+async def get_quest_batch(request):
+    return await process_batch(request, "Questionnaire Responses", {'patients': 'quest_for_patients',
+                                                                    'encounters': 'quest_for_encounters'},
+                               questionnaireResponse._build_quest)
+
+
+async def get_bacterio_batch(request):
+    statements = {'patients': 'synergy_for_patients', 'encounters': 'synergy_for_encounters'}
+    try:
+        kind, nums = await read_batch(request, statements)
+    except ValueError as e:
+        return bad_request(str(e))
+    return await process_data(request, f"Bacteriology for {kind} {nums}",
+                              fetch_synergy_batch, statements[kind], BATCH_COLUMNS[kind], nums)
+
+
+def preload_metadata():
+    """
+    Load the metadata maps concurrently, see the metadata section of the config. Called by a worker thread at startup.
+    """
+    logger.info('Preloading metadata...')
+    metadata_registry.preload()
+
+
+async def startup():
+    await postgres_db.open()
+    if isinstance(sparql_db.instance, AsyncSparqlDbInit):
+        await sparql_db.open()
+    # loaded from the snapshot and refreshed by a thread, its sparql queries being sent by the event loop
+    metadata_registry.start(config.get('metadata'))
+    if config['app']['preload_metadata']:
+        await run_in_threadpool(preload_metadata)
+    logger.info('Starting FHIR API')
+
+
+async def shutdown():
+    await run_in_threadpool(metadata_registry.stop)
+    await postgres_db.close()
+    if isinstance(sparql_db.instance, AsyncSparqlDbInit):
+        await sparql_db.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/status/pools', get_pools_status),
+        Route('/status/cache', get_cache_status),
+        Route('/status/metadata', get_metadata_status),
+        Route('/patients/{patient_num}', get_patient),
+        Route('/encounters/{encounter_num}', get_encounter),
+        Route('/encounters', get_encounters_patient),
+        Route('/patients/{patient_num}/labResults', get_labresults_patient),
+        Route('/encounters/{encounter_num}/labResults', get_labresults_encounter),
+        Route('/patients/{patient_num}/clinicalReports', get_clinicalreport_patient),
+        Route('/encounters/{encounter_num}/clinicalReports', get_clinicalreport_encounter),
+        Route('/patients/{patient_num}/medicationAdministrations', get_medication_patient),
+        Route('/encounters/{encounter_num}/medicationAdministrations', get_medication_encounter),
+        Route('/patients/{patient_num}/procedures', get_procedure_patient),
+        Route('/encounters/{encounter_num}/procedures', get_procedure_encounter),
+        Route('/patients/{patient_num}/pmsis', get_pmsi_patient),
+        Route('/encounters/{encounter_num}/pmsis', get_pmsi_encounter),
+        Route('/patients/{patient_num}/questionnaireResponses', get_quest_patient),
+        Route('/encounters/{encounter_num}/questionnaireResponses', get_quest_encounter),
+        Route('/patients/{patient_num}/bacteriology', get_bacterio_patient),
+        Route('/encounters/{encounter_num}/bacteriology', get_bacterio_encounter),
+        Route('/patients/{patient_num}/$everything', get_everything_patient),
+        Route('/patients/_batch', get_patients_batch, methods=['POST']),
+        Route('/encounters/_batch', get_encounters_batch, methods=['POST']),
+        Route('/labResults/_batch', get_labresults_batch, methods=['POST']),
+        Route('/clinicalReports/_batch', get_clinicalreport_batch, methods=['POST']),
+        Route('/medicationAdministrations/_batch', get_medication_batch, methods=['POST']),
+        Route('/procedures/_batch', get_procedure_batch, methods=['POST']),
+        Route('/pmsis/_batch', get_pmsi_batch, methods=['POST']),
+        Route('/questionnaireResponses/_batch', get_quest_batch, methods=['POST']),
+        Route('/bacteriology/_batch', get_bacterio_batch, methods=['POST']),
+    ],
+    exception_handlers={
+        HTTPException: handle_exception,
+        Exception: handle_server_error,
+    },
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
+# as flask, urls with a trailing slash are not found instead of being redirected (ex: /encounters/)
+app.router.redirect_slashes = False
+
+
+if __name__ == "__main__":
+    # base port is 5000, as the flask app
+    uvicorn.run(app, host='127.0.0.1', port=5000)